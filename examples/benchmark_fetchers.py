@@ -0,0 +1,34 @@
+import time
+
+from hcp_builder.dataset import _timeseries_frame, _contrasts_frame, \
+    TASK_LIST
+
+
+def benchmark(n_subjects=1200, n_repeats=5):
+    """Time the path building of the fetchers for a full cohort, without
+    touching the filesystem."""
+    subjects = list(range(100000, 100000 + n_subjects))
+    builders = {
+        'rest': lambda: _timeseries_frame('/HCP', subjects, 'rest', [1, 2]),
+        'task': lambda: _timeseries_frame('/HCP', subjects, 'task',
+                                          TASK_LIST),
+        'contrasts level 1 + 2': lambda: _contrasts_frame(
+            '/HCP', subjects, 'nistats', ['LR', 'RL', 'level2']),
+        'contrasts fsl': lambda: _contrasts_frame('/HCP', subjects, 'fsl',
+                                                  ['level2']),
+    }
+    total = 0
+    for name, builder in builders.items():
+        timings = []
+        for _ in range(n_repeats):
+            t0 = time.time()
+            res = builder()
+            timings.append(time.time() - t0)
+        total += min(timings)
+        print('%s: %i rows in %.3f s' % (name, res.shape[0], min(timings)))
+    print('Full cohort metadata in %.3f s' % total)
+    return total
+
+
+if __name__ == '__main__':
+    benchmark()
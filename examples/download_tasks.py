@@ -1,99 +1,56 @@
-import os
-import traceback
-from os.path import join
+from functools import partial
 
-from hcp_builder.dataset import download_experiment, fetch_subject_list, \
-    TASK_LIST
-from sklearn.externals.joblib import Parallel
-from sklearn.externals.joblib import delayed
+from hcp_builder.dataset import fetch_subject_list, TASK_LIST
+from hcp_builder.scheduler import Scheduler, default_stages, evict_stage
 
-from hcp_builder.glm import run_glm
-from hcp_builder.dataset import get_data_dirs
 
+def download_and_make_contrasts():
+    """Download the task runs of the cohort and fit their GLM.
 
-def download_and_make_contrasts(subject, task, overwrite=False, verbose=0):
-    data_dir = get_data_dirs()[0]
-    error_dir = join(data_dir, 'failures')
-    try:
-        download_experiment(subject, data_type='task',
-                            tasks=task, overwrite=overwrite,
-                            verbose=verbose)
-    except Exception as e:
-        print('Failed downloading subject %s for task %s'
-              % (subject, task))
-        traceback.print_exc()
-        with open(join(error_dir, 'task_download_%s_%s'
-                                  % (subject, task)), 'w+') as f:
-            f.write('Failed downloading.')
-            return
-    try:
-        run_glm(subject, task, backend='nistats', verbose=verbose)
-    except Exception as e:
-        print('Failed making contrasts for task %s,'
-              ' subject %s ' % (task, subject))
-        traceback.print_exc()
-        with open(join(error_dir, 'task_glm_%s_%s'
-                                  % (subject, task)), 'w+') as f:
-            f.write('Failed making contrasts.')
+    Job states are kept in jobs.db in the data directory: the script can be
+    interrupted and run again, completed jobs are skipped."""
+    stages = default_stages(n_download_jobs=8, n_glm_jobs=16)
+    scheduler = Scheduler(stages=stages, max_attempts=3, verbose=1)
+    scheduler.add(fetch_subject_list(), TASK_LIST)
+    status = scheduler.run()
+    print(status['status'].groupby(level='stage').value_counts())
 
 
-def make_contrasts(subject, task, overwrite=False, verbose=0):
-    data_dir = get_data_dirs()[0]
-    error_dir = join(data_dir, 'failures')
-    try:
-        run_glm(subject, task, backend='nistats', verbose=verbose)
-    except Exception as e:
-        print('Failed making contrasts for task %s,'
-              ' subject %s ' % (task, subject))
-        traceback.print_exc()
-        with open(join(error_dir, 'task_glm_%s_%s'
-                                  % (subject, task)), 'w+') as f:
-            f.write('Failed making contrasts.')
+def stream_contrasts(max_subjects=24, cold_dir=None):
+    """Process the cohort on a small scratch volume: at most max_subjects
+    subjects have raw runs on disk, which are deleted, or moved to
+    cold_dir, once their GLM outputs are verified.
 
-
-def restart_failed():
-    data_dir = get_data_dirs()[0]
-    error_dir = join(data_dir, 'failures')
-    restarts = []
-    n_jobs = 16
-    for name in os.listdir(error_dir):
-        os.unlink(join(error_dir, name))
-        _, _, subject, task = name.split('_')
-        restarts.append((subject, task))
-    Parallel(n_jobs=n_jobs, verbose=10)(delayed(
-        download_and_make_contrasts)(subject, task, verbose=1,
-                                     overwrite=True) for subject, task
-                                        in restarts)
+    The runs of failed jobs are kept until the slots of the stream are all
+    held by failed subjects: they are then evicted as well, and the stream
+    goes on."""
+    stages = default_stages(n_download_jobs=8, n_glm_jobs=16, evict=True,
+                            cold_dir=cold_dir)
+    scheduler = Scheduler(stages=stages, max_attempts=3,
+                          max_subjects=max_subjects, verbose=1)
+    scheduler.add(fetch_subject_list(), TASK_LIST)
+    while True:
+        status = scheduler.run()
+        if not scheduler.release(cleanup=partial(evict_stage, check=False,
+                                                 cold_dir=cold_dir)):
+            break
+    print(status['status'].groupby(level='stage').value_counts())
 
 
-def download():
-    data_dir = get_data_dirs()[0]
-    error_dir = join(data_dir, 'failures')
-    if not os.path.exists(error_dir):
-        os.makedirs(error_dir)
-    n_jobs = 36
-    subjects = fetch_subject_list()
-    tasks = TASK_LIST
-    Parallel(n_jobs=n_jobs, verbose=10)(delayed(make_contrasts)(subject, task,
-                                                                overwrite=True,
-                                                                verbose=1)
-                                        for subject in subjects
-                                        for task in tasks)
+def make_contrasts():
+    """Fit the GLM of already downloaded runs."""
+    stages = default_stages(n_glm_jobs=36)[1:]
+    scheduler = Scheduler(stages=stages, max_attempts=3, verbose=1)
+    scheduler.add(fetch_subject_list(), TASK_LIST, stages=['glm'])
+    scheduler.run()
 
 
-def contrasts():
-    data_dir = get_data_dirs()[0]
-    error_dir = join(data_dir, 'failures')
-    if not os.path.exists(error_dir):
-        os.makedirs(error_dir)
-    n_jobs = 36
-    subjects = fetch_subject_list()
-    tasks = TASK_LIST
-    Parallel(n_jobs=n_jobs, verbose=10)(delayed(
-        make_contrasts)(subject, task,
-                        overwrite=True, verbose=1) for subject in subjects
-                                        for task in tasks)
+def restart_failed():
+    scheduler = Scheduler(stages=default_stages(n_download_jobs=8,
+                                                n_glm_jobs=16), verbose=1)
+    scheduler.reset_failed()
+    scheduler.run()
 
 
 if __name__ == '__main__':
-    contrasts()
+    download_and_make_contrasts()
@@ -1,19 +1,29 @@
 import glob
 import os
+import shutil
+import threading
 import traceback
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join
 
-import boto
-import nibabel
 import pandas as pd
 import sys
-from boto.s3.key import Key
+from nilearn._utils import check_niimg
 from nilearn.datasets.utils import _fetch_file
 from sklearn.datasets.base import Bunch
 
 import numpy as np
 
+from .utils.inventory import Inventory
+from .utils.packed import PackedFile, PackedMap, packed_filename
+from .utils.timeseries import cache_timeseries, cache_filename, mask_key, \
+    is_cached
+from .utils.store import write_store, read_store, read_index, \
+    MASK_FILE as STORE_MASK_FILE
+from .utils.s3 import get_bucket, download_key, download_keys, S3Manifest, \
+    check_gzip
+
 TASK_LIST = ['EMOTION', 'WM', 'MOTOR', 'RELATIONAL',
              'GAMBLING', 'SOCIAL', 'LANGUAGE']
 
@@ -179,9 +189,50 @@ CONTRASTS = [["WM", 1, "2BK_BODY"],
 def _init_s3_connection(aws_key, aws_secret,
                         bucket_name,
                         host='s3.amazonaws.com'):
-    com = boto.connect_s3(aws_key, aws_secret, host=host)
-    bucket = com.get_bucket(bucket_name, validate=False)
-    return bucket
+    return get_bucket(aws_key, aws_secret, bucket_name, host=host)
+
+
+def fetch_s3_manifest(subjects=None, data_dir=None, overwrite=False,
+                      verbose=0):
+    """Index the S3 keys of the Results directory of subjects.
+
+    Each subject prefix is listed once and stored in the SQLite manifest
+    `s3_manifest.db` of the data directory. Subsequent existence and size
+    checks of `download_experiment` are answered from it.
+
+    Parameters
+    ----------
+    subjects: list of int or None,
+        Subjects to index. None indexes every subject of
+        `fetch_subject_list`.
+
+    overwrite: bool,
+        List again the subjects that are already indexed.
+
+    Returns
+    -------
+    manifest: hcp_builder.utils.s3.S3Manifest
+    """
+    data_dir = get_data_dirs(data_dir)[0]
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    manifest = S3Manifest(join(data_dir, 's3_manifest.db'))
+    if subjects is None:
+        subjects = fetch_subject_list(data_dir=data_dir)
+    elif not hasattr(subjects, '__iter__'):
+        subjects = [subjects]
+    bucket = None
+    for subject in subjects:
+        prefix = 'HCP_1200/%s/MNINonLinear/Results/' % subject
+        if overwrite or not manifest.has_prefix(prefix):
+            if bucket is None:
+                aws_key, aws_secret, _, _ = get_credentials(data_dir=data_dir)
+                bucket = _init_s3_connection(aws_key, aws_secret,
+                                             'hcp-openaccess')
+            if verbose > 0:
+                print('Listing %s' % prefix)
+            manifest.update(bucket, prefix, overwrite=overwrite)
+    return manifest
 
 
 def _convert_to_s3_target(filename, data_dir=None):
@@ -191,14 +242,124 @@ def _convert_to_s3_target(filename, data_dir=None):
     return filename
 
 
+def _product_frame(levels, names):
+    """Cartesian product of levels, as a frame with one column per name."""
+    index = pd.MultiIndex.from_product(levels, names=names)
+    return index.to_frame(index=False)
+
+
+def _product_paths(prefixes, suffixes):
+    """Concatenate every prefix with every suffix, prefix-major.
+
+    Paths are built with a single vectorized concatenation of object arrays.
+    """
+    prefixes = np.asarray(prefixes, dtype=object)
+    suffixes = np.asarray(suffixes, dtype=object)
+    return (np.repeat(prefixes, len(suffixes))
+            + np.tile(suffixes, len(prefixes)))
+
+
+def _timeseries_frame(data_dir, subjects, data_type, sessions):
+    """Paths of the runs of subjects, built as vectorized string columns.
+
+    sessions holds rest session numbers or task names, depending on
+    data_type.
+    """
+    session_name = 'session' if data_type == 'rest' else 'task'
+    res = _product_frame([subjects, sessions, ['LR', 'RL']],
+                         ['subject', session_name, 'direction'])
+    # Per-run part of the paths, shared by all subjects
+    runs = _product_frame([sessions, ['LR', 'RL']],
+                          [session_name, 'direction'])
+    if data_type == 'rest':
+        root_filename = ('rfMRI_REST' + runs['session'].astype(str)
+                         + '_' + runs['direction'])
+    else:
+        root_filename = 'tfMRI_' + runs['task'] + '_' + runs['direction']
+    root_dir = root_filename + os.sep
+    subject_dirs = [join(data_dir, str(subject), 'MNINonLinear', 'Results',
+                         '') for subject in subjects]
+    res['filename'] = _product_paths(subject_dirs,
+                                     root_dir + root_filename + '.nii.gz')
+    res['mask'] = _product_paths(subject_dirs,
+                                 root_dir + root_filename + '_SBRef.nii.gz')
+    if data_type == 'task':
+        res['feat_file'] = _product_paths(
+            subject_dirs, root_dir + root_filename + '_hp200_s4_level1.fsf')
+        evs = [sorted(EVS[task]) for task in runs['task']]
+        for i in range(max(len(these_evs) for these_evs in evs)):
+            present = np.array([i < len(these_evs) for these_evs in evs])
+            ev_files = [join('EVs', these_evs[i]) if i < len(these_evs)
+                        else '' for these_evs in evs]
+            ev_files = _product_paths(subject_dirs, root_dir + ev_files)
+            ev_files[~np.tile(present, len(subjects))] = np.nan
+            res['ev_%i' % i] = ev_files
+    return res.set_index(['subject', session_name, 'direction'])
+
+
+def _contrasts_frame(data_dir, subjects, output, directions, packed=False):
+    """Paths of the contrast maps of subjects, built as vectorized string
+    columns.
+
+    With packed=True, paths point to the packed maps of each direction,
+    shared by all the contrasts of a task."""
+    contrasts = pd.DataFrame(CONTRASTS,
+                             columns=['task', 'contrast_idx', 'contrast'])
+    res = _product_frame([subjects, np.arange(len(contrasts)), directions],
+                         ['subject', 'row', 'direction'])
+    # Per-contrast part of the paths, shared by all subjects
+    maps = _product_frame([np.arange(len(contrasts)), directions],
+                          ['row', 'direction'])
+    this_contrasts = contrasts.iloc[maps['row'].values].reset_index()
+    res['task'] = np.tile(this_contrasts['task'].values, len(subjects))
+    res['contrast'] = np.tile(this_contrasts['contrast'].values,
+                              len(subjects))
+    task = this_contrasts['task']
+    if output == 'fsl':
+        subject_dirs = [join(data_dir, str(subject), 'MNINonLinear',
+                             'Results', '') for subject in subjects]
+        res['z_map'] = _product_paths(
+            subject_dirs, 'tfMRI_' + task + os.sep + 'tfMRI_' + task
+            + '_hp200_s4_level2vol.feat' + os.sep + 'cope'
+            + this_contrasts['contrast_idx'].astype(str)
+            + '.feat' + os.sep + join('stats', 'zstat1.nii.gz'))
+    else:
+        subject_dirs = [join(data_dir, 'glm', str(subject), '')
+                        for subject in subjects]
+        direction_dir = task + os.sep + maps['direction'] + os.sep
+        if packed:
+            res['z_map'] = _product_paths(
+                subject_dirs, direction_dir + packed_filename('', 'z'))
+            res['effect_map'] = _product_paths(
+                subject_dirs, direction_dir + packed_filename('', 'effects'))
+        else:
+            res['z_map'] = _product_paths(
+                subject_dirs, direction_dir + join('z_maps', 'z_')
+                + this_contrasts['contrast'] + '.nii.gz')
+            res['effect_map'] = _product_paths(
+                subject_dirs, direction_dir + join('effects_maps', 'effects_')
+                + this_contrasts['contrast'] + '.nii.gz')
+    res = res.drop('row', axis=1)
+    res.set_index(['subject', 'task', 'contrast', 'direction'], inplace=True)
+    return res
+
+
 def fetch_hcp_timeseries(data_dir=None,
                          subjects=None,
                          n_subjects=None,
                          data_type='rest',
                          sessions=None,
                          on_disk=True,
-                         tasks=None):
-    """Utility to download from s3"""
+                         tasks=None,
+                         cache_mask=None):
+    """Utility to download from s3
+
+    If cache_mask is provided (a mask image or its path, or True for
+    `fetch_hcp_mask`), the cache_file column holds the paths of the masked
+    runs written by `cache_hcp_timeseries` for this mask. With on_disk=True,
+    it is NaN for runs that are not cached yet, or whose cache is older than
+    the run.
+    """
     data_dir = get_data_dirs(data_dir)[0]
 
     if data_type not in ['task', 'rest']:
@@ -214,69 +375,91 @@ def fetch_hcp_timeseries(data_dir=None,
                                   data_dir)).issuperset(set(subjects)):
         raise ValueError('Wrong subjects.')
 
-    res = []
-    for subject in subjects:
-        subject_dir = join(data_dir, str(subject), 'MNINonLinear', 'Results')
-        if data_type is 'task':
-            if tasks is None:
-                sessions = TASK_LIST
-            elif isinstance(tasks, str):
-                sessions = [tasks]
-            if not set(TASK_LIST).issuperset(set(sessions)):
-                raise ValueError('Wrong tasks.')
+    if data_type == 'task':
+        if tasks is None:
+            sessions = TASK_LIST
+        elif isinstance(tasks, str):
+            sessions = [tasks]
         else:
-            if sessions is None:
-                sessions = [1, 2]
-            elif isinstance(sessions, int):
-                sessions = [sessions]
-            if not set([1, 2]).issuperset(set(sessions)):
-                raise ValueError('Wrong rest sessions.')
-        for session in sessions:
-            for direction in ['LR', 'RL']:
-                if data_type == 'task':
-                    task = session
-                    root_filename = 'tfMRI_%s_%s' % (task, direction)
-                else:
-                    root_filename = 'rfMRI_REST%i_%s' % (session,
-                                                         direction)
-                root_dir = join(subject_dir, root_filename)
-                filename = join(root_dir, root_filename + '.nii.gz')
-                mask = join(root_dir, root_filename + '_SBRef.nii.gz')
-                confounds = ['Movement_AbsoluteRMS_mean.txt',
-                             'Movement_AbsoluteRMS.txt',
-                             'Movement_Regressors_dt.txt',
-                             'Movement_Regressors.txt',
-                             'Movement_RelativeRMS_mean.txt',
-                             'Movement_RelativeRMS.txt']
-                res_dict = {'filename': filename, 'mask': mask}
-                print(filename)
-                # for i, confound in enumerate(confounds):
-                #     res_dict['confound_%i' % i] = join(root_dir, confound)
-                if data_type is 'task':
-                    feat_file = join(root_dir,
-                                     "tfMRI_%s_%s_hp200_s4_level1.fsf"
-                                     % (task, direction))
-                    res_dict['feat_file'] = feat_file
-                    for i, ev in enumerate(EVS[task]):
-                        res_dict['ev_%i' % i] = join(root_dir, 'EVs', ev)
-                requested_on_disk = os.path.exists(filename)
-                res_dict['subject'] = subject
-                res_dict['direction'] = direction
-                if data_type == 'rest':
-                    res_dict['session'] = session
-                else:
-                    res_dict['task'] = task
-                if not on_disk or requested_on_disk:
-                    res.append(res_dict)
-
-    res = pd.DataFrame(res)
-    if not res.empty:
-        if data_type == 'rest':
-            res.set_index(['subject', 'session', 'direction'],
-                          inplace=True)
-        else:
-            res.set_index(['subject', 'task', 'direction'],
-                          inplace=True)
+            sessions = list(tasks)
+        if not set(TASK_LIST).issuperset(set(sessions)):
+            raise ValueError('Wrong tasks.')
+    else:
+        if sessions is None:
+            sessions = [1, 2]
+        elif isinstance(sessions, int):
+            sessions = [sessions]
+        if not set([1, 2]).issuperset(set(sessions)):
+            raise ValueError('Wrong rest sessions.')
+
+    res = _timeseries_frame(data_dir, subjects, data_type, sessions)
+    if cache_mask is not None:
+        if cache_mask is True:
+            cache_mask = fetch_hcp_mask(data_dir)
+        key = mask_key(check_niimg(cache_mask))
+        res['cache_file'] = [cache_filename(filename, key)
+                             for filename in res['filename']]
+    if on_disk and not res.empty:
+        inventory = fetch_inventory(data_dir, subjects=subjects)
+        res = res.loc[inventory.exists(res['filename'])]
+        if cache_mask is not None:
+            # Caches of an older version of the run are not valid
+            cached = inventory.exists(res['cache_file'])
+            cached[cached] = [is_cached(source, target) for source, target
+                              in zip(res['filename'][cached],
+                                     res['cache_file'][cached])]
+            res['cache_file'] = res['cache_file'].where(cached)
+    return res
+
+
+def cache_hcp_timeseries(data_dir=None,
+                         subjects=None,
+                         n_subjects=None,
+                         data_type='rest',
+                         sessions=None,
+                         tasks=None,
+                         mask=None,
+                         overwrite=False,
+                         n_jobs=1,
+                         verbose=0):
+    """Cache the masked runs of subjects as uncompressed float32 arrays.
+
+    Each run found by `fetch_hcp_timeseries` is decompressed once, volume by
+    volume, and stored next to it as an (n_scans, n_voxels) .npy file, named
+    after the hash of the mask. Runs whose cache is up to date are skipped.
+    The arrays are meant to be loaded with np.load(mmap_mode='r').
+
+    Parameters
+    ----------
+    mask: Nifti image, str or None,
+        Mask applied to the runs. Defaults to `fetch_hcp_mask`.
+
+    n_jobs: int,
+        Number of runs decompressed concurrently.
+
+    Returns
+    -------
+    res: pandas.DataFrame, output of `fetch_hcp_timeseries`, with the
+        cache_file column filled
+    """
+    data_dir = get_data_dirs(data_dir)[0]
+    if mask is None:
+        mask = fetch_hcp_mask(data_dir)
+    mask = check_niimg(mask)
+    res = fetch_hcp_timeseries(data_dir, subjects=subjects,
+                               n_subjects=n_subjects, data_type=data_type,
+                               sessions=sessions, tasks=tasks, on_disk=True)
+    key = mask_key(mask)
+    targets = [cache_filename(filename, key) for filename in res['filename']]
+
+    def cache(source, target):
+        if verbose > 0:
+            print('Caching %s' % source)
+        return cache_timeseries(source, target, mask, overwrite=overwrite)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        res['cache_file'] = list(executor.map(cache, res['filename'],
+                                              targets))
     return res
 
 
@@ -285,8 +468,14 @@ def fetch_hcp_contrasts(data_dir=None,
                         n_subjects=None,
                         subjects=None,
                         on_disk=True,
-                        level=2):
-    """Nilearn like fetcher"""
+                        level=2,
+                        packed=False):
+    """Nilearn like fetcher
+
+    With packed=True, maps are read from the packed output of
+    `hcp_builder.glm.run_nistats_glm`: the z_map and effect_map columns then
+    hold lazy PackedMap views instead of paths.
+    """
     data_dir = get_data_dirs(data_dir)[0]
 
     if subjects is None:
@@ -298,81 +487,147 @@ def fetch_hcp_contrasts(data_dir=None,
                                   data_dir)).issuperset(set(subjects)):
         raise ValueError('Wrong subjects.')
 
-    res = []
     if output == 'fsl':
-        for subject in subjects:
-            subject_dir = join(data_dir, str(subject), 'MNINonLinear',
-                               'Results')
-            for i, contrast in enumerate(CONTRASTS):
-                task_name = contrast[0]
-                contrast_idx = contrast[1]
-                contrast_name = contrast[2]
-                if level == 2:
-                    z_map = join(subject_dir, "tfMRI_%s/tfMRI_%s_hp200_s4_"
-                                              "level2vol.feat/cope%i.feat/"
-                                              "stats/zstat1.nii.gz"
-                                 % (task_name, task_name, contrast_idx))
-                    if os.path.exists(z_map) or not on_disk:
-                        res.append({'z_map': z_map,
-                                    'subject': subject,
-                                    'task': task_name,
-                                    'contrast': contrast_name,
-                                    'direction': 'level2'
-                                    })
-                    else:
-                        break
-                else:
-                    raise ValueError("Can only output level 2 images"
-                                     "with output='fsl'")
+        if packed:
+            raise ValueError("Packed maps are only available with "
+                             "output='nistats'")
+        if level != 2:
+            raise ValueError("Can only output level 2 images"
+                             "with output='fsl'")
+        directions = ['level2']
+    elif level == 2:
+        directions = ['level2']
+    elif level == 1:
+        directions = ['LR', 'RL']
     else:
-        source_dir = join(data_dir, 'glm')
-        if level == 2:
-            directions = ['level2']
-        elif level == 1:
-            directions = ['LR', 'RL']
-        else:
-            raise ValueError('Level should be 1 or 2, got %s' % level)
-        for subject in subjects:
-            subject_dir = join(source_dir, str(subject))
-            for contrast in CONTRASTS:
-                task_name = contrast[0]
-                contrast_name = contrast[2]
-                for direction in directions:
-                    z_dir = join(subject_dir, task_name, direction,
-                                 'z_maps')
-                    effect_dir = join(subject_dir, task_name, direction,
-                                      'effects_maps')
-                    z_map = join(z_dir, 'z_' + contrast_name +
-                                 '.nii.gz')
-                    effect_map = join(effect_dir, 'effects_' + contrast_name +
-                                      '.nii.gz')
-                    if ((os.path.exists(z_map) and os.path.exists(effect_map))
-                        or not on_disk):
-                        res.append({'z_map': z_map,
-                                    'effect_map': effect_map,
-                                    'subject': subject,
-                                    'task': task_name,
-                                    'contrast': contrast_name,
-                                    'direction': direction
-                                    })
-    res = pd.DataFrame(res)
-    if not res.empty:
-        res.set_index(['subject', 'task', 'contrast', 'direction'],
-                      inplace=True)
-        res.sort_index(ascending=True, inplace=True)
+        raise ValueError('Level should be 1 or 2, got %s' % level)
+
+    res = _contrasts_frame(data_dir, subjects, output, directions,
+                           packed=packed)
+    if on_disk and not res.empty:
+        inventory = fetch_inventory(data_dir, subjects=subjects)
+        present = inventory.exists(res['z_map'])
+        if 'effect_map' in res:
+            present &= inventory.exists(res['effect_map'])
+        res = res.loc[present]
+    res.sort_index(ascending=True, inplace=True)
+    if packed:
+        contrasts = res.index.get_level_values('contrast')
+        for column in ['z_map', 'effect_map']:
+            packed_files = {filename: PackedFile(filename)
+                            for filename in pd.unique(res[column])}
+            res[column] = [PackedMap(packed_files[filename], contrast)
+                           for filename, contrast
+                           in zip(res[column], contrasts)]
     return res
 
 
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+
+def fetch_inventory(data_dir=None, subjects=None, refresh=True):
+    """Index of the files of the HCP data directory.
+
+    The index covers the MNINonLinear/Results directory of each subject and
+    the glm output directory. It is stored in `inventory.pkl` under the data
+    directory and refreshed incrementally, relisting only the directories
+    whose modification time changed. The index of a data directory is shared
+    by the threads of the process, and refreshed by one at a time.
+
+    Parameters
+    ----------
+    subjects: list of int or None,
+        Subjects whose directories should be refreshed. None refreshes every
+        subject directory found in the data directory.
+
+    refresh: bool,
+        If False, use the stored index as is, without touching the
+        filesystem.
+
+    Returns
+    -------
+    inventory: hcp_builder.utils.inventory.Inventory
+    """
+    data_dir = get_data_dirs(data_dir)[0]
+    with _inventories_lock:
+        if data_dir not in _inventories:
+            _inventories[data_dir] = Inventory(
+                data_dir, join(data_dir, 'inventory.pkl'))
+        inventory = _inventories[data_dir]
+        if refresh and os.path.exists(data_dir):
+            if subjects is None:
+                with os.scandir(data_dir) as entries:
+                    subjects = [entry.name for entry in entries
+                                if entry.name.isdigit() and entry.is_dir()]
+            elif not hasattr(subjects, '__iter__'):
+                subjects = [subjects]
+            subtrees = []
+            for subject in subjects:
+                subtrees.append(join(str(subject), 'MNINonLinear',
+                                     'Results'))
+                subtrees.append(join('glm', str(subject)))
+            inventory.update(subtrees)
+    return inventory
+
+
+_behavioral_cache = {}
+_behavioral_frames = {}
+
+
+def _read_behavioral_csv(csv_file):
+    """Load a behavioral csv through a typed binary cache.
+
+    The parsed frame, with categorical dtypes for text columns, is pickled
+    next to the csv and memoized in-process. Both are keyed on the
+    modification time of the csv.
+    """
+    mtime = os.stat(csv_file).st_mtime_ns
+    if csv_file in _behavioral_cache:
+        cached_mtime, df = _behavioral_cache[csv_file]
+        if cached_mtime == mtime:
+            return df
+    pickle_file = os.path.splitext(csv_file)[0] + '.pkl'
+    df = None
+    if os.path.exists(pickle_file):
+        try:
+            cached = pd.read_pickle(pickle_file)
+            if cached['mtime'] == mtime:
+                df = cached['df']
+        except Exception:
+            pass
+    if df is None:
+        df = pd.read_csv(csv_file)
+        df.set_index('Subject', inplace=True)
+        text = df.select_dtypes(exclude=['number', 'bool', 'category'])
+        for column in text.columns:
+            df[column] = df[column].astype('category')
+        tmp = pickle_file + '.tmp%i' % os.getpid()
+        pd.to_pickle({'mtime': mtime, 'df': df}, tmp)
+        os.replace(tmp, pickle_file)
+    _behavioral_cache[csv_file] = mtime, df
+    return df
+
+
 def fetch_behavioral_data(data_dir=None,
                           restricted=False,
                           overwrite=False):
-    _, _, username, password = get_credentials(data_dir=data_dir)
+    """Behavioral data of the HCP subjects, indexed by subject.
+
+    The unrestricted csv is downloaded on first use. The joined frame is
+    memoized in-process, keyed on the modification times of the csv files.
+
+    Returns
+    -------
+    df: pandas.DataFrame, a copy that the caller may modify
+    """
     data_dir = get_data_dirs(data_dir)[0]
     behavioral_dir = join(data_dir, 'behavioral')
     if not os.path.exists(behavioral_dir):
         os.makedirs(behavioral_dir)
     csv_unrestricted = join(behavioral_dir, 'hcp_unrestricted_data.csv')
     if not os.path.exists(csv_unrestricted) or overwrite:
+        _, _, username, password = get_credentials(data_dir=data_dir)
         result = _fetch_file(data_dir=data_dir,
                              url='https://db.humanconnectome.org/REST/'
                                  'search/dict/Subject%20Information/results?'
@@ -382,22 +637,30 @@ def fetch_behavioral_data(data_dir=None,
                              username=username, password=password)
         os.rename(result, csv_unrestricted)
     csv_restricted = join(behavioral_dir, 'hcp_restricted_data.csv')
-    df_unrestricted = pd.read_csv(csv_unrestricted)
-    df_unrestricted.set_index('Subject', inplace=True)
     if restricted and not os.path.exists(csv_restricted):
         warnings.warn("Cannot automatically retrieve restricted data. "
                       "Please create the file '%s' manually" %
                       csv_restricted)
         restricted = False
+    csv_files = [csv_unrestricted]
+    if restricted:
+        csv_files.append(csv_restricted)
+    mtimes = tuple(os.stat(csv_file).st_mtime_ns for csv_file in csv_files)
+    key = behavioral_dir, restricted
+    if key in _behavioral_frames:
+        cached_mtimes, df = _behavioral_frames[key]
+        if cached_mtimes == mtimes:
+            return df.copy()
+    df_unrestricted = _read_behavioral_csv(csv_unrestricted)
     if not restricted:
-        df = df_unrestricted
+        df = df_unrestricted.copy()
     else:
-        df_restricted = pd.read_csv(csv_restricted)
-        df_restricted.set_index('Subject', inplace=True)
+        df_restricted = _read_behavioral_csv(csv_restricted)
         df = df_unrestricted.join(df_restricted, how='outer')
     df.sort_index(ascending=True, inplace=True)
     df.index.names = ['subject']
-    return df
+    _behavioral_frames[key] = mtimes, df
+    return df.copy()
 
 
 def fetch_subject_list(data_dir=None, n_subjects=None, only_terminated=True, overwrite=False):
@@ -417,7 +680,25 @@ def download_experiment(subject,
                         sessions=None,
                         overwrite=False,
                         mock=False,
+                        n_jobs=4,
+                        deep_check=False,
                         verbose=0):
+    """Download the files of a subject, fetching n_jobs keys at once.
+
+    Every download thread reuses its own S3 connection. Global bounds on
+    concurrency and bandwidth are set with
+    `hcp_builder.utils.s3.set_transfer_limits`. Downloads are checked against
+    the size and ETag of the manifest while they are written. If deep_check
+    is True, the gzip CRC of NIfTI files is also verified on a background
+    thread.
+
+    Raises FileNotFoundError if none of the files of the subject is on S3.
+
+    Returns
+    -------
+    failures: list of (key, target, exception) of the failed downloads,
+        with a FileNotFoundError for the files missing from S3
+    """
     aws_key, aws_secret, _, _ = get_credentials(data_dir=data_dir)
     bucket = _init_s3_connection(aws_key, aws_secret, 'hcp-openaccess')
     targets = fetch_hcp_timeseries(data_dir=data_dir,
@@ -429,11 +710,9 @@ def download_experiment(subject,
     
     keys = [_convert_to_s3_target(target, data_dir) for target in targets]
 
-    try:
-        download_from_s3(bucket, keys[0], targets[0], mock=True,
-                         verbose=0)
-    except FileNotFoundError:
-        return
+    manifest = fetch_s3_manifest(subject, data_dir=data_dir)
+    if not any(key in manifest for key in keys):
+        raise FileNotFoundError('Subject %s is not on S3' % subject)
 
     if verbose > 0:
         if data_type == 'task':
@@ -442,54 +721,64 @@ def download_experiment(subject,
         else:
             print('Downloading files for subject %s,'
                   ' session %s' % (subject, sessions))
-    for key, target in zip(keys, targets):
-        dirname = os.path.dirname(target)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-        try:
-            download_from_s3(bucket, key, target, mock=mock,
-                             overwrite=overwrite, verbose=verbose - 1)
-        except FileNotFoundError:
-            pass
-        except ConnectionError:
-            os.unlink(target)
-            exc_type, exc_value, exc_traceback = sys.exc_info()
+    if mock:
+        for key, target in zip(keys, targets):
+            try:
+                download_from_s3(bucket, key, target, mock=True,
+                                 manifest=manifest, verbose=verbose - 1)
+            except FileNotFoundError:
+                pass
+        return []
+
+    def bucket_factory():
+        return _init_s3_connection(aws_key, aws_secret, 'hcp-openaccess')
+
+    failures = download_keys(bucket_factory, keys, targets, n_jobs=n_jobs,
+                             overwrite=overwrite, manifest=manifest,
+                             deep=deep_check, verbose=verbose - 1)
+    # Interrupted large downloads leave a .part file and its range sidecar
+    # behind, so that the next attempt only fetches the missing ranges
+    for key, target, error in failures:
+        if isinstance(error, ConnectionError):
+            if os.path.exists(target):
+                os.unlink(target)
             msg = '\n'.join(traceback.format_exception(
-                exc_type, exc_value, exc_traceback))
+                type(error), error, error.__traceback__))
             target += '-error'
             with open(target, 'w+') as f:
                 f.write(msg)
+    return failures
 
 
 def download_from_s3(bucket, key, target, mock=False,
-                     overwrite=False, verbose=0):
+                     overwrite=False, manifest=None, deep_check=False,
+                     verbose=0):
     """Download file from bucket
+
+    The file is checked against the size and ETag of the key while it is
+    written. If deep_check is True, the gzip CRC of .gz files is verified
+    afterwards. If manifest is provided, existence is checked against it
+    instead of S3.
     """
-    my_key = Key(bucket)
-    my_key.key = key
-    if my_key.exists():
-        s3fid = bucket.get_key(key)
-        if not mock:
-            if not os.path.exists(target) or overwrite:
-                if verbose:
-                    print('Downloading %s from %s' % (target, key))
-                s3fid.get_contents_to_filename(target)
-                name, ext = os.path.splitext(target)
-                if ext == '.gz':
-                    try:
-                        _ = nibabel.load(target).get_shape()
-                        if verbose:
-                            print('Nifti consistency checked.')
-                    except:
-                        raise ConnectionError('Corrupted download')
-            else:
-                if verbose:
-                    print('Skipping %s as it already exists' % target)
-        else:
+    if not mock:
+        download_key(bucket, key, target, overwrite=overwrite,
+                     manifest=manifest, verbose=verbose)
+        if deep_check and target.endswith('.gz'):
+            check_gzip(target)
             if verbose:
-                print('Mock download %s from %s' % (target, key))
+                print('Gzip consistency checked.')
     else:
-        raise FileNotFoundError('File does not exist on S3')
+        if manifest is not None:
+            exists = key in manifest
+        else:
+            exists = bucket.get_key(key) is not None
+        if not exists:
+            raise FileNotFoundError('File does not exist on S3')
+        target_dir = os.path.dirname(target)
+        if target_dir:
+            os.makedirs(target_dir, exist_ok=True)
+        if verbose:
+            print('Mock download %s from %s' % (target, key))
 
 
 def get_data_dirs(data_dir=None):
@@ -589,11 +878,188 @@ def fetch_hcp_mask(data_dir=None, url=None, resume=True):
     return join(data_dir, 'mask_img.nii.gz')
 
 
+def _contrast_store_dir(data_dir, map_type, level):
+    return join(data_dir, 'parietal', 'contrast_store',
+                '%s_level%i' % (map_type, level))
+
+
+def build_contrast_store(data_dir=None, subjects=None, n_subjects=None,
+                         map_type='z_map', level=2, packed=False,
+                         batch_size=256, n_jobs=1, verbose=0):
+    """Store the masked contrast maps of the cohort in one array.
+
+    Maps found by `fetch_hcp_contrasts` are masked with `fetch_hcp_mask` and
+    written as one uncompressed float32 array, under
+    `parietal/contrast_store/<map_type>_level<level>`, along with its
+    (subject, task, contrast, direction) row index. Read it back with
+    `load_contrast_store`.
+
+    Parameters
+    ----------
+    map_type: 'z_map' or 'effect_map'
+
+    packed: bool,
+        Read maps from the packed output of the GLM.
+    """
+    data_dir = get_data_dirs(data_dir)[0]
+    if map_type not in ['z_map', 'effect_map']:
+        raise ValueError("Wrong map type. Expected 'z_map' or 'effect_map', "
+                         "got %s" % map_type)
+    contrasts = fetch_hcp_contrasts(data_dir, subjects=subjects,
+                                    n_subjects=n_subjects, level=level,
+                                    packed=packed, on_disk=True)
+    mask = fetch_hcp_mask(data_dir)
+    store_dir = _contrast_store_dir(data_dir, map_type, level)
+    write_store(store_dir, contrasts[map_type].tolist(), contrasts.index,
+                mask, batch_size=batch_size, n_jobs=n_jobs, verbose=verbose)
+    return store_dir
+
+
+def load_contrast_store(data_dir=None, map_type='z_map', level=2,
+                        subjects=None, tasks=None, contrasts=None,
+                        directions=None):
+    """Load masked contrast maps written by `build_contrast_store`.
+
+    Rows are stored sorted by subject, task, contrast and direction. A
+    selection of evenly spaced rows, such as all the maps of consecutive
+    subjects, is returned as a zero-copy np.memmap slice. Other selections
+    are copied in memory.
+
+    Returns
+    -------
+    Bunch with attributes
+        maps: array of shape (n_maps, n_voxels)
+        index: pandas.MultiIndex of the maps
+        mask: str, path of the mask used to build the store
+    """
+    data_dir = get_data_dirs(data_dir)[0]
+    store_dir = _contrast_store_dir(data_dir, map_type, level)
+    if not os.path.exists(store_dir):
+        raise ValueError('No contrast store found in %s, create it with '
+                         'build_contrast_store.' % store_dir)
+    if subjects is not None and not hasattr(subjects, '__iter__'):
+        subjects = [subjects]
+    rows = _select_rows(read_index(store_dir),
+                        {'subject': subjects, 'task': tasks,
+                         'contrast': contrasts, 'direction': directions})
+    maps, index = read_store(store_dir, rows)
+    return Bunch(maps=maps, index=index,
+                 mask=join(store_dir, STORE_MASK_FILE))
+
+
+SNAPSHOT_TABLES = ['rest', 'task', 'contrasts', 'behavioral']
+
+
+def _select_rows(df, predicates):
+    """Keep the rows of df whose index levels are in the given values.
+
+    Predicates on levels that df does not have are ignored.
+    """
+    keep = np.ones(df.shape[0], dtype=bool)
+    for level, values in predicates.items():
+        if values is not None and level in df.index.names:
+            if isinstance(values, str):
+                values = [values]
+            keep &= df.index.get_level_values(level).isin(values)
+    return df if keep.all() else df.loc[keep]
+
+
+def _partition_files(table_dir, subject, tasks=None):
+    """Partition files of a snapshot table for a subject.
+
+    Tables indexed by task are further partitioned by task, so that task
+    predicates skip the other files altogether.
+    """
+    subject_file = join(table_dir, '%s.pkl' % subject)
+    if os.path.exists(subject_file):
+        return [subject_file]
+    subject_dir = join(table_dir, str(subject))
+    if not os.path.exists(subject_dir):
+        return []
+    if tasks is None:
+        return sorted(glob.glob(join(subject_dir, '*.pkl')))
+    if isinstance(tasks, str):
+        tasks = [tasks]
+    return [join(subject_dir, '%s.pkl' % task) for task in tasks
+            if os.path.exists(join(subject_dir, '%s.pkl' % task))]
+
+
+def dump_hcp_snapshot(data_dir=None):
+    """Dump fetch_hcp outputs as a snapshot partitioned by subject.
+
+    Each table of the dataset is pickled under `parietal/snapshot/<table>`,
+    one file per subject, and one file per subject and task for tables
+    indexed by task. dtypes and MultiIndex are preserved. The snapshot is
+    read back with `fetch_hcp(from_file=True)`, which only loads the
+    partitions of the requested subjects and tasks.
+    """
+    dataset = fetch_hcp(data_dir, on_disk=True)
+    data_dir = get_data_dirs(data_dir)[0]
+    snapshot_dir = join(data_dir, 'parietal', 'snapshot')
+    tmp_dir = snapshot_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    subjects = set()
+    for name in SNAPSHOT_TABLES:
+        df = dataset[name]
+        table_dir = join(tmp_dir, name)
+        os.makedirs(table_dir)
+        if df.empty:
+            continue
+        for subject, sub_df in df.groupby(level='subject', sort=False):
+            subjects.add(subject)
+            if 'task' in df.index.names:
+                subject_dir = join(table_dir, str(subject))
+                os.makedirs(subject_dir)
+                for task, task_df in sub_df.groupby(level='task',
+                                                    sort=False):
+                    task_df.to_pickle(join(subject_dir, '%s.pkl' % task))
+            else:
+                sub_df.to_pickle(join(table_dir, '%s.pkl' % subject))
+    pd.to_pickle(sorted(subjects), join(tmp_dir, 'subjects.pkl'))
+    if os.path.exists(snapshot_dir):
+        shutil.rmtree(snapshot_dir)
+    os.replace(tmp_dir, snapshot_dir)
+
+
+def _read_hcp_snapshot(data_dir, subjects, predicates):
+    snapshot_dir = join(data_dir, 'parietal', 'snapshot')
+    if not os.path.exists(snapshot_dir):
+        raise ValueError('No snapshot found in %s, create it with '
+                         'dump_hcp_snapshot.' % snapshot_dir)
+    tables = {}
+    for name in SNAPSHOT_TABLES:
+        table_dir = join(snapshot_dir, name)
+        frames = []
+        for subject in subjects:
+            for filename in _partition_files(table_dir, subject,
+                                             tasks=predicates['task']):
+                frames.append(_select_rows(pd.read_pickle(filename),
+                                           predicates))
+        if frames:
+            tables[name] = pd.concat(frames)
+        else:
+            tables[name] = pd.DataFrame([])
+    return tables
+
+
 def fetch_hcp(data_dir=None, n_subjects=None, subjects=None,
               from_file=False,
-              on_disk=True):
+              on_disk=True,
+              tasks=None,
+              contrasts=None,
+              directions=None):
+    """Fetch rest, task, contrasts and behavioral tables of HCP subjects.
+
+    With from_file=True, tables are read from the snapshot written by
+    `dump_hcp_snapshot`: only the partitions of the requested subjects (and
+    tasks) are loaded. tasks, contrasts and directions restrict the rows of
+    the tables that are indexed by these levels.
+    """
     root = get_data_dirs(data_dir)[0]
     mask = fetch_hcp_mask(data_dir)
+    predicates = {'task': tasks, 'contrast': contrasts,
+                  'direction': directions}
     if not from_file:
         rest = fetch_hcp_timeseries(data_dir, data_type='rest',
                                     n_subjects=n_subjects, subjects=subjects,
@@ -606,6 +1072,9 @@ def fetch_hcp(data_dir=None, n_subjects=None, subjects=None,
                                         n_subjects=n_subjects,
                                         subjects=subjects,
                                         on_disk=on_disk)
+        rest = _select_rows(rest, predicates)
+        task = _select_rows(task, predicates)
+        contrasts = _select_rows(contrasts, predicates)
         behavioral = fetch_behavioral_data(data_dir)
         indices = []
         for df in rest, task, contrasts:
@@ -620,24 +1089,16 @@ def fetch_hcp(data_dir=None, n_subjects=None, subjects=None,
         else:
             behavioral = pd.DataFrame([])
     else:
-        rest = pd.read_csv(join(root, 'parietal', 'rest.csv'))
-        task = pd.read_csv(join(root, 'parietal', 'task.csv'))
-        contrasts = pd.read_csv(join(root, 'parietal',
-                                     'contrasts.csv'))
-        behavioral = pd.read_csv(join(root, 'parietal',
-                                      'behavioral.csv'))
-        behavioral.set_index('subject', inplace=True)
-        rest.set_index(['subject', 'session', 'direction'], inplace=True)
-        task.set_index(['subject', 'task', 'direction'], inplace=True)
-        contrasts.set_index(['subject', 'task', 'contrast', 'direction'],
-                            inplace=True)
         if subjects is None:
-            subjects = fetch_subject_list(data_dir=data_dir,
-                                          n_subjects=n_subjects)
-        rest = rest.loc[subjects]
-        task = task.loc[subjects]
-        contrasts = contrasts.loc[subjects]
-        behavioral = behavioral.loc[subjects]
+            subjects = pd.read_pickle(join(root, 'parietal', 'snapshot',
+                                           'subjects.pkl'))[:n_subjects]
+        elif not hasattr(subjects, '__iter__'):
+            subjects = [subjects]
+        tables = _read_hcp_snapshot(root, subjects, predicates)
+        rest = tables['rest']
+        task = tables['task']
+        contrasts = tables['contrasts']
+        behavioral = tables['behavioral']
 
     return Bunch(rest=rest,
                  contrasts=contrasts,
@@ -648,6 +1109,11 @@ def fetch_hcp(data_dir=None, n_subjects=None, subjects=None,
 
 
 def dump_hcp_csv(data_dir=None):
+    """Export fetch_hcp outputs as flat csv files, for inspection.
+
+    fetch_hcp(from_file=True) reads the snapshot of `dump_hcp_snapshot`
+    instead.
+    """
     dataset = fetch_hcp(data_dir, on_disk=True)
     data_dir = get_data_dirs(data_dir)[0]
     dataset.rest.to_csv(join(data_dir, 'parietal',
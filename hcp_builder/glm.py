@@ -3,79 +3,58 @@ Run GLM on HCP data using nistats.
 """
 # Author: Arthur Mensch, Elvis Dohmatob
 
+import glob
 import inspect
 import os
-import re
+import tempfile
 import warnings
+from functools import partial
 from os.path import join, dirname
+from subprocess import CalledProcessError
 
 import nibabel
 import numpy as np
 import pandas as pd
-import shutil
 from nilearn._utils import check_niimg
-from nilearn.image import new_img_like
+from nistats.design_matrix import make_design_matrix
 from nistats.first_level_model import FirstLevelModel
 from numpy import VisibleDeprecationWarning
-from sklearn.externals.joblib import Memory
-
-from .utils.fsl import run_cmd, configure
-from .dataset import get_data_dirs
-
-# regex for contrasts
-CON_REAL_REGX = ("set fmri\(con_real(?P<con_num>\d+?)\.(?P<ev_num>\d+?)\)"
-                 " (?P<con_val>\S+)")
-
-# regex for "Number of EVs"
-NUM_EV_REGX = """set fmri\(evs_orig\) (?P<evs_orig>\d+)
-set fmri\(evs_real\) (?P<evs_real>\d+)
-set fmri\(evs_vox\) (?P<evs_vox>\d+)"""
-
-# regex for "Number of contrasts"
-NUM_CON_REGX = """set fmri\(ncon_orig\) (?P<ncon>\d+)
-set fmri\(ncon_real\) (?P<ncon_real>\d+)"""
-
-# regex for "# EV %i title"
-EV_TITLE_REGX = """set fmri\(evtitle\d+?\) \"(?P<evtitle>.+)\""""
-
-# regex for "Title for contrast_real %i"
-CON_TITLE_REGX = """set fmri\(conname_real\.\d+?\) \"(?P<conname_real>.+)\""""
-
-# regex for "Basic waveform shape (EV %i)"
-# 0 : Square
-# 1 : Sinusoid
-# 2 : Custom (1 entry per volume)
-# 3 : Custom (3 column format)
-# 4 : Interaction
-# 10 : Empty (all zeros)
-EV_SHAPE_REGX = """set fmri\(shape\d+\) (?P<shape>[0|1|3])"""
-
-# regex for "Custom EV file (EV %i)"
-EV_CUSTOM_FILE_REGX = """set fmri\(custom\d+?\) \"(?P<custom>.+)\""""
-
-
-def _get_abspath_relative_to_file(filename, ref_filename):
-    """
-    Returns the absolute path of a given filename relative to a reference
-    filename (ref_filename).
-
-    """
-
-    # we only handle files
-    assert os.path.isfile(ref_filename)
-
-    old_cwd = os.getcwd()  # save CWD
-    os.chdir(os.path.dirname(ref_filename))  # we're in context now
-    abspath = os.path.abspath(filename)  # bing0!
-    os.chdir(old_cwd)  # restore CWD
-
-    return abspath
+from sklearn.externals.joblib import Memory, hash as joblib_hash
+
+from .utils.cache import LRUCache
+from .utils.packed import dump_packed, unmask_array, packed_filename
+from .utils.writer import ImageWriter
+from .utils.regression import compute_contrasts, fixed_effects, \
+    residual_dof, fit_ar1, chunk_size_from_budget
+from .utils.timeseries import iter_volumes
+from .utils.fsf import write_fsf_files, read_fsf_design, template_n_scans
+from .utils.fsl import run_commands, run_jobs, fsl_environment, JobResult
+from .dataset import get_data_dirs, CONTRASTS
+
+# Default memory budget of fit_run_chunked, in bytes
+MEMORY_BUDGET = 1024 ** 3
+
+# First level model of the nistats backend
+HRF_MODEL = "spm + derivative"
+DRIFT_MODEL = "polynomial"
+DRIFT_ORDER = 2
+PERIOD_CUT = 0
+SMOOTHING_FWHM = 4
+T_R = .72
+
+# Parameters of the HCP FSL pipeline, as passed by compute_stats.sh
+FSL_ORIGINAL_SMOOTHING_FWHM = '2'
+FSL_FINAL_SMOOTHING_FWHM = '4'
+FSL_TEMPORAL_FILTER = '200'
 
 
 def read_fsl_design_file(design_filename):
     """
     Scrapes an FSL design file for the list of contrasts.
 
+    The file is parsed by `hcp_builder.utils.fsf.read_fsf_design`, which
+    memoizes designs by content: the returned lists and arrays are copies.
+
     Returns
     -------
     conditions: list of n_conditions strings
@@ -84,66 +63,18 @@ def read_fsl_design_file(design_filename):
     timing_files: list of n_condtions strings
         absolute paths of files containing timing info for each condition_id
 
-    contrast_ids: list of n_contrasts strings
-        contrast titles
-
-    contrasts: 2D array of shape (n_contrasts, n_conditions)
-        array of contrasts, one line per contrast_id; one column per
-        condition_id
+    contrasts: list of n_contrasts (contrast_id, contrast) tuples
+        contrast titles, and arrays of shape (n_conditions,) with one value
+        per condition_id
 
     Raises
     ------
-    AssertionError or IndexError if design_filename is corrupt (not in
-    official FSL format)
+    ValueError if design_filename is corrupt (not in official FSL format)
 
     """
-
-    # read design file
-    design_conf = open(design_filename, 'r').read()
-
-    # scrape n_conditions and n_contrasts
-    n_conditions_orig = int(re.search(NUM_EV_REGX,
-                                      design_conf).group("evs_orig"))
-    n_conditions = int(re.search(NUM_EV_REGX, design_conf).group("evs_real"))
-    n_contrasts = int(re.search(NUM_CON_REGX, design_conf).group("ncon_real"))
-
-    # initialize 2D array of contrasts
-    contrasts = np.zeros((n_contrasts, n_conditions))
-
-    # lookup EV titles
-    conditions = [item.group("evtitle") for item in re.finditer(
-        EV_TITLE_REGX, design_conf)]
-    assert len(conditions) == n_conditions_orig
-
-    # lookup contrast titles
-    contrast_ids = [item.group("conname_real") for item in re.finditer(
-        CON_TITLE_REGX, design_conf)]
-    assert len(contrast_ids) == n_contrasts
-
-    # lookup EV (condition) custom files
-    timing_files = [_get_abspath_relative_to_file(item.group("custom"),
-                                                  design_filename)
-                    for item in re.finditer(EV_CUSTOM_FILE_REGX, design_conf)]
-
-    # lookup the contrast values
-    count = 0
-    for item in re.finditer(CON_REAL_REGX, design_conf):
-        count += 1
-        value = float(item.group('con_val'))
-
-        i = int(item.group('con_num')) - 1
-        j = int(item.group('ev_num')) - 1
-
-        # roll-call
-        assert 0 <= i < n_contrasts, item.group()
-        assert 0 <= j < n_conditions, item.group()
-
-        contrasts[i, j] = value
-
-    # roll-call
-    assert count == n_contrasts * n_conditions, count
-
-    return conditions, timing_files, list(zip(contrast_ids, contrasts))
+    design = read_fsf_design(design_filename)
+    return design.conditions, design.timing_files, list(zip(
+        design.contrast_names, design.contrasts))
 
 
 def make_paradigm_from_timing_files(timing_files, trial_types=None):
@@ -194,12 +125,277 @@ def make_paradigm_from_timing_files(timing_files, trial_types=None):
                          'modulation': amplitudes})
 
 
-def run_nistats_glm(subject, task, verbose=0):
+# Design matrices shared by the GLM fits of the current process
+_design_cache = LRUCache(max_size=32)
+
+
+def make_cached_design_matrix(frame_times, events, hrf_model, drift_model,
+                              period_cut, drift_order, cache=None):
+    """Build a design matrix, reusing it across identical designs.
+
+    The design is identified by a hash of the event timings, the frame
+    times and the HRF/drift settings, so that subjects sharing a paradigm
+    share a single design matrix.
+
+    Parameters
+    ----------
+    cache: hcp_builder.utils.cache.LRUCache or None,
+        Cache to use, defaults to a process-wide in-memory cache. Provide an
+        LRUCache with a cache_dir to share designs across processes.
+    """
+    if cache is None:
+        cache = _design_cache
+    events = events[['trial_type', 'onset', 'duration', 'modulation']]
+    key = joblib_hash((np.asarray(frame_times),
+                       events.reset_index(drop=True),
+                       hrf_model, drift_model, period_cut, drift_order))
+
+    def compute():
+        return make_design_matrix(frame_times, events,
+                                  hrf_model=hrf_model,
+                                  drift_model=drift_model,
+                                  period_cut=period_cut,
+                                  drift_order=drift_order)
+    return cache.get(key, compute)
+
+
+def _as_mask(mask):
+    """Boolean mask array of a mask image, or of an array."""
+    if isinstance(mask, np.ndarray):
+        return mask.astype(bool, copy=False)
+    return check_niimg(mask).get_data() != 0
+
+
+def _mask_run(fmri_file, mask, filename, smoothing_fwhm=None, verbose=0):
+    """Decompress, smooth and mask a run volume by volume into a float32
+    (n_scans, n_voxels) memmap."""
+    mask = _as_mask(mask)
+    n_scans = nibabel.load(fmri_file).shape[3]
+    data = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32,
+                                     shape=(n_scans, int(mask.sum())))
+    if verbose > 0:
+        print("Masking %s ..." % fmri_file)
+    for i, volume in enumerate(iter_volumes(fmri_file, mask=mask,
+                                            smoothing_fwhm=smoothing_fwhm)):
+        data[i] = volume
+    data.flush()
+    return data
+
+
+def fit_run_chunked(fmri_file, design, mask, smoothing_fwhm=None,
+                    memory_budget=MEMORY_BUDGET, tmp_dir=None, verbose=0):
+    """Fit the AR(1) GLM of a run within a memory budget.
+
+    The run is decompressed, smoothed and masked one volume at a time into
+    a temporary float32 (n_scans, n_voxels) memmap. The GLM is then fitted
+    over blocks of voxels sized after memory_budget, see
+    `hcp_builder.utils.regression.fit_ar1`. The model is the one of
+    FirstLevelModel(standardize=True, noise_model='ar1').
+
+    Parameters
+    ----------
+    mask: boolean array or Nifti image
+
+    memory_budget: int,
+        Bytes of memory used by the fit, besides the per-voxel outputs.
+
+    tmp_dir: str or None,
+        Directory of the temporary memmap.
+
+    Returns
+    -------
+    labels, results: as FirstLevelModel.labels_[0] and results_[0]
+    """
+    fd, tmp = tempfile.mkstemp(suffix='.npy', dir=tmp_dir)
+    os.close(fd)
+    try:
+        data = _mask_run(fmri_file, mask, tmp,
+                         smoothing_fwhm=smoothing_fwhm, verbose=verbose)
+        chunk_size = chunk_size_from_budget(data.shape[0], memory_budget)
+        if verbose > 0:
+            print("Fitting GLM by blocks of %i voxels ..." % chunk_size)
+        return fit_ar1(data, np.asarray(design), standardize=True,
+                       chunk_size=chunk_size)
+    finally:
+        data = None
+        os.remove(tmp)
+
+
+def compute_contrasts_batch(labels, results, contrasts):
+    """Compute the z and effect maps of all contrasts in a single pass.
+
+    Contrast vectors are stacked into one matrix and projected over the
+    labelled regression results of the fitted model at once, see
+    `hcp_builder.utils.regression.compute_contrasts`.
+
+    Parameters
+    ----------
+    labels, results: voxel labels and regression results of a single run,
+        e.g. FirstLevelModel.labels_[0] and results_[0]
+
+    contrasts: list of (name, array of shape (n_regressors,))
+
+    Returns
+    -------
+    z_score, effect, variance: arrays of shape (n_contrasts, n_voxels)
+        Masked maps, that the masker of the run turns into 4D images with
+        one volume per contrast.
+
+    dof: array of shape (n_voxels,)
+        Residual degrees of freedom.
+    """
+    contrast_matrix = np.array([contrast_val for _, contrast_val
+                                in contrasts])
+    effect, variance, z_score = compute_contrasts(labels, results,
+                                                  contrast_matrix)
+    return z_score, effect, variance, residual_dof(labels, results)
+
+
+def _save_contrast_maps(writer, mask_img, mask, maps, contrasts, output_dir,
+                        map_type, packed=False):
+    """Save masked contrast maps of shape (n_contrasts, n_voxels).
+
+    Maps are either packed in a single array (see
+    `hcp_builder.utils.packed`), or unmasked with the boolean mask and
+    queued to the ImageWriter, one file per contrast.
+    """
+    contrast_names = [contrast_name for contrast_name, _ in contrasts]
+    if packed:
+        dump_packed(output_dir, map_type, maps, contrast_names)
+        return
+    map_dir = os.path.join(output_dir, '%s_maps' % map_type)
+    if not os.path.exists(map_dir):
+        os.makedirs(map_dir)
+    for i, contrast_name in enumerate(contrast_names):
+        map_path = os.path.join(map_dir, '%s_%s.nii.gz' % (map_type,
+                                                           contrast_name))
+        writer.save(nibabel.Nifti1Image(unmask_array(maps[i], mask),
+                                        mask_img.affine), map_path)
+
+
+def _subject_mask(subject_data_dir, task, sessions):
+    """Intersection of the SBRef supports of the runs of a task.
+
+    Returns the mask image and the corresponding boolean array, used for
+    all the masking and unmasking of the task.
+    """
+    mask = None
+    affine = None
+    for session in sessions:
+        sbref = nibabel.load(join(subject_data_dir,
+                                  "tfMRI_%s_%s/tfMRI_%s_%s_SBRef.nii.gz" % (
+                                      task, session, task, session)))
+        this_mask = np.asanyarray(sbref.dataobj) != 0
+        mask = this_mask if mask is None else mask & this_mask
+        affine = sbref.affine
+    mask_img = nibabel.Nifti1Image(mask.astype(np.int8), affine)
+    return mask_img, mask
+
+
+def _read_run(subject_data_dir, task, session, design_cache=None,
+              verbose=0):
+    """Run file, design matrix and padded contrasts of a task run."""
+    fmri_file = os.path.join(subject_data_dir,
+                             "tfMRI_%s_%s/tfMRI_%s_%s.nii.gz" % (
+                                 task, session, task, session))
+    design_file = os.path.join(subject_data_dir,
+                               "tfMRI_%s_%s/tfMRI_%s_%s_hp200_s4_level1.fsf"
+                               % (task, session, task, session))
+    # read the experimental setup
+    if verbose > 0:
+        print("Reading experimental setup from %s ..." % design_file)
+    trial_types, timing_files, contrasts = read_fsl_design_file(
+        design_file)
+
+    # fix timing filenames as we load the fsl file one directory
+    # higher than expected
+    timing_files = [tf.replace("EVs", "tfMRI_%s_%s/EVs" % (
+        task, session)) for tf in timing_files]
+
+    # make design matrix
+    if verbose > 0:
+        print("Constructing design matrix for direction %s ..." % session)
+    events = make_paradigm_from_timing_files(timing_files,
+                                             trial_types=trial_types)
+    # frame times as computed by FirstLevelModel, from the header only
+    n_scans = nibabel.load(fmri_file).shape[3]
+    frame_times = np.linspace(0, (n_scans - 1) * T_R, n_scans)
+    design = make_cached_design_matrix(frame_times, events,
+                                       hrf_model=HRF_MODEL,
+                                       drift_model=DRIFT_MODEL,
+                                       period_cut=PERIOD_CUT,
+                                       drift_order=DRIFT_ORDER,
+                                       cache=design_cache)
+
+    # Pad contrast with 1, for subject id
+    for i, (contrast_name, contrast_val) in enumerate(contrasts):
+        size_contrast = contrast_val.shape[0]
+        new_contrast_val = np.zeros(design.shape[1])
+        new_contrast_val[:size_contrast] = contrast_val
+        contrasts[i] = (contrast_name, new_contrast_val)
+    return fmri_file, design, contrasts
+
+
+def _save_run(writer, output_dir, session, mask_img, mask, stats, contrasts,
+              packed=False, verbose=0):
+    """Save the mask and the z and effect maps of a direction."""
+    z_map, eff_map = stats[:2]
+    model_output_dir = join(output_dir, session)
+    if not os.path.exists(model_output_dir):
+        os.makedirs(model_output_dir)
+    mask_path = os.path.join(model_output_dir, "mask.nii.gz")
+    if verbose > 0:
+        print("Saving mask image to %s ..." % mask_path)
+    writer.save(mask_img, mask_path)
+    # store stat maps to disk
+    for map_type, out_map in zip(['z', 'effects'], [z_map, eff_map]):
+        _save_contrast_maps(writer, mask_img, mask, out_map, contrasts,
+                            model_output_dir, map_type, packed=packed)
+
+
+def _save_level2(writer, output_dir, sessions, mask_img, mask, session_stats,
+                 contrasts, packed=False, verbose=0):
+    """Combine directions with fixed effects and save the level 2 maps."""
+    # XXX: we will use SecondLevelModel once it works
+    model_output_dir = join(output_dir, 'level2')
+    if not os.path.exists(model_output_dir):
+        os.makedirs(model_output_dir)
+    mask_path = os.path.join(model_output_dir, "mask.nii.gz")
+    if verbose > 0:
+        print("Saving mask image to %s ..." % mask_path)
+    writer.save(mask_img, mask_path)
+    eff_map, _, z_map = fixed_effects(
+        [session_stats[session][1] for session in sessions],
+        [session_stats[session][2] for session in sessions],
+        [session_stats[session][3] for session in sessions])
+    # store stat maps to disk
+    for map_type, out_map in zip(['z', 'effects'], [z_map, eff_map]):
+        _save_contrast_maps(writer, mask_img, mask, out_map, contrasts,
+                            model_output_dir, map_type, packed=packed)
+
+
+def run_nistats_glm(subject, task, design_cache=None, packed=False,
+                    memory_budget=None, n_writers=2, compresslevel=None,
+                    verbose=0):
+    """Fit first and second level GLMs of a subject task with nistats.
+
+    Design matrices are obtained from `make_cached_design_matrix`, using
+    design_cache if provided. If packed is True, the maps of each direction
+    are stored as masked arrays (z_maps.npy, effects_maps.npy and
+    contrasts.json) instead of one Nifti file per contrast.
+
+    If memory_budget is provided (in bytes), runs are fitted with
+    `fit_run_chunked` instead of FirstLevelModel, which loads whole runs in
+    memory. The budget bounds the temporaries of the fit only: the masked
+    effects and variances of both directions, of shape (n_contrasts,
+    n_voxels), are kept for level 2, which allocates maps of the same size.
+
+    Images are saved by an `hcp_builder.utils.writer.ImageWriter` with
+    n_writers threads, compressing with the zlib level compresslevel (0 for
+    uncompressed data, None for the nibabel default).
+    """
     warnings.filterwarnings('ignore', category=VisibleDeprecationWarning)
 
-    hrf_model = "spm + derivative"
-    drift_model = "polynomial"
-    drift_order = 2
     subject = str(subject)
     subject_data_dir = join(get_data_dirs()[0], subject,
                             'MNINonLinear', 'Results')
@@ -209,172 +405,410 @@ def run_nistats_glm(subject, task, verbose=0):
     memory = Memory(cachedir=None)
     # Memory(os.path.join(output_dir, "cache_dir", subject), verbose=0)
     sessions = ['RL', 'LR']
-    session_models = {}
-    session_contrasts = {}
-    session_events = {}
-    session_files = {}
-    # the actual GLM stuff
-
-    masks = []
-    mask_file = None
-    for session in sessions:
-        mask_file = check_niimg(join(subject_data_dir,
-                                     "tfMRI_%s_%s/tfMRI_%s_%s_SBRef.nii.gz" % (
-                                         task, session, task, session)))
-        masks.append(mask_file.get_data() != 0)
-    mask = np.logical_and(masks[0], masks[1])
-    mask = new_img_like(mask_file, mask, copy_header=False)
+    # Both directions share the same mask
+    mask_img, mask = _subject_mask(subject_data_dir, task, sessions)
+
+    # Images are compressed and written in the background, while the next
+    # direction is fitted
+    with ImageWriter(n_jobs=n_writers, compresslevel=compresslevel) as writer:
+        # Masked effects, variances and dofs of each direction
+        session_stats = {}
+        for session in sessions:
+            fmri_file, design, contrasts = _read_run(subject_data_dir, task,
+                                                     session, design_cache,
+                                                     verbose=verbose)
+            if memory_budget is None:
+                level1_model = FirstLevelModel(mask=mask_img,
+                                               smoothing_fwhm=SMOOTHING_FWHM,
+                                               standardize=True,
+                                               memory=memory,
+                                               signal_scaling=False,
+                                               period_cut=PERIOD_CUT,
+                                               t_r=T_R,
+                                               hrf_model=HRF_MODEL,
+                                               drift_model=DRIFT_MODEL,
+                                               drift_order=DRIFT_ORDER,
+                                               subject_label=session,
+                                               verbose=verbose-1)
+                level1_model.fit(fmri_file, design_matrices=[design])
+                labels, results = (level1_model.labels_[0],
+                                   level1_model.results_[0])
+            else:
+                labels, results = fit_run_chunked(
+                    fmri_file, design, mask, smoothing_fwhm=SMOOTHING_FWHM,
+                    memory_budget=memory_budget, tmp_dir=output_dir,
+                    verbose=verbose-1)
+            if verbose > 0:
+                print("\tComputing %i contrasts" % len(contrasts))
+            stats = compute_contrasts_batch(labels, results, contrasts)
+            _save_run(writer, output_dir, session, mask_img, mask, stats,
+                      contrasts, packed=packed, verbose=verbose)
+            # Level-1 z maps are not needed for level 2
+            session_stats[session] = (None,) + stats[1:]
+            del stats
+        _save_level2(writer, output_dir, sessions, mask_img, mask,
+                     session_stats, contrasts, packed=packed, verbose=verbose)
+    if verbose > 0:
+        print("Done (subject %s)" % subject)
 
-    for session in sessions:
-        fmri_file = os.path.join(subject_data_dir,
-                                 "tfMRI_%s_%s/tfMRI_%s_%s.nii.gz" % (
-                                     task, session, task, session))
-        session_files[session] = fmri_file
-        design_file = os.path.join(subject_data_dir,
-                                   "tfMRI_%s_%s/tfMRI_%s_%s_hp200_s4_level1.fsf"
-                                   % (task, session, task, session))
-        # read the experimental setup
-        if verbose > 0:
-            print("Reading experimental setup from %s ..." % design_file)
-        trial_types, timing_files, contrasts = read_fsl_design_file(
-            design_file)
 
-        # fix timing filenames as we load the fsl file one directory
-        # higher than expected
-        timing_files = [tf.replace("EVs", "tfMRI_%s_%s/EVs" % (
-            task, session)) for tf in timing_files]
+def fit_runs_batch(fmri_files, design, masks, contrasts, smoothing_fwhm=None,
+                   memory_budget=MEMORY_BUDGET, tmp_dir=None, verbose=0):
+    """Fit the AR(1) GLM of several runs sharing a design matrix at once.
 
-        # make design matrix
+    Runs are masked into temporary memmaps as in `fit_run_chunked`, and
+    fitted as a single (n_scans, sum of n_voxels) problem: pseudo-inverses
+    of the (whitened) design and contrast covariances are computed once,
+    and each block of voxels, spanning several runs, is solved with a
+    single matrix product. memory_budget bounds the temporaries of the
+    blocks; the per-voxel outputs grow with the number of runs.
+
+    Parameters
+    ----------
+    fmri_files: list of str
+
+    design: pandas.DataFrame or array of shape (n_scans, n_regressors)
+
+    masks: list of boolean arrays or Nifti images, mask of each run
+
+    contrasts: list of (name, array of shape (n_regressors,))
+
+    Returns
+    -------
+    stats: list of (z_score, effect, variance, dof) of each run, as
+        returned by `compute_contrasts_batch`
+    """
+    data = []
+    tmp_files = []
+    try:
+        for fmri_file, mask_img in zip(fmri_files, masks):
+            fd, tmp = tempfile.mkstemp(suffix='.npy', dir=tmp_dir)
+            os.close(fd)
+            tmp_files.append(tmp)
+            data.append(_mask_run(fmri_file, mask_img, tmp,
+                                  smoothing_fwhm=smoothing_fwhm,
+                                  verbose=verbose))
+        chunk_size = chunk_size_from_budget(data[0].shape[0], memory_budget)
         if verbose > 0:
-            print("Constructing design matrix for direction %s ..." % session)
-        events = make_paradigm_from_timing_files(timing_files,
-                                                 trial_types=trial_types)
-        session_events[session] = events
-        # convert contrasts to dict
-        level1_model = FirstLevelModel(mask=mask,
-                                       smoothing_fwhm=4,
-                                       standardize=True,
-                                       memory=memory,
-                                       signal_scaling=False,
-                                       period_cut=0,
-                                       t_r=.72,
-                                       hrf_model=hrf_model,
-                                       drift_model=drift_model,
-                                       drift_order=drift_order,
-                                       subject_label=session,
-                                       verbose=verbose-1)
-        level1_model.fit(fmri_file, events)
-        session_models[session] = level1_model
-
-        # Pad contrast with 1, for subject id
-        for i, (contrast_name, contrast_val) in enumerate(contrasts):
-            size_contrast = contrast_val.shape[0]
-            new_contrast_val = np.zeros(level1_model.
-                                        design_matrices_[0].shape[1])
-            new_contrast_val[:size_contrast] = contrast_val
-            contrasts[i] = (contrast_name, new_contrast_val)
-
-        session_contrasts[session] = contrasts
-
-    z_maps = {}
-    eff_maps = {}
-    for contrast_name, contrast_val in contrasts:
-        z_maps[contrast_name] = {}
-        eff_maps[contrast_name] = {}
+            print("Fitting GLM of %i runs by blocks of %i voxels ..."
+                  % (len(data), chunk_size))
+        labels, results = fit_ar1(data, np.asarray(design), standardize=True,
+                                  chunk_size=chunk_size)
+        stats = compute_contrasts_batch(labels, results, contrasts)
+        bounds = np.cumsum([0] + [this_data.shape[1] for this_data in data])
+        return [tuple(stat[..., start:stop] for stat in stats)
+                for start, stop in zip(bounds[:-1], bounds[1:])]
+    finally:
+        data = None
+        for tmp in tmp_files:
+            os.remove(tmp)
+
+
+def _output_bytes_per_voxel(n_regressors, n_contrasts):
+    """Bytes of the float64 per-voxel outputs of the GLM of a subject
+    task: parameters and dofs of a run, its contrast effects, variances and
+    z maps, the effects, variances and dofs of both directions kept for
+    level 2, and the level 2 maps."""
+    return 8 * (n_regressors + 2 + 3 * n_contrasts + 2 * (2 * n_contrasts + 1)
+                + 3 * n_contrasts)
+
+
+def run_nistats_glm_batch(subjects, task, design_cache=None, packed=False,
+                          memory_budget=MEMORY_BUDGET, n_writers=2,
+                          compresslevel=None, verbose=0):
+    """Fit first and second level GLMs of a task for several subjects.
+
+    Subjects are processed in batches whose per-voxel outputs fit within
+    memory_budget bytes. Within a batch, subjects whose runs share a design
+    matrix and contrasts are fitted together with `fit_runs_batch`, whose
+    temporaries take up to memory_budget bytes as well. Outputs are the
+    same as with `run_nistats_glm(memory_budget=...)` for each subject.
+
+    The masked runs of a group are held in temporary memmaps, about
+    4 * n_scans * n_voxels bytes per subject, in the glm directory of the
+    first subject of the group. Images are written in the background, see
+    `run_nistats_glm`.
+    """
+    warnings.filterwarnings('ignore', category=VisibleDeprecationWarning)
+
+    subjects = [str(subject) for subject in subjects]
+    data_dir = get_data_dirs()[0]
+    sessions = ['RL', 'LR']
+    subject_data_dirs, output_dirs, mask_imgs, masks = {}, {}, {}, {}
+    for subject in subjects:
+        subject_data_dirs[subject] = join(data_dir, subject, 'MNINonLinear',
+                                          'Results')
+        output_dirs[subject] = join(data_dir, 'glm', subject, task)
+        if not os.path.exists(output_dirs[subject]):
+            os.makedirs(output_dirs[subject])
+        mask_imgs[subject], masks[subject] = _subject_mask(
+            subject_data_dirs[subject], task, sessions)
+
+    # All the runs of a task have about the same design
+    _, design, contrasts = _read_run(subject_data_dirs[subjects[0]], task,
+                                     sessions[0], design_cache)
+    bytes_per_voxel = _output_bytes_per_voxel(design.shape[1], len(contrasts))
+    batches = [[]]
+    batch_bytes = 0
+    for subject in subjects:
+        subject_bytes = bytes_per_voxel * int(masks[subject].sum())
+        if batches[-1] and batch_bytes + subject_bytes > memory_budget:
+            batches.append([])
+            batch_bytes = 0
+        batches[-1].append(subject)
+        batch_bytes += subject_bytes
+
+    with ImageWriter(n_jobs=n_writers, compresslevel=compresslevel) as writer:
+        for batch in batches:
+            if verbose > 0:
+                print("%s: batch of %i subjects" % (task, len(batch)))
+            _fit_subjects_batch(writer, batch, task, sessions,
+                                subject_data_dirs, output_dirs, mask_imgs,
+                                masks, design_cache=design_cache,
+                                packed=packed, memory_budget=memory_budget,
+                                verbose=verbose)
+
+
+def _fit_subjects_batch(writer, subjects, task, sessions, subject_data_dirs,
+                        output_dirs, mask_imgs, masks, design_cache=None,
+                        packed=False, memory_budget=MEMORY_BUDGET,
+                        verbose=0):
+    """Fit and save the GLMs of a batch of `run_nistats_glm_batch`."""
+    session_stats = {subject: {} for subject in subjects}
     for session in sessions:
-        model = session_models[session]
-        contrasts = session_contrasts[session]
-        model_output_dir = join(output_dir, session)
-        if not os.path.exists(model_output_dir):
-            os.makedirs(model_output_dir)
-        # Hack to avoid caching unmask
-        model.masker_.memory = Memory(None)
-        model.masker_.memory_level = 0
-        mask_path = os.path.join(model_output_dir, "mask.nii.gz")
-        if verbose > 0:
-            print("Saving mask image to %s ..." % mask_path)
-        model.masker_.mask_img_.to_filename(mask_path)
-        for contrast_name, contrast_val in contrasts:
+        runs = {}
+        groups = {}
+        for subject in subjects:
+            runs[subject] = _read_run(subject_data_dirs[subject], task,
+                                      session, design_cache, verbose=verbose)
+            _, design, contrasts = runs[subject]
+            key = joblib_hash((design, contrasts))
+            groups.setdefault(key, []).append(subject)
+        for group in groups.values():
+            _, design, contrasts = runs[group[0]]
             if verbose > 0:
-                print("\tContrast: %s" % contrast_name)
-            # save computed mask
-            z_map = model.compute_contrast(
-                contrast_val, output_type='z_score')
-            z_maps[contrast_name][session] = z_map
-            eff_map = model.compute_contrast(
-                contrast_val, output_type='effect_size')
-            eff_maps[contrast_name][session] = eff_map
-            # store stat maps to disk
-            for map_type, out_map in zip(['z', 'effects'], [z_map, eff_map]):
-                map_dir = os.path.join(model_output_dir, '%s_maps' % map_type)
-                if not os.path.exists(map_dir):
-                    os.makedirs(map_dir)
-                map_path = os.path.join(map_dir, '%s_%s.nii.gz' % (map_type,
-                                                                   contrast_name))
-                nibabel.save(out_map, map_path)
-
-    # XXX: we will use SecondLevelModel once it works
-    session = 'level2'
-    contrasts = session_contrasts['RL']
-    mask = join(output_dir, 'RL', 'mask.nii.gz')
-    model_output_dir = join(output_dir, session)
-    if not os.path.exists(model_output_dir):
-        os.makedirs(model_output_dir)
-    # Hack to avoid caching unmask
-    mask_path = os.path.join(model_output_dir, "mask.nii.gz")
-    if verbose > 0:
-        print("Saving mask image to %s ..." % mask_path)
-    shutil.copy(mask, mask_path)
-    for contrast_name, contrast_val in contrasts:
+                print("%s, %s: fitting %i subjects sharing a design"
+                      % (task, session, len(group)))
+            stats = fit_runs_batch(
+                [runs[subject][0] for subject in group], design,
+                [masks[subject] for subject in group], contrasts,
+                smoothing_fwhm=SMOOTHING_FWHM, memory_budget=memory_budget,
+                tmp_dir=output_dirs[group[0]], verbose=verbose-1)
+            for subject, this_stats in zip(group, stats):
+                _save_run(writer, output_dirs[subject], session,
+                          mask_imgs[subject], masks[subject], this_stats,
+                          contrasts, packed=packed, verbose=verbose)
+                session_stats[subject][session] = (None,) + this_stats[1:]
+            del stats
+    for subject in subjects:
+        _, _, contrasts = runs[subject]
+        _save_level2(writer, output_dirs[subject], sessions,
+                     mask_imgs[subject], masks[subject],
+                     session_stats[subject], contrasts, packed=packed,
+                     verbose=verbose)
         if verbose > 0:
-            print("\tContrast: %s" % contrast_name)
-        # save computed mask
-        z_map = new_img_like(z_maps[contrast_name]['LR'],
-                             z_maps[contrast_name]['LR'].get_data()
-                             + z_maps[contrast_name]['RL'].get_data())
-        eff_map = new_img_like(eff_maps[contrast_name]['LR'],
-                               eff_maps[contrast_name]['LR'].get_data()
-                               + eff_maps[contrast_name]['RL'].get_data())
-        # store stat maps to disk
-        for map_type, out_map in zip(['z', 'effects'], [z_map, eff_map]):
-            map_dir = os.path.join(model_output_dir, '%s_maps' % map_type)
-            if not os.path.exists(map_dir):
-                os.makedirs(map_dir)
-            map_path = os.path.join(map_dir, '%s_%s.nii.gz' % (map_type,
-                                                               contrast_name))
-            nibabel.save(out_map, map_path)
-    if verbose > 0:
-        print("Done (subject %s)" % subject)
+            print("Done (subject %s)" % subject)
 
 
-def run_glm(subject, tasks=None, backend='fsl', verbose=0):
-    root_path = get_data_dirs()[0]
+def check_glm_outputs(subject, task, packed=False):
+    """Check that the nistats GLM of a subject task is complete.
+
+    Each direction and the level 2 must hold a mask and the same non-zero
+    number of z and effect maps. Raises a ValueError otherwise, e.g. before
+    the raw runs of the task are deleted.
+    """
+    output_dir = join(get_data_dirs()[0], 'glm', str(subject), task)
+    missing = []
+    n_maps = set()
+    for session in ['LR', 'RL', 'level2']:
+        model_output_dir = join(output_dir, session)
+        mask_path = join(model_output_dir, 'mask.nii.gz')
+        if not os.path.exists(mask_path):
+            missing.append(mask_path)
+        for map_type in ['z', 'effects']:
+            if packed:
+                filename = packed_filename(model_output_dir, map_type)
+                try:
+                    n_maps.add(np.load(filename, mmap_mode='r').shape[0])
+                except (IOError, ValueError):
+                    missing.append(filename)
+            else:
+                map_dir = join(model_output_dir, '%s_maps' % map_type)
+                filenames = glob.glob(join(map_dir,
+                                           '%s_*.nii.gz' % map_type))
+                if filenames:
+                    n_maps.add(len(filenames))
+                else:
+                    missing.append(map_dir)
+    if missing:
+        raise ValueError('Incomplete GLM outputs, missing %s'
+                         % ', '.join(missing))
+    if len(n_maps) != 1:
+        raise ValueError('Inconsistent numbers of maps in %s: %s'
+                         % (output_dir, sorted(n_maps)))
+
+
+def check_fsl_outputs(subject, task):
+    """Check that the FSL GLM of a subject task is complete.
+
+    The level 2 must hold the z map of each contrast of the task, at the
+    paths read by `fetch_hcp_contrasts(output='fsl')`. Raises a ValueError
+    otherwise.
+    """
+    feat_dir = join(get_data_dirs()[0], str(subject), 'MNINonLinear',
+                    'Results', 'tfMRI_%s' % task,
+                    'tfMRI_%s_hp200_s4_level2vol.feat' % task)
+    filenames = [join(feat_dir, 'cope%i.feat' % contrast_idx, 'stats',
+                      'zstat1.nii.gz')
+                 for this_task, contrast_idx, _ in CONTRASTS
+                 if this_task == task]
+    if not filenames:
+        raise ValueError('Unknown task %s' % task)
+    missing = [filename for filename in filenames
+               if not os.path.exists(filename)]
+    if missing:
+        raise ValueError('Incomplete GLM outputs, missing %s'
+                         % ', '.join(missing))
+
+
+def _fsl_commands(root_path, subject, task, level1=False, n_scans=None):
+    """Steps of the FSL GLM of a subject task, see
+    `hcp_builder.utils.fsl.run_commands`.
+
+    The fsf files are rendered from the cached templates (as prepare.sh
+    does), then the level 2 combines the level 1 analyses of both
+    directions. As in TaskfMRIAnalysis.v2.0.sh, these are expected to exist,
+    unless level1 is True: they are then run first, concurrently. Arguments
+    are those of compute_stats.sh.
+
+    n_scans maps each direction to the number of volumes of its run. It
+    defaults to the run lengths of the HCP protocol, so that no header is
+    read.
+    """
     pathname = inspect.getfile(inspect.currentframe())
     script_dir = join(dirname(dirname(pathname)), 'hcp_scripts')
-    subject = str(subject)
+    analysis_dir = join(script_dir, 'HCP-pipeline-scripts',
+                        'TaskfMRIAnalysis', 'scripts')
+    results_dir = join(root_path, subject, 'MNINonLinear', 'Results')
+    level1_names = ['tfMRI_%s_%s' % (task, direction)
+                    for direction in ['RL', 'LR']]
+    level2_name = 'tfMRI_%s' % task
+    level1_script = join(analysis_dir, 'TaskfMRILevel1.v2.0.sh')
+    level1_cmds = tuple(['bash', level1_script, subject, results_dir, name,
+                         name, FSL_ORIGINAL_SMOOTHING_FWHM, 'NONE',
+                         FSL_FINAL_SMOOTHING_FWHM, FSL_TEMPORAL_FILTER,
+                         'NONE']
+                        for name in level1_names)
+    level2 = ['bash', join(analysis_dir, 'TaskfMRILevel2.v2.0.sh'),
+              subject, results_dir, '@'.join(level1_names),
+              '@'.join(level1_names), level2_name, level2_name,
+              FSL_FINAL_SMOOTHING_FWHM, FSL_TEMPORAL_FILTER, 'NONE']
+    if n_scans is None:
+        n_scans = {direction: template_n_scans(task, direction)
+                   for direction in ['RL', 'LR']}
+    prepare = partial(write_fsf_files, root_path, subject, task,
+                      n_scans=n_scans)
+    if level1:
+        return [prepare, level1_cmds, level2]
+    return [prepare, level2]
+
+
+def run_glm(subject, tasks=None, backend='fsl', design_cache=None,
+            packed=False, memory_budget=None, compresslevel=None,
+            level1=False, verbose=0):
+    """Fit the GLMs of the tasks of a subject, or of a list of subjects.
+
+    With backend='nistats' and several subjects, each task is fitted for
+    batches of subjects with `run_nistats_glm_batch`, sized so that their
+    outputs fit within memory_budget (MEMORY_BUDGET if None). With
+    backend='fsl', the level 1 analyses are only run if level1 is True.
+    """
+    root_path = get_data_dirs()[0]
+    if hasattr(subject, '__iter__') and not isinstance(subject, str):
+        subjects = [str(this_subject) for this_subject in subject]
+    else:
+        subjects = [str(subject)]
     if tasks is None:
         tasks = ['EMOTION', 'WM', 'MOTOR', 'RELATIONAL',
                  'GAMBLING', 'SOCIAL', 'LANGUAGE']
     elif isinstance(tasks, str):
         tasks = [tasks]
     if backend == 'fsl':
-        configure()
-        prepare_script = join(script_dir, 'prepare.sh')
-        compute_script = join(script_dir, 'compute_stats.sh')
-        for task in tasks:
-            if verbose > 0:
-                print('%s, %s: Preparing fsl files' % (subject, task))
-            run_cmd(['bash', prepare_script, root_path, subject, task],
-                    verbose=verbose-1)
-            if verbose > 0:
-                print('%s, %s: Learning the GLM with FSL' % (subject, task))
-            run_cmd(['bash', compute_script, root_path, subject,
-                     task],
-                    verbose=verbose-1)
+        env = fsl_environment()
+        for subject in subjects:
+            for task in tasks:
+                if verbose > 0:
+                    print('%s, %s: Learning the GLM with FSL'
+                          % (subject, task))
+                log_file = join(root_path, 'fsl_logs',
+                                '%s_%s.log' % (subject, task))
+                result = run_commands(_fsl_commands(root_path, subject,
+                                                    task, level1=level1),
+                                      log_file, env=env)
+                if verbose > 0:
+                    print('%s, %s: exit code %i in %.0fs, see %s'
+                          % (subject, task, result.returncode,
+                             result.wall_time, log_file))
+                if result.returncode != 0:
+                    raise CalledProcessError(result.returncode, result.cmd,
+                                             output=log_file)
     elif backend == 'nistats':
         for task in tasks:
+            if len(subjects) > 1:
+                if verbose > 0:
+                    print('%s: Learning the GLM of %i subjects with nistats'
+                          % (task, len(subjects)))
+                run_nistats_glm_batch(
+                    subjects, task, design_cache=design_cache, packed=packed,
+                    memory_budget=(MEMORY_BUDGET if memory_budget is None
+                                   else memory_budget),
+                    compresslevel=compresslevel, verbose=verbose-1)
+                continue
+            subject = subjects[0]
             if verbose > 0:
                 print('%s, %s: Learning the GLM with nistats' % (subject, task))
-            run_nistats_glm(subject, task, verbose=verbose-1)
+            run_nistats_glm(subject, task, design_cache=design_cache,
+                            packed=packed, memory_budget=memory_budget,
+                            compresslevel=compresslevel, verbose=verbose-1)
     else:
         raise ValueError('Wrong backend')
+
+
+def run_fsl_glm_batch(subjects, tasks=None, n_jobs=None, log_dir=None,
+                      level1=False, verbose=0):
+    """Run the FSL GLMs of subjects x tasks, n_jobs at once.
+
+    Each subject task writes its fsf files, then runs the level 2, preceded
+    by the level 1 of both directions if level1 is True. Their output is
+    written to log_dir/SUBJECT_TASK.log (by default in the fsl_logs folder
+    of the data directory). Failures do not stop the other jobs.
+    During the level 1, a job runs two processes: n_jobs should be about
+    half the number of idle CPUs.
+
+    Returns
+    -------
+    results: pandas.DataFrame indexed by subject and task, with the exit
+        code, wall time, maximum RSS (kB), log file and last command of each
+        job (see `hcp_builder.utils.fsl.run_commands`)
+    """
+    root_path = get_data_dirs()[0]
+    if log_dir is None:
+        log_dir = join(root_path, 'fsl_logs')
+    if tasks is None:
+        tasks = ['EMOTION', 'WM', 'MOTOR', 'RELATIONAL',
+                 'GAMBLING', 'SOCIAL', 'LANGUAGE']
+    elif isinstance(tasks, str):
+        tasks = [tasks]
+    keys, jobs = [], []
+    for subject in subjects:
+        subject = str(subject)
+        for task in tasks:
+            jobs.append((_fsl_commands(root_path, subject, task,
+                                       level1=level1),
+                         join(log_dir, '%s_%s.log' % (subject, task))))
+            keys.append((subject, task))
+    results = run_jobs(jobs, n_jobs=n_jobs, env=fsl_environment(),
+                       verbose=verbose)
+    return pd.DataFrame(results, columns=JobResult._fields,
+                        index=pd.MultiIndex.from_tuples(
+                            keys, names=['subject', 'task']))
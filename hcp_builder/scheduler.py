@@ -0,0 +1,508 @@
+"""
+Resumable scheduling of the download and GLM jobs of the cohort.
+"""
+import glob
+import os
+import shutil
+import sqlite3
+import time
+import traceback
+import warnings
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    wait, FIRST_COMPLETED
+
+import pandas as pd
+
+from .dataset import download_experiment, fetch_hcp_timeseries, \
+    get_data_dirs
+from .glm import run_glm, check_glm_outputs, check_fsl_outputs, \
+    MEMORY_BUDGET
+from .utils.timeseries import cache_filename
+
+# Job statuses
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+# Failed jobs whose data was removed by Scheduler.release
+RELEASED = 'released'
+
+# Pseudo task of resting-state downloads
+REST = 'REST'
+
+
+def download_stage(subject, task, data_dir=None, overwrite=False, verbose=0):
+    """Download the runs of a subject task, or of its resting-state if task
+    is REST. Raises the first transfer error, so that the job is retried,
+    and FileNotFoundError if the subject is not on S3."""
+    if task == REST:
+        failures = download_experiment(subject, data_dir=data_dir,
+                                       data_type='rest', overwrite=overwrite,
+                                       verbose=verbose)
+    else:
+        failures = download_experiment(subject, data_dir=data_dir,
+                                       data_type='task', tasks=task,
+                                       overwrite=overwrite, verbose=verbose)
+    for _, _, error in failures or []:
+        if isinstance(error, ConnectionError):
+            raise error
+
+
+def glm_stage(subject, task, backend='nistats', packed=False,
+              memory_budget=None, verbose=0):
+    """Fit the GLM of a subject task, see `hcp_builder.glm.run_glm`.
+    Resting-state jobs have nothing to fit."""
+    if task == REST:
+        return
+    run_glm(subject, task, backend=backend, packed=packed,
+            memory_budget=memory_budget, verbose=verbose)
+
+
+def evict_stage(subject, task, data_dir=None, cold_dir=None,
+                backend='nistats', packed=False, check=True, verbose=0):
+    """Remove the raw runs of a subject task once its GLM outputs are
+    verified, along with their masked caches. Resting-state runs, which
+    have no GLM, are removed as is.
+
+    If cold_dir is provided, files are moved there, under their path
+    relative to the data directory, instead of being deleted. check=False
+    skips the verification, e.g. to release the data of failed jobs.
+    """
+    if check and task != REST:
+        if backend == 'fsl':
+            check_fsl_outputs(subject, task)
+        else:
+            check_glm_outputs(subject, task, packed=packed)
+    data_dir = get_data_dirs(data_dir)[0]
+    if task == REST:
+        runs = fetch_hcp_timeseries(data_dir, subjects=subject,
+                                    data_type='rest', on_disk=False)
+    else:
+        runs = fetch_hcp_timeseries(data_dir, subjects=subject,
+                                    data_type='task', tasks=task,
+                                    on_disk=False)
+    for filename in runs['filename']:
+        # Masked caches of any mask, and their sidecars
+        caches = glob.glob(cache_filename(filename, '*') + '*')
+        for path in [filename] + caches:
+            if not os.path.exists(path):
+                continue
+            if cold_dir is None:
+                if verbose > 0:
+                    print('Delete %s' % path)
+                os.unlink(path)
+            else:
+                target = os.path.join(cold_dir,
+                                      os.path.relpath(path, data_dir))
+                if verbose > 0:
+                    print('Move %s to %s' % (path, target))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.move(path, target)
+
+
+class Stage(object):
+    """Step of the jobs, run by its own pool of workers.
+
+    Parameters
+    ----------
+    name: str,
+
+    func: callable,
+        Called as func(subject, task). It must be picklable if processes is
+        True, e.g. a module-level function or a functools.partial of one.
+
+    n_jobs: int,
+        Number of workers of the stage.
+
+    processes: bool,
+        Use a pool of processes, for CPU-bound stages, instead of threads.
+    """
+    def __init__(self, name, func, n_jobs=1, processes=False):
+        self.name = name
+        self.func = func
+        self.n_jobs = n_jobs
+        self.processes = processes
+
+
+def default_stages(n_download_jobs=4, n_glm_jobs=4, data_dir=None,
+                   backend='nistats', packed=False,
+                   memory_budget=MEMORY_BUDGET, evict=False, cold_dir=None):
+    """Network-bound downloads on threads, CPU-bound GLM on processes.
+
+    With the nistats backend, each GLM process fits runs within
+    memory_budget bytes, see `hcp_builder.glm.run_nistats_glm`. If evict is
+    True, an 'evict' stage removes the raw runs of each task once its GLM
+    outputs are verified, or moves them to cold_dir.
+    """
+    stages = [Stage('download', partial(download_stage, data_dir=data_dir),
+                    n_jobs=n_download_jobs),
+              Stage('glm', partial(glm_stage, backend=backend, packed=packed,
+                                   memory_budget=memory_budget),
+                    n_jobs=n_glm_jobs, processes=True)]
+    if evict:
+        stages.append(Stage('evict', partial(evict_stage, data_dir=data_dir,
+                                             cold_dir=cold_dir,
+                                             backend=backend,
+                                             packed=packed)))
+    return stages
+
+
+class JobStore(object):
+    """Status of (subject, task, stage) jobs, stored in a SQLite database.
+
+    Parameters
+    ----------
+    filename: str,
+        Path of the SQLite database. It is created if needed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._con = sqlite3.connect(filename, timeout=60)
+        with self._con:
+            self._con.execute('CREATE TABLE IF NOT EXISTS jobs '
+                              '(subject INTEGER, task TEXT, stage TEXT, '
+                              'rank INTEGER, status TEXT, '
+                              'attempts INTEGER, next_try REAL, '
+                              'error TEXT, updated REAL, '
+                              'PRIMARY KEY (subject, task, stage))')
+
+    def add(self, subject, task, stages):
+        """Register the jobs of a subject task, keeping known ones as is."""
+        rows = [(subject, task, stage, rank, PENDING, 0, 0., None,
+                 time.time()) for rank, stage in enumerate(stages)]
+        with self._con:
+            self._con.executemany('INSERT OR IGNORE INTO jobs '
+                                  'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def set(self, subject, task, stage, status, error=None, next_try=0.,
+            attempt=False):
+        with self._con:
+            self._con.execute('UPDATE jobs SET status=?, error=?, '
+                              'next_try=?, updated=?, '
+                              'attempts=attempts + ? '
+                              'WHERE subject=? AND task=? AND stage=?',
+                              (status, error, next_try, time.time(),
+                               int(attempt), subject, task, stage))
+
+    def attempts(self, subject, task, stage):
+        return self._con.execute('SELECT attempts FROM jobs WHERE subject=? '
+                                 'AND task=? AND stage=?',
+                                 (subject, task, stage)).fetchone()[0]
+
+    _READY = ('FROM jobs AS j WHERE status=? '
+              'AND NOT EXISTS (SELECT 1 FROM jobs AS p '
+              'WHERE p.subject=j.subject AND p.task=j.task '
+              'AND p.rank < j.rank AND p.status != ?)')
+
+    def ready(self, stage, now, limit):
+        """Pending jobs of stage whose previous stages are done and whose
+        backoff delay has elapsed."""
+        return self._con.execute(
+            'SELECT subject, task ' + self._READY +
+            ' AND stage=? AND next_try <= ? ORDER BY subject, task LIMIT ?',
+            (PENDING, DONE, stage, now, limit)).fetchall()
+
+    def next_try(self, now):
+        """Earliest retry time after now of the jobs whose previous stages
+        are done, or None."""
+        return self._con.execute(
+            'SELECT MIN(next_try) ' + self._READY + ' AND next_try > ?',
+            (PENDING, DONE, now)).fetchone()[0]
+
+    def fail_next(self, subject, task, stage):
+        """Mark the stages following a failed one as failed, so that they
+        are not waited for."""
+        with self._con:
+            self._con.execute('UPDATE jobs SET status=?, error=?, updated=? '
+                              'WHERE subject=? AND task=? AND rank > '
+                              '(SELECT rank FROM jobs WHERE subject=? '
+                              'AND task=? AND stage=?)',
+                              (FAILED, 'Stage %s failed' % stage,
+                               time.time(), subject, task, subject, task,
+                               stage))
+
+    def reset(self, status=RUNNING, stage=None):
+        """Set jobs back to pending, e.g. those interrupted by a crash.
+
+        Failed jobs are given a new set of attempts. If stage is provided,
+        only its jobs are reset, along with the failed stages that follow
+        them."""
+        query = 'UPDATE jobs SET status=?, next_try=0'
+        if status == FAILED:
+            query += ', attempts=0'
+        query += ' WHERE status=?'
+        if stage is None:
+            with self._con:
+                self._con.execute(query, (PENDING, status))
+            return
+        keys = self._con.execute('SELECT subject, task, rank FROM jobs '
+                                 'WHERE status=? AND stage=?',
+                                 (status, stage)).fetchall()
+        with self._con:
+            self._con.executemany(query + ' AND subject=? AND task=? '
+                                  'AND rank >= ?',
+                                  [(PENDING, status) + key for key in keys])
+
+    def open_subjects(self, stages):
+        """Subjects with started jobs that still have pending or running
+        jobs of the given stages, or failed ones."""
+        marks = ', '.join('?' * len(stages))
+        rows = self._con.execute(
+            'SELECT DISTINCT subject FROM jobs AS j '
+            'WHERE status IN (?, ?, ?) AND stage IN (%s) '
+            'AND EXISTS (SELECT 1 FROM jobs AS s WHERE s.subject=j.subject '
+            'AND (s.status != ? OR s.attempts > 0))' % marks,
+            [PENDING, RUNNING, FAILED] + list(stages) + [PENDING]).fetchall()
+        return set(row[0] for row in rows)
+
+    def failed(self, subjects=None):
+        """(subject, task) of the failed jobs, of some subjects or of all
+        of them."""
+        rows = self._con.execute('SELECT DISTINCT subject, task FROM jobs '
+                                 'WHERE status=? ORDER BY subject, task',
+                                 (FAILED,)).fetchall()
+        if subjects is not None:
+            subjects = set(subjects)
+            rows = [row for row in rows if row[0] in subjects]
+        return rows
+
+    def release(self, subject, task):
+        """Mark the failed jobs of a subject task as released."""
+        with self._con:
+            self._con.execute('UPDATE jobs SET status=?, updated=? '
+                              'WHERE subject=? AND task=? AND status=?',
+                              (RELEASED, time.time(), subject, task, FAILED))
+
+    def restart_released(self, stage=None):
+        """Set all the jobs of the subject tasks with released jobs, of
+        stage if provided, back to pending with a new set of attempts."""
+        query = 'SELECT DISTINCT subject, task FROM jobs WHERE status=?'
+        params = (RELEASED,)
+        if stage is not None:
+            query += ' AND stage=?'
+            params += (stage,)
+        keys = self._con.execute(query, params).fetchall()
+        with self._con:
+            self._con.executemany('UPDATE jobs SET status=?, attempts=0, '
+                                  'next_try=0, updated=? '
+                                  'WHERE subject=? AND task=?',
+                                  [(PENDING, time.time()) + key
+                                   for key in keys])
+
+    def count(self, status):
+        return self._con.execute('SELECT COUNT(*) FROM jobs WHERE status=?',
+                                 (status,)).fetchone()[0]
+
+    def status(self):
+        """pandas.DataFrame of the jobs."""
+        return pd.read_sql('SELECT * FROM jobs ORDER BY subject, task, rank',
+                           self._con).set_index(['subject', 'task', 'stage'])
+
+    def close(self):
+        self._con.close()
+
+
+class Scheduler(object):
+    """Run the stages of (subject, task) jobs with resumable state.
+
+    Each stage has its own pool of workers, so that downloads of the next
+    subjects overlap with the GLM fits of the current ones. Job states are
+    kept in a JobStore: completed jobs are skipped when the scheduler is
+    run again, and failed jobs are retried with an exponential backoff, up
+    to max_attempts times.
+
+    Parameters
+    ----------
+    filename: str or None,
+        SQLite job database. Defaults to `jobs.db` in the data directory.
+
+    stages: list of Stage or None,
+        Defaults to `default_stages()`.
+
+    max_attempts: int,
+        Number of attempts of a job before it is marked as failed.
+
+    backoff: float,
+        Delay before the first retry of a job, in seconds. It doubles with
+        each attempt.
+
+    max_subjects: int or None,
+        Maximum number of subjects being processed at once. The first stage
+        of a new subject only starts when fewer subjects have unfinished
+        jobs. With an evict last stage (see `default_stages`), this bounds
+        the number of subjects whose raw data is on disk, while the
+        downloads of the next subjects still overlap with the GLM fits.
+        As the data of failed jobs is not evicted, their subject stays
+        counted until the jobs are retried with `reset_failed`, or their
+        data removed with `release`. Once max_subjects subjects have failed
+        jobs, `run` returns with the jobs of the other subjects pending.
+    """
+    def __init__(self, filename=None, stages=None, max_attempts=3,
+                 backoff=60., max_subjects=None, verbose=0):
+        if filename is None:
+            filename = os.path.join(get_data_dirs()[0], 'jobs.db')
+        if stages is None:
+            stages = default_stages()
+        self.store = JobStore(filename)
+        self.stages = stages
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_subjects = max_subjects
+        self.verbose = verbose
+
+    def add(self, subjects, tasks, stages=None):
+        """Register the jobs of subjects x tasks, on all stages by default."""
+        if stages is None:
+            stages = [stage.name for stage in self.stages]
+        if isinstance(tasks, str):
+            tasks = [tasks]
+        if not hasattr(subjects, '__iter__'):
+            subjects = [subjects]
+        for subject in subjects:
+            for task in tasks:
+                self.store.add(subject, task, stages)
+
+    def _finish(self, future, job):
+        subject, task, stage = job
+        error = future.exception()
+        if error is None:
+            self.store.set(subject, task, stage, DONE, attempt=True)
+            if self.verbose > 0:
+                print('%s, %s: %s done' % (subject, task, stage))
+            return
+        msg = ''.join(traceback.format_exception(type(error), error,
+                                                 error.__traceback__))
+        attempts = self.store.attempts(subject, task, stage) + 1
+        if attempts >= self.max_attempts:
+            self.store.set(subject, task, stage, FAILED, error=msg,
+                           attempt=True)
+            self.store.fail_next(subject, task, stage)
+        else:
+            next_try = time.time() + self.backoff * 2 ** (attempts - 1)
+            self.store.set(subject, task, stage, PENDING, error=msg,
+                           next_try=next_try, attempt=True)
+        if self.verbose > 0:
+            print('%s, %s: %s failed (attempt %i)\n%s'
+                  % (subject, task, stage, attempts, msg))
+
+    def _submit(self, executors, running):
+        now = time.time()
+        for i, stage in enumerate(self.stages):
+            in_flight = sum(job[2] == stage.name for job in running.values())
+            free = stage.n_jobs - in_flight
+            if free <= 0:
+                continue
+            if i == 0 and self.max_subjects is not None:
+                jobs = self._admit(free)
+            else:
+                jobs = self.store.ready(stage.name, now, free)
+            for subject, task in jobs:
+                self.store.set(subject, task, stage.name, RUNNING)
+                future = executors[stage.name].submit(stage.func, subject,
+                                                      task)
+                running[future] = (subject, task, stage.name)
+
+    def _admit(self, n_jobs):
+        """Ready jobs of the first stage, of open subjects or of new ones
+        while there are less than max_subjects open."""
+        subjects = self.store.open_subjects([stage.name
+                                             for stage in self.stages])
+        jobs = []
+        for subject, task in self.store.ready(self.stages[0].name,
+                                              time.time(), -1):
+            if (subject not in subjects
+                    and len(subjects) >= self.max_subjects):
+                continue
+            subjects.add(subject)
+            jobs.append((subject, task))
+            if len(jobs) == n_jobs:
+                break
+        return jobs
+
+    def run(self):
+        """Run the registered jobs until all of them are done or failed,
+        or until the remaining ones are blocked by subjects with failed jobs
+        holding all the max_subjects slots. A warning is then issued: call
+        `release` to free the slots, and run again.
+
+        Returns
+        -------
+        status: pandas.DataFrame of the jobs
+        """
+        # Jobs left running by an interrupted run
+        self.store.reset(RUNNING)
+        executors = {}
+        for stage in self.stages:
+            pool = ProcessPoolExecutor if stage.processes \
+                else ThreadPoolExecutor
+            executors[stage.name] = pool(max_workers=stage.n_jobs)
+        running = {}
+        try:
+            while True:
+                self._submit(executors, running)
+                next_try = self.store.next_try(time.time())
+                if not running:
+                    if next_try is None:
+                        break
+                    time.sleep(max(0., next_try - time.time()))
+                    continue
+                timeout = None if next_try is None \
+                    else max(0., next_try - time.time())
+                done, _ = wait(list(running), timeout=timeout,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._finish(future, running.pop(future))
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+            for future, job in running.items():
+                self._finish(future, job)
+        n_blocked = self.store.count(PENDING)
+        if n_blocked:
+            warnings.warn('%i jobs are blocked by the failed jobs of %i '
+                          'subjects, which keep their data: release them '
+                          'with Scheduler.release, or retry them with '
+                          'Scheduler.reset_failed.'
+                          % (n_blocked, len(self.store.failed())))
+        return self.store.status()
+
+    def status(self):
+        """pandas.DataFrame of the jobs."""
+        return self.store.status()
+
+    def reset_failed(self, stage=None):
+        """Give failed jobs, of all stages by default, a new set of
+        attempts. Released subject tasks, whose data was removed, start
+        over from the first stage."""
+        self.store.reset(FAILED, stage=stage)
+        self.store.restart_released(stage=stage)
+
+    def release(self, subjects=None, cleanup=None):
+        """Free the max_subjects slots of subjects with failed jobs.
+
+        cleanup(subject, task) is called on each failed subject task to
+        remove its data, e.g. `partial(evict_stage, check=False)` or
+        `hcp_builder.utils.fsl.clean_artifacts`. The failed jobs are then
+        marked as released: they no longer count against max_subjects, and
+        are not run again unless `reset_failed` is called.
+
+        Parameters
+        ----------
+        subjects: list of int or None,
+            Subjects to release, all those with failed jobs by default.
+
+        Returns
+        -------
+        released: list of (subject, task)
+        """
+        if subjects is not None and not hasattr(subjects, '__iter__'):
+            subjects = [subjects]
+        released = self.store.failed(subjects)
+        for subject, task in released:
+            if cleanup is not None:
+                cleanup(subject, task)
+            self.store.release(subject, task)
+            if self.verbose > 0:
+                print('%s, %s: released' % (subject, task))
+        return released
@@ -0,0 +1,27 @@
+from hcp_builder.utils.cache import LRUCache
+
+
+def test_lru_cache(tmpdir):
+    calls = []
+
+    def compute(value):
+        def _compute():
+            calls.append(value)
+            return value
+        return _compute
+
+    cache = LRUCache(max_size=2)
+    assert cache.get('a', compute(1)) == 1
+    assert cache.get('b', compute(2)) == 2
+    assert cache.get('a', compute(1)) == 1
+    # 'b' is the least recently used and gets evicted
+    assert cache.get('c', compute(3)) == 3
+    assert cache.get('a', compute(1)) == 1
+    assert cache.get('b', compute(2)) == 2
+    assert calls == [1, 2, 3, 2]
+
+    cache = LRUCache(max_size=1, cache_dir=str(tmpdir))
+    cache.get('a', compute(1))
+    other = LRUCache(max_size=1, cache_dir=str(tmpdir))
+    assert other.get('a', compute(1)) == 1
+    assert calls == [1, 2, 3, 2, 1]
@@ -1,5 +1,12 @@
+import os
+from os.path import join
+
+import pandas as pd
+
+from hcp_builder import dataset
 from hcp_builder.dataset import fetch_behavioral_data, fetch_subject_list, \
-    fetch_hcp, _convert_to_s3_target, fetch_hcp_timeseries
+    fetch_hcp, _convert_to_s3_target, fetch_hcp_timeseries, \
+    _timeseries_frame, _contrasts_frame, dump_hcp_snapshot, CONTRASTS, EVS
 
 
 # def test_fetch_behavioral_data():
@@ -29,6 +36,123 @@ from hcp_builder.dataset import fetch_behavioral_data, fetch_subject_list, \
 #     # res = fetch_hcp_timeseries(on_disk=False, data_type='rest')
 
 
+def test_fetch_behavioral_data_cache(tmpdir, monkeypatch):
+    data_dir = str(tmpdir)
+    os.makedirs(join(data_dir, 'behavioral'))
+    unrestricted = join(data_dir, 'behavioral', 'hcp_unrestricted_data.csv')
+    restricted = join(data_dir, 'behavioral', 'hcp_restricted_data.csv')
+    with open(unrestricted, 'w') as f:
+        f.write('Subject,Gender,Age_in_Yrs\n100307,F,26\n100206,M,27\n')
+    with open(restricted, 'w') as f:
+        f.write('Subject,Handedness\n100206,R\n100307,L\n')
+    df = fetch_behavioral_data(data_dir=data_dir, restricted=True)
+    assert df.index.tolist() == [100206, 100307]
+    assert str(df['Gender'].dtype) == 'category'
+    assert str(df['Handedness'].dtype) == 'category'
+    assert df['Age_in_Yrs'].dtype.kind == 'i'
+    df.loc[100206, 'Age_in_Yrs'] = 0
+
+    # Memoized joined frame, unaffected by changes of the returned copy
+    def fail(csv_file):
+        raise AssertionError('csv read again')
+    monkeypatch.setattr(dataset, '_read_behavioral_csv', fail)
+    df = fetch_behavioral_data(data_dir=data_dir, restricted=True)
+    assert df.loc[100206, 'Age_in_Yrs'] == 27
+    monkeypatch.undo()
+
+    # Invalidated when a csv changes
+    with open(restricted, 'w') as f:
+        f.write('Subject,Handedness\n100206,L\n100307,L\n')
+    mtime = os.stat(restricted).st_mtime_ns + 10 ** 9
+    os.utime(restricted, ns=(mtime, mtime))
+    df = fetch_behavioral_data(data_dir=data_dir, restricted=True)
+    assert df.loc[100206, 'Handedness'] == 'L'
+    df = fetch_behavioral_data(data_dir=data_dir)
+    assert 'Handedness' not in df.columns
+
+
+def test_timeseries_frame():
+    res = _timeseries_frame('/HCP', [100206, 100307], 'task',
+                            ['EMOTION', 'WM'])
+    assert res.shape[0] == 8
+    assert res.index.names == ['subject', 'task', 'direction']
+    root_dir = join('/HCP', '100307', 'MNINonLinear', 'Results',
+                    'tfMRI_EMOTION_RL')
+    row = res.loc[(100307, 'EMOTION', 'RL')]
+    assert row['filename'] == join(root_dir, 'tfMRI_EMOTION_RL.nii.gz')
+    assert row['mask'] == join(root_dir, 'tfMRI_EMOTION_RL_SBRef.nii.gz')
+    evs = row.filter(like='ev_').dropna().tolist()
+    assert evs == [join(root_dir, 'EVs', ev) for ev in sorted(EVS['EMOTION'])]
+    n_evs = len(EVS['WM'])
+    assert res.loc[(100307, 'WM', 'LR'), 'ev_%i' % (n_evs - 1)].endswith(
+        sorted(EVS['WM'])[-1])
+
+    res = _timeseries_frame('/HCP', [100206], 'rest', [1, 2])
+    assert res.loc[(100206, 2, 'LR'), 'filename'] == join(
+        '/HCP', '100206', 'MNINonLinear', 'Results', 'rfMRI_REST2_LR',
+        'rfMRI_REST2_LR.nii.gz')
+
+
+def test_contrasts_frame():
+    res = _contrasts_frame('/HCP', [100206, 100307], 'nistats',
+                           ['LR', 'RL'])
+    assert res.shape[0] == 2 * len(CONTRASTS) * 2
+    assert res.loc[(100206, 'MOTOR', 'LH', 'RL'), 'z_map'] == join(
+        '/HCP', 'glm', '100206', 'MOTOR', 'RL', 'z_maps', 'z_LH.nii.gz')
+    res = _contrasts_frame('/HCP', [100206], 'nistats', ['level2'],
+                           packed=True)
+    assert res.loc[(100206, 'MOTOR', 'LH', 'level2'), 'z_map'] == join(
+        '/HCP', 'glm', '100206', 'MOTOR', 'level2', 'z_maps.npy')
+    res = _contrasts_frame('/HCP', [100206], 'fsl', ['level2'])
+    assert res.loc[(100206, 'MOTOR', 'LH', 'level2'), 'z_map'] == join(
+        '/HCP', '100206', 'MNINonLinear', 'Results', 'tfMRI_MOTOR',
+        'tfMRI_MOTOR_hp200_s4_level2vol.feat', 'cope3.feat', 'stats',
+        'zstat1.nii.gz')
+
+
 def test_fetch_hcp():
     res = fetch_hcp(on_disk=True)
-    print(res)
\ No newline at end of file
+    print(res)
+
+
+def _touch(filename):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    open(filename, 'w').close()
+
+
+def test_hcp_snapshot(tmpdir, monkeypatch):
+    data_dir = str(tmpdir)
+    mask = join(data_dir, 'parietal', 'mask_img.nii.gz')
+    monkeypatch.setattr(dataset, 'fetch_hcp_mask', lambda data_dir: mask)
+    os.makedirs(join(data_dir, 'behavioral'))
+    with open(join(data_dir, 'behavioral', 'hcp_unrestricted_data.csv'),
+              'w') as f:
+        f.write('Subject,Gender,3T_RS-fMRI_PctCompl,3T_tMRI_PctCompl\n'
+                '100206,M,100,100\n100307,F,100,100\n100408,F,50,100\n')
+    # A synthetic tree with part of the runs and contrast maps
+    subjects = [100206, 100307]
+    runs = _timeseries_frame(data_dir, subjects, 'task', ['EMOTION', 'WM'])
+    runs = runs.drop((100307, 'WM', 'LR'))
+    rest = _timeseries_frame(data_dir, subjects, 'rest', [1])
+    maps = _contrasts_frame(data_dir, subjects, 'nistats', ['level2'])
+    maps = maps.loc[maps.index.get_level_values('task') != 'MOTOR']
+    for filename in (runs['filename'].tolist() + rest['filename'].tolist() +
+                     maps['z_map'].tolist() + maps['effect_map'].tolist()):
+        _touch(filename)
+    dump_hcp_snapshot(data_dir)
+
+    for kwargs in [dict(),
+                   dict(subjects=[100307], tasks='WM'),
+                   dict(tasks=['EMOTION', 'WM'], directions=['RL', 'level2'],
+                        contrasts=['FACES', '2BK'])]:
+        scanned = fetch_hcp(data_dir, **kwargs)
+        loaded = fetch_hcp(data_dir, from_file=True, **kwargs)
+        for name in ['rest', 'task', 'contrasts', 'behavioral']:
+            pd.testing.assert_frame_equal(loaded[name].sort_index(),
+                                          scanned[name].sort_index())
+    loaded = fetch_hcp(data_dir, from_file=True, subjects=[100307],
+                       tasks='WM')
+    assert loaded['task'].index.tolist() == [(100307, 'WM', 'RL')]
+    tasks = loaded['contrasts'].index.get_level_values('task')
+    assert tasks.unique().tolist() == ['WM']
+    assert loaded['behavioral'].index.tolist() == [100307]
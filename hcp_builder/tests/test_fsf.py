@@ -0,0 +1,93 @@
+import os
+import re
+from os.path import join
+
+import nibabel
+import numpy as np
+import pytest
+
+from hcp_builder.glm import _fsl_commands
+from hcp_builder.utils import fsf
+from hcp_builder.utils.cache import LRUCache
+from hcp_builder.utils.fsf import write_fsf_files, read_fsf_design, \
+    TEMPLATE_DIR, level1_fsf_name, level2_fsf_name
+
+
+def test_write_fsf_files(tmpdir):
+    root_path = str(tmpdir)
+    results_dir = join(root_path, '100307', 'MNINonLinear', 'Results')
+    for direction in ['RL', 'LR']:
+        os.makedirs(join(results_dir, 'tfMRI_MOTOR_%s' % direction))
+    # The number of scans of LR is read from the header of its run
+    nibabel.save(nibabel.Nifti1Image(np.zeros((2, 2, 2, 7), dtype=np.int16),
+                                     np.eye(4)),
+                 join(results_dir, 'tfMRI_MOTOR_LR', 'tfMRI_MOTOR_LR.nii.gz'))
+    filenames = write_fsf_files(root_path, 100307, 'MOTOR',
+                                n_scans={'RL': 284})
+    for filename, direction, n_scans in zip(filenames, ['RL', 'LR'],
+                                            [284, 7]):
+        with open(join(TEMPLATE_DIR,
+                       level1_fsf_name('MOTOR', direction))) as f:
+            # What generate_level1_fsf.sh does with sed
+            expected = re.sub(r'fmri\(npts\) [0-9]*',
+                              'fmri(npts) %i' % n_scans, f.read())
+        with open(filename) as f:
+            assert f.read() == expected
+    with open(join(TEMPLATE_DIR, level2_fsf_name('MOTOR'))) as f:
+        expected = f.read()
+    with open(filenames[2]) as f:
+        assert f.read() == expected
+    assert filenames[2] == join(results_dir, 'tfMRI_MOTOR',
+                                level2_fsf_name('MOTOR'))
+
+
+def test_fsl_commands_n_scans(tmpdir, monkeypatch):
+    root_path = str(tmpdir)
+    results_dir = join(root_path, '100307', 'MNINonLinear', 'Results')
+    for direction in ['RL', 'LR']:
+        os.makedirs(join(results_dir, 'tfMRI_MOTOR_%s' % direction))
+
+    def load(filename):
+        raise AssertionError('Header of %s read' % filename)
+
+    monkeypatch.setattr(fsf.nibabel, 'load', load)
+    # The fsf files are written from the run lengths of the protocol
+    prepare = _fsl_commands(root_path, '100307', 'MOTOR')[0]
+    filenames = prepare()
+    for filename in filenames[:2]:
+        with open(filename) as f:
+            assert 'set fmri(npts) 284\n' in f.read()
+    prepare = _fsl_commands(root_path, '100307', 'MOTOR',
+                            n_scans={'RL': 280, 'LR': 284})[0]
+    with open(prepare()[0]) as f:
+        assert 'set fmri(npts) 280\n' in f.read()
+
+
+def test_read_fsf_design(tmpdir):
+    with open(join(TEMPLATE_DIR, level1_fsf_name('MOTOR', 'LR'))) as f:
+        text = f.read()
+    filenames = []
+    for subject in ['1', '2']:
+        subject_dir = join(str(tmpdir), subject)
+        os.makedirs(subject_dir)
+        filenames.append(join(subject_dir, 'design.fsf'))
+        with open(filenames[-1], 'w') as f:
+            f.write(text)
+    cache = LRUCache(max_size=2)
+    design = read_fsf_design(filenames[0], cache=cache)
+    assert design.conditions == ['CUE', 'LF', 'LH', 'RF', 'RH', 'T']
+    assert design.timing_files[0] == join(str(tmpdir), 'EVs', 'cue.txt')
+    assert design.contrasts.shape == (len(design.contrast_names), 12)
+    # Identical files are parsed once, and paths resolved for each of them
+    design.contrasts[:] = 0
+    design.conditions.append('extra')
+    other = read_fsf_design(filenames[1], cache=cache)
+    assert cache.misses == 1 and cache.hits == 1
+    assert other.conditions == ['CUE', 'LF', 'LH', 'RF', 'RH', 'T']
+    assert np.any(other.contrasts != 0)
+    assert other.timing_files[0] == join(str(tmpdir), 'EVs', 'cue.txt')
+
+    with open(filenames[1], 'w') as f:
+        f.write(text.replace('set fmri(ncon_real)', 'set fmri(ncon_none)'))
+    with pytest.raises(ValueError):
+        read_fsf_design(filenames[1], cache=cache)
@@ -0,0 +1,117 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from hcp_builder.utils import fsl
+
+
+def test_fsl_environment(tmpdir, monkeypatch):
+    setup_script = str(tmpdir.join('fsl.sh'))
+    with open(setup_script, 'w') as f:
+        f.write('export FSLDIR=/opt/fsl\nexport FSLOPT="a=b c"\n')
+    cache_file = str(tmpdir.join('fsl_env.json'))
+    env = fsl.fsl_environment(setup_script, cache_file=cache_file)
+    assert env['FSLDIR'] == '/opt/fsl'
+    assert env['FSLOPT'] == 'a=b c'
+    assert os.path.isdir(env['HCPPIPEDIR'])
+    assert 'FSLDIR' not in os.environ
+
+    # Resolved once per process, then read from the cache file
+    calls = []
+    source_environment = fsl._source_environment
+
+    def counting_source(script):
+        calls.append(script)
+        return source_environment(script)
+
+    monkeypatch.setattr(fsl, '_source_environment', counting_source)
+    fsl.fsl_environment(setup_script, cache_file=cache_file)
+    fsl._environments.clear()
+    fsl.fsl_environment(setup_script, cache_file=cache_file)
+    assert calls == []
+
+    # A change of the script is picked up
+    with open(setup_script, 'a') as f:
+        f.write('export FSLOUTPUTTYPE=NIFTI_GZ\n')
+    os.utime(setup_script, ns=(0, 0))
+    env = fsl.fsl_environment(setup_script, cache_file=cache_file)
+    assert env['FSLOUTPUTTYPE'] == 'NIFTI_GZ'
+    assert calls == [setup_script]
+
+
+def test_run_jobs(tmpdir):
+    python = sys.executable
+    allocate = [python, '-c', 'x = bytearray(50 * 1024 ** 2); '
+                              'print("allocated"); '
+                              'import sys; sys.stderr.write("warning\\n")']
+    fail = [python, '-c', 'import sys; sys.exit(3)']
+    never = [python, '-c', 'print("never run")']
+    jobs = [([allocate], str(tmpdir.join('logs', 'ok.log'))),
+            ([fail, never], str(tmpdir.join('logs', 'fail.log')))]
+    ok, failed = fsl.run_jobs(jobs, n_jobs=2)
+    assert ok.returncode == 0
+    assert ok.max_rss > 50 * 1024
+    with open(ok.log_file) as f:
+        log = f.read()
+    assert 'allocated' in log and 'warning' in log
+    assert failed.returncode == 3
+    assert failed.cmd == ' '.join(fail)
+    with open(failed.log_file) as f:
+        assert 'never run' not in f.read()
+
+
+def test_run_commands_concurrent(tmpdir):
+    python = sys.executable
+    sleep = [python, '-c', 'import time; start = time.time(); '
+             'time.sleep(1); print("slept %r %r" % (start, time.time()))']
+    log_file = str(tmpdir.join('job.log'))
+    result = fsl.run_commands([(sleep, sleep), sleep], log_file)
+    assert result.returncode == 0
+    with open(log_file) as f:
+        intervals = [tuple(map(float, line.split()[1:]))
+                     for line in f if line.startswith('slept ')]
+    assert len(intervals) == 3
+    # Both commands of the first step run at once, before the second step
+    first, second, last = intervals
+    assert max(first[0], second[0]) < min(first[1], second[1])
+    assert last[0] >= max(first[1], second[1])
+    assert result.wall_time > 2
+
+    fail = [python, '-c', 'import sys; sys.exit(2)']
+    result = fsl.run_commands([(sleep, fail), sleep], log_file)
+    assert result.returncode == 2
+    assert result.cmd == ' '.join(fail)
+    with open(log_file) as f:
+        assert sum(line.startswith('slept ') for line in f) == 1
+
+
+def test_run_commands_callable(tmpdir):
+    python = sys.executable
+    log_file = str(tmpdir.join('job.log'))
+    calls = []
+
+    def prepare():
+        calls.append('prepare')
+
+    def fail():
+        raise IOError('Missing run')
+
+    echo = [python, '-c', 'print("echoed")']
+    result = fsl.run_commands([prepare, echo], log_file)
+    assert result.returncode == 0 and calls == ['prepare']
+    result = fsl.run_commands([fail, echo], log_file)
+    assert result.returncode == 1
+    assert result.cmd == 'Python: fail'
+    with open(log_file) as f:
+        log = f.read()
+    assert 'Missing run' in log and 'echoed\n' not in log
+
+
+def test_run_cmd(capsys):
+    fsl.run_cmd([sys.executable, '-c', 'print("line 1"); print("line 2")'],
+                verbose=True)
+    assert 'line 1\nline 2\n' in capsys.readouterr().out
+    with pytest.raises(subprocess.CalledProcessError):
+        fsl.run_cmd([sys.executable, '-c', 'import sys; sys.exit(1)'])
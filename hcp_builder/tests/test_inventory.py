@@ -0,0 +1,59 @@
+import os
+from os.path import join
+
+from hcp_builder.utils.inventory import Inventory
+
+
+def _touch(filename):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    open(filename, 'w').close()
+
+
+def test_inventory(tmpdir):
+    root = str(tmpdir)
+    filename = join(root, 'inventory.pkl')
+    results = join('100206', 'MNINonLinear', 'Results')
+    _touch(join(root, results, 'tfMRI_WM_LR', 'tfMRI_WM_LR.nii.gz'))
+    _touch(join(root, results, 'tfMRI_WM_LR', 'EVs', 'Sync.txt'))
+    inventory = Inventory(root, filename)
+    inventory.update([results, join('glm', '100206')])
+    paths = [join(root, results, 'tfMRI_WM_LR', 'tfMRI_WM_LR.nii.gz'),
+             join(results, 'tfMRI_WM_LR', 'EVs', 'Sync.txt'),
+             join(root, results, 'tfMRI_WM_RL', 'tfMRI_WM_RL.nii.gz')]
+    assert inventory.exists(paths).tolist() == [True, True, False]
+
+    # Reloaded from disk and incrementally updated
+    _touch(join(root, results, 'tfMRI_WM_RL', 'tfMRI_WM_RL.nii.gz'))
+    os.unlink(join(root, results, 'tfMRI_WM_LR', 'EVs', 'Sync.txt'))
+    inventory = Inventory(root, filename)
+    assert inventory.exists(paths).tolist() == [True, True, False]
+    inventory.update([results])
+    assert inventory.exists(paths).tolist() == [True, False, True]
+
+    # Removed directories are dropped from the index
+    os.unlink(join(root, results, 'tfMRI_WM_LR', 'tfMRI_WM_LR.nii.gz'))
+    os.rmdir(join(root, results, 'tfMRI_WM_LR', 'EVs'))
+    os.rmdir(join(root, results, 'tfMRI_WM_LR'))
+    inventory.update([results])
+    assert inventory.exists(paths).tolist() == [False, False, True]
+
+
+def test_inventory_mtime_granularity(tmpdir):
+    root = str(tmpdir)
+    _touch(join(root, 'old', 'a.txt'))
+    _touch(join(root, 'new', 'a.txt'))
+    old_mtime = os.stat(join(root, 'old')).st_mtime_ns - 10 ** 10
+    os.utime(join(root, 'old'), ns=(old_mtime, old_mtime))
+    # Not older than the listing, whatever the second it happens in
+    new_mtime = old_mtime + 2 * 10 ** 10
+    os.utime(join(root, 'new'), ns=(new_mtime, new_mtime))
+    inventory = Inventory(root)
+    inventory.update(['old', 'new'])
+    # Directories changed without a new modification time
+    for directory, mtime in [('old', old_mtime), ('new', new_mtime)]:
+        _touch(join(root, directory, 'b.txt'))
+        os.utime(join(root, directory), ns=(mtime, mtime))
+    inventory.update(['old', 'new'])
+    paths = [join('old', 'b.txt'), join('new', 'b.txt')]
+    # Only the listing made in the second of the modification is redone
+    assert inventory.exists(paths).tolist() == [False, True]
@@ -0,0 +1,27 @@
+import nibabel
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from hcp_builder.utils.packed import (dump_packed, load_packed, PackedFile,
+                                      PackedMap, packed_filename)
+
+
+def test_packed_maps(tmpdir):
+    output_dir = str(tmpdir)
+    mask = np.zeros((4, 5, 6), dtype=np.int8)
+    mask[1:3, 1:4, 2:5] = 1
+    n_voxels = int(mask.sum())
+    nibabel.save(nibabel.Nifti1Image(mask, np.eye(4)),
+                 str(tmpdir.join('mask.nii.gz')))
+    data = np.random.RandomState(0).randn(3, n_voxels)
+    dump_packed(output_dir, 'z', data, ['a', 'b', 'c'])
+    loaded, names = load_packed(output_dir, 'z')
+    assert names == ['a', 'b', 'c']
+    assert_array_equal(loaded, data)
+
+    packed_map = PackedMap(PackedFile(packed_filename(output_dir, 'z')), 'b')
+    assert_array_equal(packed_map.get_data(), data[1])
+    img = packed_map.to_img()
+    assert img.shape == mask.shape
+    assert_array_equal(np.asanyarray(img.dataobj)[mask != 0], data[1])
+    assert np.all(np.asanyarray(img.dataobj)[mask == 0] == 0)
@@ -0,0 +1,107 @@
+from collections import namedtuple
+
+import numpy as np
+from numpy.testing import assert_array_almost_equal
+from scipy.stats import norm, t as t_dist
+
+from hcp_builder.utils.regression import compute_contrasts, fit_ar1, \
+    fixed_effects
+
+Result = namedtuple('Result', ['theta', 'cov', 'dispersion', 'df_resid'])
+
+
+def _make_results(n_regressors=5, n_voxels=50, random_state=0):
+    rng = np.random.RandomState(random_state)
+    labels = rng.randint(3, size=n_voxels).astype(str)
+    results = {}
+    for label in np.unique(labels):
+        n = np.sum(labels == label)
+        a = rng.randn(n_regressors, n_regressors)
+        results[label] = Result(theta=rng.randn(n_regressors, n),
+                                cov=a.dot(a.T),
+                                dispersion=rng.rand(n) + .5,
+                                df_resid=100)
+    return labels, results
+
+
+def test_compute_contrasts():
+    labels, results = _make_results()
+    contrast_matrix = np.random.RandomState(1).randn(4, 5)
+    effect, variance, z_score = compute_contrasts(labels, results,
+                                                  contrast_matrix)
+    assert effect.shape == variance.shape == z_score.shape == (4, 50)
+    # One contrast and one voxel at a time, as nistats Tcontrast does
+    for i, con in enumerate(contrast_matrix):
+        for j, label in enumerate(labels):
+            result = results[label]
+            k = np.sum(labels[:j] == label)
+            this_effect = con.dot(result.theta[:, k])
+            this_variance = con.dot(result.cov).dot(con) \
+                * result.dispersion[k]
+            p_value = t_dist.sf(this_effect / np.sqrt(this_variance), 100)
+            assert_array_almost_equal(effect[i, j], this_effect)
+            assert_array_almost_equal(variance[i, j], this_variance)
+            assert_array_almost_equal(z_score[i, j], norm.isf(p_value))
+
+
+def test_fixed_effects():
+    rng = np.random.RandomState(0)
+    effects = [rng.randn(3, 101) for _ in range(2)]
+    variances = [rng.rand(3, 101) + .1 for _ in range(2)]
+    dofs = [100, np.full(101, 120.)]
+    effect, variance, z_score = fixed_effects(effects, variances, dofs,
+                                              chunk_size=7)
+    weights = [1. / this_variance for this_variance in variances]
+    expected_variance = 1. / (weights[0] + weights[1])
+    expected_effect = (weights[0] * effects[0]
+                       + weights[1] * effects[1]) * expected_variance
+    assert_array_almost_equal(variance, expected_variance)
+    assert_array_almost_equal(effect, expected_effect)
+    p_value = t_dist.sf(expected_effect / np.sqrt(expected_variance), 220)
+    assert_array_almost_equal(z_score, norm.isf(p_value))
+
+
+def test_fit_ar1():
+    rng = np.random.RandomState(0)
+    n_scans, n_voxels = 80, 60
+    design = np.c_[rng.randn(n_scans, 3), np.ones(n_scans)]
+    noise = rng.randn(n_scans, n_voxels)
+    noise[1:] += .4 * noise[:-1]
+    Y = design.dot(rng.randn(4, n_voxels)) + noise
+    labels, results = fit_ar1(Y, design, chunk_size=7)
+    chunk_labels, chunk_results = fit_ar1(Y, design, chunk_size=1000)
+    assert_array_almost_equal(labels, chunk_labels)
+    for label, result in results.items():
+        voxels = np.flatnonzero(labels == label)
+        assert_array_almost_equal(result.theta,
+                                  chunk_results[label].theta)
+        # Reference fit, one voxel at a time
+        for k, j in enumerate(voxels):
+            whitened_design = design.copy()
+            whitened_design[1:] -= label * design[:-1]
+            y = Y[:, j].copy()
+            y[1:] -= label * Y[:-1, j]
+            beta, _, _, _ = np.linalg.lstsq(whitened_design, y, rcond=None)
+            resid = y - whitened_design.dot(beta)
+            assert_array_almost_equal(result.theta[:, k], beta)
+            assert_array_almost_equal(result.dispersion[k],
+                                      resid.dot(resid) / (n_scans - 4))
+
+
+def test_fit_ar1_batch():
+    rng = np.random.RandomState(0)
+    design = np.c_[rng.randn(50, 2), np.ones(50)]
+    Ys = [rng.randn(50, n_voxels) for n_voxels in [10, 3, 25]]
+    labels, results = fit_ar1(Ys, design, standardize=True, chunk_size=8)
+    contrast_matrix = np.eye(3)[:2]
+    effect, _, z_score = compute_contrasts(labels, results, contrast_matrix)
+    start = 0
+    for Y in Ys:
+        this_labels, this_results = fit_ar1(Y, design, standardize=True)
+        this_effect, _, this_z_score = compute_contrasts(
+            this_labels, this_results, contrast_matrix)
+        stop = start + Y.shape[1]
+        assert_array_almost_equal(labels[start:stop], this_labels)
+        assert_array_almost_equal(effect[:, start:stop], this_effect)
+        assert_array_almost_equal(z_score[:, start:stop], this_z_score)
+        start = stop
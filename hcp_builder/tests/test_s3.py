@@ -0,0 +1,268 @@
+import gzip
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+
+from hcp_builder.utils import s3
+
+
+class FakeKey(object):
+    """Minimal stand-in for boto.s3.key.Key, serving bytes from memory."""
+    def __init__(self, bucket, name, data):
+        self.bucket = bucket
+        self.name = name
+        self.data = data
+        self.size = len(data)
+        self.etag = '"%s"' % hashlib.md5(data).hexdigest()
+        self.last_modified = '2017-03-01T00:00:00.000Z'
+        self._pos = None
+        self._stop = None
+
+    def open_read(self, headers=None):
+        if self._pos is None:
+            with self.bucket.lock:
+                self.bucket.n_requests += 1
+                self.bucket.n_open += 1
+                self.bucket.max_open = max(self.bucket.max_open,
+                                           self.bucket.n_open)
+            self._pos, self._stop = 0, self.size
+            if headers is not None and 'Range' in headers:
+                start, stop = headers['Range'][len('bytes='):].split('-')
+                self._pos, self._stop = int(start), int(stop) + 1
+                if self._pos in self.bucket.failing_ranges:
+                    self.bucket.failing_ranges.remove(self._pos)
+                    self._stop = self._pos + 10
+
+    def read(self, size=0):
+        self.open_read()
+        time.sleep(self.bucket.delay)
+        chunk = self.data[self._pos:min(self._pos + size, self._stop)]
+        self._pos += len(chunk)
+        return chunk
+
+    def close(self):
+        if self._pos is not None:
+            with self.bucket.lock:
+                self.bucket.n_open -= 1
+        self._pos = None
+
+
+class FakeBucket(object):
+    def __init__(self, contents):
+        self.contents = contents
+        self.n_requests = 0
+        self.failing_ranges = set()
+        self.lock = threading.Lock()
+        self.n_open = self.max_open = 0
+        self.delay = 0
+
+    def get_key(self, name):
+        if name not in self.contents:
+            return None
+        return FakeKey(self, name, self.contents[name])
+
+    def new_key(self, name):
+        return FakeKey(self, name, self.contents[name])
+
+    def list(self, prefix=''):
+        self.n_requests += 1
+        return [FakeKey(self, name, data)
+                for name, data in sorted(self.contents.items())
+                if name.startswith(prefix)]
+
+
+@pytest.fixture
+def bucket():
+    contents = {'HCP_1200/100206/file_%i.txt' % i: os.urandom(1000 + i)
+                for i in range(10)}
+    return FakeBucket(contents)
+
+
+def test_download_keys(tmpdir, bucket):
+    keys = sorted(bucket.contents) + ['HCP_1200/100206/missing.txt']
+    targets = [str(tmpdir.join(*key.split('/'))) for key in keys]
+    threads = set()
+
+    def bucket_factory():
+        threads.add(threading.get_ident())
+        return bucket
+
+    failures = s3.download_keys(bucket_factory, keys, targets, n_jobs=4)
+    assert len(failures) == 1
+    assert failures[0][0] == keys[-1]
+    assert isinstance(failures[0][2], FileNotFoundError)
+    for key, target in zip(keys[:-1], targets[:-1]):
+        with open(target, 'rb') as f:
+            assert f.read() == bucket.contents[key]
+    assert len(threads) > 1
+
+
+def test_transfer_limits(tmpdir, bucket):
+    limiter = s3.set_transfer_limits(max_concurrency=2)
+    try:
+        assert s3._limiter is limiter
+        keys = sorted(bucket.contents)
+        bucket.delay = 0.01
+        threads = []
+
+        def bucket_factory():
+            threads.append(threading.get_ident())
+            return bucket
+
+        for run in ('first', 'second'):
+            targets = [str(tmpdir.join(run, '%i.txt' % i))
+                       for i in range(len(keys))]
+            failures = s3.download_keys(bucket_factory, keys, targets,
+                                        n_jobs=8)
+            assert failures == []
+        # Eight download threads, but never more than two open streams
+        assert bucket.max_open == 2
+        assert bucket.n_open == 0
+        # The second call reuses the threads, and connections, of the first
+        assert len(set(threads)) <= 8
+    finally:
+        s3.set_transfer_limits()
+    assert s3._limiter.max_concurrency == s3.MAX_CONCURRENCY
+
+
+def test_download_ranges_resume(tmpdir, bucket, monkeypatch):
+    monkeypatch.setattr(s3, 'MULTIPART_THRESHOLD', 100)
+    monkeypatch.setattr(s3, 'RANGE_SIZE', 100)
+    key = 'HCP_1200/100206/large.nii.gz'
+    bucket.contents[key] = data = gzip.compress(os.urandom(1030))
+    target = str(tmpdir.join('large.nii.gz'))
+    # Interrupt the transfer of two ranges out of eleven
+    bucket.failing_ranges = {200, 700}
+    with pytest.raises(ConnectionError):
+        s3.download_key(bucket, key, target)
+    assert not os.path.exists(target)
+    assert os.path.exists(target + '.part.json')
+    n_requests = bucket.n_requests
+    s3.download_key(bucket, key, target)
+    assert bucket.n_requests - n_requests == 2
+    assert not os.path.exists(target + '.part')
+    assert not os.path.exists(target + '.part.json')
+    with open(target, 'rb') as f:
+        assert f.read() == data
+
+
+def test_manifest(tmpdir, bucket):
+    manifest = s3.S3Manifest(str(tmpdir.join('manifest.db')))
+    manifest.update(bucket, 'HCP_1200/100206/')
+    manifest.update(bucket, 'HCP_1200/100206/')
+    assert bucket.n_requests == 1
+    assert manifest.has_prefix('/HCP_1200/100206/')
+    key = 'HCP_1200/100206/file_3.txt'
+    assert '/' + key in manifest
+    assert manifest.get(key)[0] == 1003
+
+    keys = [key, 'HCP_1200/100206/missing.txt']
+    targets = [str(tmpdir.join('%i.txt' % i)) for i in range(2)]
+    failures = s3.download_keys(lambda: bucket, keys, targets,
+                                manifest=manifest)
+    assert len(failures) == 1
+    assert isinstance(failures[0][2], FileNotFoundError)
+    # Only the GET of the existing key reached the bucket
+    assert bucket.n_requests == 2
+
+
+def test_download_key_verification(tmpdir, bucket, monkeypatch):
+    key = 'HCP_1200/100206/file_0.txt'
+    target = str(tmpdir.join('file_0.txt'))
+    bucket.contents[key] = b'x' * 10
+    # Served bytes no longer match the recorded ETag
+    fake_key = bucket.get_key(key)
+    fake_key.data = b'y' * 10
+    monkeypatch.setattr(bucket, 'get_key', lambda name: fake_key)
+    with pytest.raises(ConnectionError):
+        s3.download_key(bucket, key, target)
+    assert not os.path.exists(target)
+    assert not os.path.exists(target + '.part')
+
+
+def test_download_ranges_multipart_etag(tmpdir, bucket, monkeypatch):
+    monkeypatch.setattr(s3, 'PART_SIZES', [100])
+    key = 'HCP_1200/100206/large.nii.gz'
+    bucket.contents[key] = data = os.urandom(1050)
+    digests = b''.join(hashlib.md5(data[i:i + 100]).digest()
+                       for i in range(0, 1050, 100))
+    etag = '"%s-11"' % hashlib.md5(digests).hexdigest()
+    target = str(tmpdir.join('large.nii.gz'))
+    s3.download_ranges(lambda: bucket, key, target, len(data), etag=etag)
+    with open(target, 'rb') as f:
+        assert f.read() == data
+    wrong_etag = '"%s-11"' % hashlib.md5(b'').hexdigest()
+    with pytest.raises(ConnectionError):
+        s3.download_ranges(lambda: bucket, key, target, len(data),
+                           etag=wrong_etag)
+
+
+def test_download_ranges_part_size_candidates(tmpdir, bucket, monkeypatch):
+    # Like a 50 MB key in 4 parts, which fits both 16 MB and 15 MB parts
+    monkeypatch.setattr(s3, 'PART_SIZES', [160, 150])
+    key = 'HCP_1200/100206/large.nii.gz'
+    bucket.contents[key] = data = os.urandom(500)
+    digests = b''.join(hashlib.md5(data[i:i + 150]).digest()
+                       for i in range(0, 500, 150))
+    etag = '"%s-4"' % hashlib.md5(digests).hexdigest()
+    target = str(tmpdir.join('large.nii.gz'))
+    s3.download_ranges(lambda: bucket, key, target, len(data), etag=etag)
+    with open(target, 'rb') as f:
+        assert f.read() == data
+
+    # Unknown part size: a valid gzip stream is kept
+    bucket.contents[key] = data = gzip.compress(os.urandom(500))
+    etag = '"%s-4"' % hashlib.md5(b'').hexdigest()
+    s3.download_ranges(lambda: bucket, key, target, len(data), etag=etag,
+                       range_size=100)
+    with open(target, 'rb') as f:
+        assert f.read() == data
+
+    # Unknown part size of another file: kept aside unless explicitly allowed
+    key = 'HCP_1200/100206/large.txt'
+    bucket.contents[key] = data = os.urandom(500)
+    target = str(tmpdir.join('large.txt'))
+    with pytest.raises(ConnectionError, match='verify'):
+        s3.download_ranges(lambda: bucket, key, target, len(data),
+                           etag=etag, range_size=100)
+    assert not os.path.exists(target)
+    n_requests = bucket.n_requests
+    s3.download_ranges(lambda: bucket, key, target, len(data), etag=etag,
+                       range_size=100, allow_unverified=True)
+    assert bucket.n_requests == n_requests
+    with open(target, 'rb') as f:
+        assert f.read() == data
+
+
+def test_download_ranges_plain_etag(tmpdir, bucket):
+    key = 'HCP_1200/100206/large.txt'
+    bucket.contents[key] = data = os.urandom(1050)
+    target = str(tmpdir.join('large.txt'))
+    etag = '"%s"' % hashlib.md5(data).hexdigest()
+    s3.download_ranges(lambda: bucket, key, target, len(data), etag=etag,
+                       range_size=100)
+    with open(target, 'rb') as f:
+        assert f.read() == data
+    os.unlink(target)
+    wrong_etag = '"%s"' % hashlib.md5(b'').hexdigest()
+    with pytest.raises(ConnectionError, match='Corrupted'):
+        s3.download_ranges(lambda: bucket, key, target, len(data),
+                           etag=wrong_etag, range_size=100)
+    assert not os.path.exists(target)
+    assert not os.path.exists(target + '.part')
+
+
+def test_check_gzip(tmpdir):
+    filename = str(tmpdir.join('img.nii.gz'))
+    with gzip.open(filename, 'wb') as f:
+        f.write(os.urandom(10000))
+    s3.deep_check(filename).result()
+    with open(filename, 'rb') as f:
+        data = f.read()
+    with open(filename, 'wb') as f:
+        f.write(data[:-100])
+    with pytest.raises(ConnectionError):
+        s3.deep_check(filename).result()
@@ -0,0 +1,102 @@
+import threading
+
+import pytest
+
+from hcp_builder.scheduler import Scheduler, Stage, DONE, FAILED, \
+    PENDING, RELEASED
+
+
+def test_scheduler(tmpdir):
+    calls = []
+    downloaded = set()
+    lock = threading.Lock()
+
+    def download(subject, task):
+        with lock:
+            calls.append(('download', subject, task))
+            n_calls = calls.count(('download', subject, task))
+        # The first download of subject 2 fails once
+        if subject == 2 and n_calls == 1:
+            raise ConnectionError('Transfer interrupted')
+        with lock:
+            downloaded.add((subject, task))
+
+    def glm(subject, task):
+        with lock:
+            # Fits start once downloads are done
+            assert (subject, task) in downloaded
+            calls.append(('glm', subject, task))
+        if task == 'MOTOR':
+            raise ValueError('Bad design')
+
+    filename = str(tmpdir.join('jobs.db'))
+    stages = [Stage('download', download, n_jobs=2),
+              Stage('glm', glm, n_jobs=1)]
+    scheduler = Scheduler(filename, stages, max_attempts=2, backoff=0.01)
+    scheduler.add([1, 2, 3], ['EMOTION', 'MOTOR'])
+    status = scheduler.run()['status']
+    assert len(status) == 12
+    assert (status.xs('download', level='stage') == DONE).all()
+    glm_status = status.xs('glm', level='stage')
+    assert (glm_status.xs('EMOTION', level='task') == DONE).all()
+    assert (glm_status.xs('MOTOR', level='task') == FAILED).all()
+    assert calls.count(('download', 2, 'EMOTION')) == 2
+    assert calls.count(('glm', 1, 'MOTOR')) == 2
+
+    # Completed jobs are skipped, failed ones retried on demand
+    del calls[:]
+    scheduler = Scheduler(filename, stages, max_attempts=1, backoff=0.01)
+    scheduler.add([1, 2, 3], ['EMOTION', 'MOTOR'])
+    scheduler.run()
+    assert calls == []
+    scheduler.reset_failed(stage='glm')
+    scheduler.run()
+    assert sorted(calls) == [('glm', subject, 'MOTOR')
+                             for subject in [1, 2, 3]]
+
+
+def test_scheduler_max_subjects(tmpdir):
+    on_disk = set()
+    max_on_disk = [0]
+    lock = threading.Lock()
+
+    def download(subject, task):
+        with lock:
+            on_disk.add((subject, task))
+            max_on_disk[0] = max(max_on_disk[0],
+                                 len(set(key[0] for key in on_disk)))
+
+    def glm(subject, task):
+        if subject in (1, 2) and task == 'MOTOR':
+            raise ValueError('Bad design')
+
+    def evict(subject, task):
+        with lock:
+            on_disk.discard((subject, task))
+
+    stages = [Stage('download', download, n_jobs=4),
+              Stage('glm', glm, n_jobs=2),
+              Stage('evict', evict, n_jobs=1)]
+    scheduler = Scheduler(str(tmpdir.join('jobs.db')), stages,
+                          max_attempts=1, max_subjects=2)
+    scheduler.add(range(6), ['EMOTION', 'MOTOR'])
+    # The data of failed jobs is kept, and holds the max_subjects slots
+    with pytest.warns(UserWarning, match='blocked'):
+        status = scheduler.run()['status']
+    assert max_on_disk[0] == 2
+    assert on_disk == {(1, 'MOTOR'), (2, 'MOTOR')}
+    assert status[1, 'MOTOR', 'evict'] == FAILED
+    assert (status.loc[[3, 4, 5]] == PENDING).all()
+
+    # Released subjects free their slots, and are not run again
+    assert scheduler.release(cleanup=evict) == [(1, 'MOTOR'), (2, 'MOTOR')]
+    assert on_disk == set()
+    status = scheduler.run()['status']
+    assert max_on_disk[0] == 2
+    assert on_disk == set()
+    assert status[1, 'MOTOR', 'glm'] == RELEASED
+    assert (status.drop([1, 2], level='subject') == DONE).all()
+
+    # Retried from the first stage
+    scheduler.reset_failed()
+    assert (scheduler.status()['status'][2, 'MOTOR'] == PENDING).all()
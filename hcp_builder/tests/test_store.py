@@ -0,0 +1,40 @@
+import nibabel
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_array_equal
+
+from hcp_builder.utils.store import write_store, read_store, read_index
+
+
+def test_store(tmpdir):
+    mask = np.zeros((4, 5, 6), dtype=np.int8)
+    mask[1:3, 1:4, 2:5] = 1
+    mask_img = nibabel.Nifti1Image(mask, np.eye(4))
+    rng = np.random.RandomState(0)
+    sources, expected = [], []
+    for i in range(6):
+        data = rng.randn(4, 5, 6).astype(np.float32)
+        filename = str(tmpdir.join('map_%i.nii.gz' % i))
+        nibabel.save(nibabel.Nifti1Image(data, np.eye(4)), filename)
+        sources.append(filename)
+        expected.append(data[mask != 0])
+    expected = np.array(expected)
+    index = pd.MultiIndex.from_product([[100206, 100307], ['a', 'b', 'c']],
+                                       names=['subject', 'contrast'])
+    store_dir = str(tmpdir.join('store'))
+    write_store(store_dir, sources, index, mask_img, batch_size=4, n_jobs=2)
+
+    maps, this_index = read_store(store_dir)
+    assert isinstance(maps, np.memmap)
+    assert_array_equal(maps, expected)
+    assert this_index.equals(index)
+
+    rows = read_index(store_dir)
+    # Evenly spaced rows are a view on the store
+    maps, this_index = read_store(store_dir, rows.loc[(slice(None), 'b')])
+    assert isinstance(maps, np.memmap)
+    assert_array_equal(maps, expected[[1, 4]])
+    # Others are copied
+    maps, this_index = read_store(store_dir, rows.iloc[[0, 1, 5]])
+    assert not isinstance(maps, np.memmap)
+    assert_array_equal(maps, expected[[0, 1, 5]])
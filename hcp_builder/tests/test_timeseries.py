@@ -0,0 +1,54 @@
+import os
+
+import nibabel
+import numpy as np
+from numpy.testing import assert_array_almost_equal
+from scipy import ndimage
+
+from hcp_builder.utils.timeseries import (cache_timeseries, cache_filename,
+                                          is_cached, iter_volumes, mask_key)
+
+
+def test_cache_timeseries(tmpdir):
+    rng = np.random.RandomState(0)
+    data = rng.randint(0, 1000, size=(4, 5, 6, 7)).astype(np.int16)
+    img = nibabel.Nifti1Image(data, np.eye(4))
+    img.header.set_slope_inter(.5, 10)
+    source = str(tmpdir.join('rfMRI_REST1_LR.nii.gz'))
+    nibabel.save(img, source)
+    mask = np.zeros((4, 5, 6), dtype=np.int8)
+    mask[1:3, 1:4, 2:5] = 1
+    mask[0, 0, 0] = 1
+    mask_img = nibabel.Nifti1Image(mask, np.eye(4))
+    expected = (data[mask != 0] * .5 + 10).T
+
+    volumes = list(iter_volumes(source))
+    assert_array_almost_equal(np.stack(volumes, axis=3), data * .5 + 10)
+
+    target = cache_filename(source, mask_key(mask_img))
+    assert target == str(tmpdir.join('rfMRI_REST1_LR_masked_%s.npy'
+                                      % mask_key(mask_img)))
+    assert not is_cached(source, target)
+    cache_timeseries(source, target, mask_img)
+    assert is_cached(source, target)
+    cached = np.load(target, mmap_mode='r')
+    assert cached.dtype == np.float32
+    assert_array_almost_equal(cached, expected)
+    # The cache is invalidated when the source changes
+    os.utime(source, ns=(0, 0))
+    assert not is_cached(source, target)
+
+
+def test_iter_volumes_smoothing(tmpdir):
+    rng = np.random.RandomState(0)
+    data = rng.randn(6, 7, 8, 3).astype(np.float32)
+    affine = np.diag([2., 2., 2., 1.])
+    source = str(tmpdir.join('run.nii.gz'))
+    nibabel.save(nibabel.Nifti1Image(data, affine), source)
+    mask = rng.rand(6, 7, 8) > .5
+    sigma = 4. / (np.sqrt(8 * np.log(2)) * 2.)
+    for t, volume in enumerate(iter_volumes(source, mask=mask,
+                                            smoothing_fwhm=4.)):
+        expected = ndimage.gaussian_filter(data[..., t].astype(np.float64),
+                                           sigma)
+        assert_array_almost_equal(volume, expected[mask], decimal=5)
@@ -0,0 +1,46 @@
+import os
+
+import nibabel
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal
+
+from hcp_builder.utils.writer import ImageWriter, save_img
+
+
+def test_image_writer(tmpdir, monkeypatch):
+    rng = np.random.RandomState(0)
+    imgs = [nibabel.Nifti1Image(rng.randn(5, 6, 7), np.eye(4))
+            for _ in range(8)]
+    for compresslevel in [None, 0, 1]:
+        filenames = [str(tmpdir.join('%s_%i.nii.gz' % (compresslevel, i)))
+                     for i in range(len(imgs))]
+        with ImageWriter(n_jobs=3, max_pending=2,
+                         compresslevel=compresslevel) as writer:
+            for img, filename in zip(imgs, filenames):
+                writer.save(img, filename)
+        for img, filename in zip(imgs, filenames):
+            assert_array_equal(np.asanyarray(nibabel.load(filename).dataobj),
+                               img.dataobj)
+    # Uncompressed gzip streams are larger
+    assert (os.path.getsize(str(tmpdir.join('0_0.nii.gz')))
+            > os.path.getsize(str(tmpdir.join('1_0.nii.gz'))))
+    assert not [name for name in os.listdir(str(tmpdir))
+                if name.startswith('.tmp')]
+
+    # Write errors are raised on exit
+    with pytest.raises(IOError):
+        with ImageWriter(n_jobs=2) as writer:
+            writer.save(imgs[0], str(tmpdir.join('missing', 'img.nii.gz')))
+
+
+def test_save_img_failure(tmpdir, monkeypatch):
+    img = nibabel.Nifti1Image(np.zeros((5, 6, 7)), np.eye(4))
+
+    def to_file_map(file_map):
+        file_map['image'].fileobj.write(b'partial')
+        raise IOError('Disk full')
+    monkeypatch.setattr(img, 'to_file_map', to_file_map)
+    with pytest.raises(IOError):
+        save_img(img, str(tmpdir.join('img.nii.gz')), compresslevel=1)
+    assert os.listdir(str(tmpdir)) == []
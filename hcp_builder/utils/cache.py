@@ -0,0 +1,73 @@
+"""
+In-memory LRU cache with an optional on-disk tier.
+"""
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from os.path import join
+
+
+class LRUCache(object):
+    """Least-recently-used cache of computed values, keyed on strings.
+
+    Parameters
+    ----------
+    max_size: int,
+        Number of values kept in memory.
+
+    cache_dir: str or None,
+        If provided, values are also pickled in this directory, and shared
+        between the processes using it.
+    """
+    def __init__(self, max_size=32, cache_dir=None):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+        filename = join(self.cache_dir, '%s.pkl' % key)
+        try:
+            with open(filename, 'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _dump(self, key, value):
+        if self.cache_dir is None:
+            return
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        filename = join(self.cache_dir, '%s.pkl' % key)
+        tmp = filename + '.tmp%i' % os.getpid()
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+
+    def get(self, key, compute):
+        """Return the value of key, calling compute() on a miss."""
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                self.hits += 1
+                return self._values[key]
+        value = self._load(key)
+        if value is None:
+            value = compute()
+            self._dump(key, value)
+        with self._lock:
+            self.misses += 1
+            self._values[key] = value
+            self._values.move_to_end(key)
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
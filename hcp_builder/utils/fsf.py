@@ -0,0 +1,215 @@
+"""
+FSL design (fsf) files of the HCP task pipeline: parsing, and rendering
+from the templates of PrepareTaskfMRI.
+"""
+import hashlib
+import inspect
+import os
+import re
+import threading
+from collections import namedtuple
+from os.path import dirname, join
+
+import nibabel
+import numpy as np
+
+from .cache import LRUCache
+
+TEMPLATE_DIR = join(dirname(dirname(dirname(
+    inspect.getfile(inspect.currentframe())))), 'hcp_scripts',
+    'HCP-pipeline-scripts', 'PrepareTaskfMRI', 'fsf_templates')
+
+NPTS_REGEX = re.compile(r'fmri\(npts\) [0-9]*')
+
+# `set group(key) value` lines
+SET_REGEX = re.compile(r'^set (\w+)\(([^)\s]+)\) (.*?)\s*$', re.MULTILINE)
+
+FsfDesign = namedtuple('FsfDesign', ['conditions', 'timing_files',
+                                     'contrast_names', 'contrasts'])
+
+_fsf_cache = LRUCache(max_size=64)
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def level1_fsf_name(task, direction):
+    return 'tfMRI_%s_%s_hp200_s4_level1.fsf' % (task, direction)
+
+
+def level2_fsf_name(task):
+    return 'tfMRI_%s_hp200_s4_level2.fsf' % task
+
+
+def load_template(name, template_dir=TEMPLATE_DIR):
+    """Text of a template, and its parts around the value of
+    `set fmri(npts)`, read once per process.
+
+    Returns
+    -------
+    text: str
+
+    parts: tuple of str, the text before and after the number of scans, or
+        the whole text if there is no such line
+    """
+    filename = join(template_dir, name)
+    with _templates_lock:
+        if filename not in _templates:
+            with open(filename, 'r') as f:
+                text = f.read()
+            match = NPTS_REGEX.search(text)
+            if match is None:
+                parts = (text,)
+            else:
+                parts = (text[:match.start()] + 'fmri(npts) ',
+                         text[match.end():])
+            _templates[filename] = text, parts
+        return _templates[filename]
+
+
+def render_level1_fsf(task, direction, n_scans, template_dir=TEMPLATE_DIR):
+    """Text of the level 1 fsf of a run of n_scans volumes, as written by
+    generate_level1_fsf.sh."""
+    _, parts = load_template(level1_fsf_name(task, direction), template_dir)
+    return ('%i' % n_scans).join(parts)
+
+
+def template_n_scans(task, direction, template_dir=TEMPLATE_DIR):
+    """Number of volumes of a run in the HCP protocol, as set in its level 1
+    template."""
+    text, _ = load_template(level1_fsf_name(task, direction), template_dir)
+    match = NPTS_REGEX.search(text)
+    if match is None:
+        raise ValueError('No number of scans in the template of %s %s'
+                         % (task, direction))
+    return int(match.group().split()[-1])
+
+
+def _write(text, filename):
+    tmp = join(dirname(filename), '.tmp%i.%i.%s' % (
+        os.getpid(), threading.get_ident(), os.path.basename(filename)))
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, filename)
+
+
+def write_fsf_files(root_path, subject, task, n_scans=None,
+                    template_dir=TEMPLATE_DIR):
+    """Write the level 1 and level 2 fsf files of a subject task, as
+    prepare.sh does.
+
+    Parameters
+    ----------
+    n_scans: dict or None,
+        Number of volumes of each direction. Read from the header of the
+        runs if not provided.
+
+    Returns
+    -------
+    filenames: list of str, the fsf files of RL, LR and the level 2
+    """
+    results_dir = join(root_path, str(subject), 'MNINonLinear', 'Results')
+    filenames = []
+    for direction in ['RL', 'LR']:
+        name = 'tfMRI_%s_%s' % (task, direction)
+        if n_scans is not None and direction in n_scans:
+            this_n_scans = n_scans[direction]
+        else:
+            this_n_scans = nibabel.load(join(results_dir, name,
+                                             name + '.nii.gz')).shape[3]
+        filename = join(results_dir, name, level1_fsf_name(task, direction))
+        _write(render_level1_fsf(task, direction, this_n_scans,
+                                 template_dir), filename)
+        filenames.append(filename)
+    level2_dir = join(results_dir, 'tfMRI_%s' % task)
+    if not os.path.exists(level2_dir):
+        os.makedirs(level2_dir, exist_ok=True)
+    filename = join(level2_dir, level2_fsf_name(task))
+    text, _ = load_template(level2_fsf_name(task), template_dir)
+    _write(text, filename)
+    filenames.append(filename)
+    return filenames
+
+
+def parse_fsf(text):
+    """Values of the `set group(key) value` lines of an fsf file, read in a
+    single pass.
+
+    Returns
+    -------
+    settings: dict, mapping (group, key) to the value, unquoted
+    """
+    settings = {}
+    for match in SET_REGEX.finditer(text):
+        value = match.group(3)
+        if len(value) >= 2 and value[0] == value[-1] == '"':
+            value = value[1:-1]
+        settings[match.group(1), match.group(2)] = value
+    return settings
+
+
+def _design_from_settings(settings):
+    """FsfDesign of parsed settings, with timing files as written in the
+    file."""
+    def get(key):
+        try:
+            return settings['fmri', key]
+        except KeyError:
+            raise ValueError('Missing fmri(%s) in design file' % key)
+
+    n_conditions_orig = int(get('evs_orig'))
+    n_conditions = int(get('evs_real'))
+    n_contrasts = int(get('ncon_real'))
+    conditions = [get('evtitle%i' % i) for i in
+                  range(1, n_conditions_orig + 1)]
+    timing_files = [settings['fmri', 'custom%i' % i]
+                    for i in range(1, n_conditions_orig + 1)
+                    if ('fmri', 'custom%i' % i) in settings]
+    contrast_names = [get('conname_real.%i' % i) for i in
+                      range(1, n_contrasts + 1)]
+    contrasts = np.zeros((n_contrasts, n_conditions))
+    count = 0
+    for (group, key), value in settings.items():
+        if group != 'fmri' or not key.startswith('con_real'):
+            continue
+        i, _, j = key[len('con_real'):].partition('.')
+        i, j = int(i) - 1, int(j) - 1
+        if not (0 <= i < n_contrasts and 0 <= j < n_conditions):
+            raise ValueError('Contrast value fmri(%s) out of range' % key)
+        contrasts[i, j] = float(value)
+        count += 1
+    if count != n_contrasts * n_conditions:
+        raise ValueError('Expected %i contrast values, got %i'
+                         % (n_contrasts * n_conditions, count))
+    return FsfDesign(conditions, timing_files, contrast_names, contrasts)
+
+
+def read_fsf_design(filename, cache=None):
+    """Conditions, timing files and contrasts of an fsf file.
+
+    Parsed designs are memoized by the hash of the file content, so that a
+    template shared by many subjects is parsed once. Timing files are
+    resolved relative to the directory of filename, without changing the
+    working directory.
+
+    Parameters
+    ----------
+    cache: hcp_builder.utils.cache.LRUCache or None,
+        Defaults to a module-level cache of 64 designs.
+
+    Returns
+    -------
+    design: FsfDesign, a copy that the caller may modify
+    """
+    if cache is None:
+        cache = _fsf_cache
+    with open(filename, 'rb') as f:
+        content = f.read()
+    design = cache.get(hashlib.md5(content).hexdigest(),
+                       lambda: _design_from_settings(
+                           parse_fsf(content.decode('utf-8'))))
+    ref_dir = dirname(os.path.abspath(filename))
+    return FsfDesign(list(design.conditions),
+                     [os.path.normpath(join(ref_dir, timing_file))
+                      for timing_file in design.timing_files],
+                     list(design.contrast_names), design.contrasts.copy())
@@ -1,52 +1,230 @@
 import inspect
+import json
 import os
 import shutil
-import subprocess
 import subprocess as sp
 import sys
+import threading
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from os.path import dirname
 from os.path import join
 
 from hcp_builder.dataset import get_data_dirs
 
+FSL_SETUP = '/etc/fsl/5.0/fsl.sh'
+ENV_FILE = 'fsl_env.json'
 
-def configure():
+_environments = {}
+_environments_lock = threading.Lock()
+
+
+def _source_environment(setup_script):
+    """Variables set by sourcing setup_script in an empty shell."""
+    command = ['env', '-i', 'bash', '-c',
+               'source "%s" > /dev/null && env -0' % setup_script]
+    output = sp.check_output(command).decode('utf-8')
+    env = {}
+    for line in output.split('\0'):
+        key, sep, value = line.partition('=')
+        if sep:
+            env[key] = value
+    return env
+
+
+def fsl_environment(setup_script=FSL_SETUP, cache_file=None):
+    """Environment of the FSL commands, to pass to subprocesses with env=.
+
+    The variables set by setup_script are resolved once per process, and
+    persisted in cache_file (by default fsl_env.json in the data
+    directory) along with the modification time of the script, so that the
+    shell is only spawned again when the script changes. os.environ is left
+    untouched.
+
+    Returns
+    -------
+    env: dict, a copy of os.environ updated with the FSL and HCP pipeline
+        variables
+    """
+    if cache_file is None:
+        cache_file = join(get_data_dirs()[0], ENV_FILE)
+    mtime = os.stat(setup_script).st_mtime_ns
+    key = (setup_script, mtime)
+    with _environments_lock:
+        if key not in _environments:
+            fsl_env = None
+            try:
+                with open(cache_file, 'r') as f:
+                    cached = json.load(f)
+                if (cached['script'] == setup_script
+                        and cached['mtime'] == mtime):
+                    fsl_env = cached['env']
+            except (IOError, ValueError, KeyError):
+                pass
+            if fsl_env is None:
+                fsl_env = _source_environment(setup_script)
+                tmp = cache_file + '.tmp%i' % os.getpid()
+                with open(tmp, 'w') as f:
+                    json.dump({'script': setup_script, 'mtime': mtime,
+                               'env': fsl_env}, f)
+                os.replace(tmp, cache_file)
+            _environments[key] = fsl_env
+        fsl_env = _environments[key]
+    env = dict(os.environ)
+    env.update(fsl_env)
     pathname = inspect.getfile(inspect.currentframe())
-    pathname = join(dirname(dirname(pathname)), 'hcp_scripts')
-    os.environ['HCPPIPEDIR'] = join(pathname, 'HCP-pipeline-scripts')
-    os.environ['HCPPIPEDIR_tfMRIAnalysis'] = join(
-        os.environ['HCPPIPEDIR'],
-        'TaskfMRIAnalysis', 'scripts')
-    command = 'env -i bash -c "source /etc/fsl/5.0/fsl.sh && env"'
-    for line in subprocess.getoutput(command).split("\n"):
-        key, value = line.split("=")
-        os.environ[key] = value
+    pathname = join(dirname(dirname(dirname(pathname))), 'hcp_scripts')
+    env['HCPPIPEDIR'] = join(pathname, 'HCP-pipeline-scripts')
+    env['HCPPIPEDIR_tfMRIAnalysis'] = join(env['HCPPIPEDIR'],
+                                           'TaskfMRIAnalysis', 'scripts')
+    return env
 
 
-def run_cmd(lst_cmd, verbose=False):
-    process = sp.Popen(lst_cmd, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
+def configure():
+    """Set the FSL environment in os.environ.
 
+    Not thread-safe: prefer passing `fsl_environment()` to subprocesses.
+    """
+    os.environ.update(fsl_environment())
+
+
+def run_cmd(lst_cmd, verbose=False, env=None):
     s_cmd = ' '.join(lst_cmd)
     print("Command: '%s'\n" % s_cmd)
     if verbose:
-        while True:
-            out = process.stdout.read(1)
-            if process.poll() is not None:
-                break
-            if out != '':
-                sys.stdout.write(out.decode('utf-8'))
-                sys.stdout.flush()
+        # stderr is merged so that a full stderr pipe cannot block the
+        # command while stdout is read, line by line
+        process = sp.Popen(lst_cmd, stdin=sp.DEVNULL, stdout=sp.PIPE,
+                           stderr=sp.STDOUT, env=env)
+        for line in process.stdout:
+            sys.stdout.write(line.decode('utf-8', 'replace'))
+            sys.stdout.flush()
+        process.wait()
+        stderr = ''
     else:
-        process.communicate()
+        process = sp.Popen(lst_cmd, stdin=sp.DEVNULL, stdout=sp.PIPE,
+                           stderr=sp.PIPE, env=env)
+        _, stderr = process.communicate()
+        stderr = stderr.decode('utf-8', 'replace')
     if 0 != process.returncode:
-        print(process.stderr.read().decode('utf-8'))
-        raise sp.CalledProcessError(process.returncode,
-                                    s_cmd, output=process.stdout,
-                                    stderr=process.stderr)
+        print(stderr)
+        raise sp.CalledProcessError(process.returncode, s_cmd,
+                                    stderr=stderr)
     else:
         print("Command succeeded!")
 
 
+JobResult = namedtuple('JobResult', ['returncode', 'wall_time', 'max_rss',
+                                     'log_file', 'cmd'])
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_commands(cmds, log_file, env=None):
+    """Run steps in sequence, until one fails, with their stdout and stderr
+    written to log_file.
+
+    Each step is a command (a list of str), a tuple of commands that run
+    concurrently, e.g. independent runs of a task, or a Python callable
+    taking no argument, run in the calling thread. An exception raised by a
+    callable is written to the log and fails the job with exit code 1.
+
+    Returns
+    -------
+    result: JobResult,
+        Exit code of the failed command, or 0 (negative for a signal), total
+        wall time in seconds, maximum resident set size of the commands in
+        kilobytes (from wait4), log file and failed or last command run.
+    """
+    log_dir = dirname(log_file)
+    if log_dir and not os.path.exists(log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+    start = time.time()
+    returncode, max_rss, last = 0, 0, ''
+    # Concurrent commands append to the log without overwriting each other
+    with open(log_file, 'ab') as log:
+        log.truncate(0)
+        for step in cmds:
+            if callable(step):
+                func = getattr(step, 'func', step)
+                last = 'Python: %s' % getattr(func, '__name__', repr(func))
+                log.write(('%s\n' % last).encode('utf-8'))
+                try:
+                    step()
+                except Exception:
+                    log.write(traceback.format_exc().encode('utf-8'))
+                    returncode = 1
+                    break
+                continue
+            step = list(step) if isinstance(step, tuple) else [step]
+            processes = []
+            for cmd in step:
+                last = ' '.join(cmd)
+                log.write(("Command: '%s'\n" % last).encode('utf-8'))
+                log.flush()
+                # The output goes straight to the file, without going
+                # through this process
+                try:
+                    processes.append(sp.Popen(cmd, stdin=sp.DEVNULL,
+                                              stdout=log, stderr=sp.STDOUT,
+                                              env=env))
+                except OSError as e:
+                    log.write(('%s\n' % e).encode('utf-8'))
+                    returncode = 127
+                    break
+            for cmd, process in zip(step, processes):
+                _, status, rusage = os.wait4(process.pid, 0)
+                process.returncode = _exit_code(status)
+                max_rss = max(max_rss, rusage.ru_maxrss)
+                if process.returncode != 0 and returncode == 0:
+                    returncode, last = process.returncode, ' '.join(cmd)
+            if returncode != 0:
+                break
+    return JobResult(returncode, time.time() - start, max_rss, log_file,
+                     last)
+
+
+def run_jobs(jobs, n_jobs=None, env=None, verbose=0):
+    """Run jobs of sequential steps in parallel, see `run_commands`.
+
+    Parameters
+    ----------
+    jobs: list of (cmds, log_file),
+        cmds being a list of steps, see `run_commands`.
+
+    n_jobs: int or None,
+        Number of jobs running at once, i.e. the CPU budget for single
+        threaded commands. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    results: list of JobResult, in the order of jobs. Failures are reported
+        there, not raised.
+    """
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    def run(job):
+        cmds, log_file = job
+        result = run_commands(cmds, log_file, env=env)
+        if verbose > 0:
+            print('%s: %s in %.0fs, max RSS %i MB'
+                  % (log_file,
+                     'failed (%i)' % result.returncode
+                     if result.returncode else 'done',
+                     result.wall_time, result.max_rss // 1024))
+        return result
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(run, jobs))
+
+
 def clean_artifacts(subject, tasks=None, verbose=0):
     from ..dataset import _get_single_fmri_paths
 
@@ -0,0 +1,150 @@
+"""
+Persistent index of the files of a directory tree.
+"""
+import os
+import time
+from os.path import join, dirname, basename
+
+import numpy as np
+import pandas as pd
+
+# Stored in place of the modification time of directories listed in the
+# second they were modified, which must be listed again
+RESCAN = -1
+
+
+class Inventory(object):
+    """Index of the files below some subtrees of a root directory.
+
+    Directories are listed with os.scandir. Each listing is stored along with
+    the modification time of the directory, and reused as long as it does not
+    change: refreshing the index costs one stat per directory instead of one
+    per file. As modification times may have a granularity of a second, a
+    directory modified in the second it was listed is listed again on the
+    next update.
+
+    Parameters
+    ----------
+    root: str,
+        Root directory. Paths of the index are relative to it.
+
+    filename: str or None,
+        Pickle in which the index is persisted, as a frame of directories
+        and a frame of files.
+    """
+    def __init__(self, root, filename=None):
+        self.root = root
+        self.filename = filename
+        self._mtimes = {}
+        self._files = {}
+        self._subdirs = {}
+        self._paths = None
+        if filename is not None and os.path.exists(filename):
+            self._load()
+
+    def _load(self):
+        state = pd.read_pickle(self.filename)
+        directories, files = state['directories'], state['files']
+        self._mtimes = dict(zip(directories['directory'],
+                                directories['mtime']))
+        self._files = {directory: [] for directory in self._mtimes}
+        self._subdirs = {directory: [] for directory in self._mtimes}
+        for directory in directories['directory']:
+            parent = dirname(directory)
+            if parent in self._subdirs:
+                self._subdirs[parent].append(basename(directory))
+        for directory, names in files.groupby('directory',
+                                              observed=True)['name']:
+            self._files[directory] = names.astype(str).tolist()
+
+    def save(self):
+        directories = pd.DataFrame({'directory': list(self._mtimes),
+                                    'mtime': list(self._mtimes.values())})
+        lengths = [len(self._files[directory]) for directory in self._mtimes]
+        files = pd.DataFrame(
+            {'directory': pd.Categorical(np.repeat(list(self._mtimes),
+                                                   lengths)),
+             'name': pd.Categorical([name for directory in self._mtimes
+                                     for name in self._files[directory]])})
+        tmp = self.filename + '.tmp%i' % os.getpid()
+        pd.to_pickle({'directories': directories, 'files': files}, tmp)
+        os.replace(tmp, self.filename)
+
+    def _walk_known(self, subtrees):
+        stack = [subtree for subtree in subtrees if subtree in self._mtimes]
+        known = set()
+        while stack:
+            directory = stack.pop()
+            known.add(directory)
+            stack.extend(join(directory, subdir)
+                         for subdir in self._subdirs[directory])
+        return known
+
+    def update(self, subtrees):
+        """Refresh the listing of subtrees, relative to root.
+
+        Only the directories whose modification time changed are listed
+        again. The index is saved if anything changed.
+        """
+        known = self._walk_known(subtrees)
+        scan_time = int(time.time())
+        seen = set()
+        changed = False
+        stack = list(subtrees)
+        while stack:
+            directory = stack.pop()
+            path = join(self.root, directory)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            seen.add(directory)
+            if self._mtimes.get(directory) != mtime:
+                files, subdirs = [], []
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            subdirs.append(entry.name)
+                        else:
+                            files.append(entry.name)
+                if mtime // 10 ** 9 >= scan_time:
+                    mtime = RESCAN
+                if (self._mtimes.get(directory) != mtime or
+                        self._files.get(directory) != files or
+                        self._subdirs.get(directory) != subdirs):
+                    self._mtimes[directory] = mtime
+                    self._files[directory] = files
+                    self._subdirs[directory] = subdirs
+                    changed = True
+            stack.extend(join(directory, subdir)
+                         for subdir in self._subdirs[directory])
+        for directory in known - seen:
+            del self._mtimes[directory]
+            del self._files[directory]
+            del self._subdirs[directory]
+            changed = True
+        if changed:
+            self._paths = None
+            if self.filename is not None:
+                self.save()
+
+    @property
+    def paths(self):
+        """pandas.Index of the indexed files, relative to root."""
+        if self._paths is None:
+            self._paths = pd.Index([join(directory, name)
+                                    for directory, names
+                                    in self._files.items()
+                                    for name in names])
+        return self._paths
+
+    def exists(self, paths):
+        """Vectorized existence check of absolute or root-relative paths.
+
+        Returns a boolean array.
+        """
+        paths = pd.Series(paths, dtype=object)
+        prefix = join(self.root, '')
+        absolute = paths.str.startswith(prefix)
+        paths = paths.where(~absolute, paths.str.slice(len(prefix)))
+        return np.array(paths.isin(self.paths))
@@ -0,0 +1,139 @@
+"""
+Packed storage of contrast maps: one masked (n_contrasts, n_voxels) array
+per run and map type, next to the run mask and a sidecar of contrast names.
+"""
+import json
+import os
+from os.path import join, dirname
+
+import nibabel
+import numpy as np
+
+CONTRAST_FILE = 'contrasts.json'
+MASK_FILE = 'mask.nii.gz'
+
+
+def packed_filename(output_dir, map_type):
+    """Path of the packed maps of type map_type ('z' or 'effects')."""
+    return join(output_dir, '%s_maps.npy' % map_type)
+
+
+def dump_packed(output_dir, map_type, data, contrast_names):
+    """Save masked maps of shape (n_contrasts, n_voxels) in output_dir.
+
+    The contrast-name sidecar is (re)written along with them.
+    """
+    data = np.asarray(data)
+    if data.ndim != 2 or data.shape[0] != len(contrast_names):
+        raise ValueError('Expected an array of shape (%i, n_voxels), got %s'
+                         % (len(contrast_names), data.shape))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    filename = packed_filename(output_dir, map_type)
+    tmp = filename + '.tmp%i' % os.getpid()
+    with open(tmp, 'wb') as f:
+        np.save(f, data)
+    os.replace(tmp, filename)
+    contrast_file = join(output_dir, CONTRAST_FILE)
+    tmp = contrast_file + '.tmp%i' % os.getpid()
+    with open(tmp, 'w') as f:
+        json.dump(list(contrast_names), f)
+    os.replace(tmp, contrast_file)
+
+
+def load_packed(output_dir, map_type, mmap_mode='r'):
+    """Return the packed maps of a run and their contrast names."""
+    with open(join(output_dir, CONTRAST_FILE), 'r') as f:
+        contrast_names = json.load(f)
+    data = np.load(packed_filename(output_dir, map_type), mmap_mode=mmap_mode)
+    return data, contrast_names
+
+
+def unmask_array(data, mask):
+    """Unmask (n_voxels,) or (n_maps, n_voxels) data with a boolean mask,
+    into a 3D or 4D array."""
+    data = np.asarray(data)
+    if data.ndim == 1:
+        volume = np.zeros(mask.shape, dtype=data.dtype)
+        volume[mask] = data
+    else:
+        volume = np.zeros(mask.shape + (data.shape[0],), dtype=data.dtype)
+        volume[mask] = data.T
+    return volume
+
+
+def unmask(data, mask_img):
+    """Unmask (n_voxels,) or (n_maps, n_voxels) data into a Nifti image."""
+    mask = np.asanyarray(mask_img.dataobj) != 0
+    return nibabel.Nifti1Image(unmask_array(data, mask), mask_img.affine)
+
+
+class PackedFile(object):
+    """Lazily memory-mapped packed maps of a run.
+
+    Neither the array, the sidecar nor the mask are read before they are
+    needed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._data = None
+        self._index = None
+        self._mask_img = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.load(self.filename, mmap_mode='r')
+        return self._data
+
+    @property
+    def contrast_names(self):
+        return list(self._contrast_index)
+
+    @property
+    def _contrast_index(self):
+        if self._index is None:
+            with open(join(dirname(self.filename), CONTRAST_FILE), 'r') as f:
+                self._index = {name: i for i, name in enumerate(json.load(f))}
+        return self._index
+
+    @property
+    def mask_img(self):
+        if self._mask_img is None:
+            self._mask_img = nibabel.load(join(dirname(self.filename),
+                                               MASK_FILE))
+        return self._mask_img
+
+    def index(self, contrast):
+        try:
+            return self._contrast_index[contrast]
+        except KeyError:
+            raise ValueError('Contrast %s not found in %s'
+                             % (contrast, self.filename))
+
+
+class PackedMap(object):
+    """Lazy view on one contrast map of a PackedFile.
+
+    Parameters
+    ----------
+    packed_file: PackedFile
+
+    contrast: str,
+        Name of the contrast, as listed in the sidecar.
+    """
+    def __init__(self, packed_file, contrast):
+        self.packed_file = packed_file
+        self.contrast = contrast
+
+    def get_data(self):
+        """Masked map, as a read-only view of shape (n_voxels,)."""
+        return self.packed_file.data[self.packed_file.index(self.contrast)]
+
+    def to_img(self):
+        """Unmasked map, as a 3D Nifti image."""
+        return unmask(self.get_data(), self.packed_file.mask_img)
+
+    def __repr__(self):
+        return 'PackedMap(%r, %r)' % (self.packed_file.filename,
+                                      self.contrast)
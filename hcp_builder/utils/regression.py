@@ -0,0 +1,242 @@
+"""
+Vectorized statistics over fitted regression results.
+"""
+from collections import namedtuple
+
+import numpy as np
+from scipy.stats import norm, t as t_dist
+
+# Same numerical guards as nistats.contrasts.Contrast
+TINY = 1e-50
+DOFMAX = 1e10
+
+# Number of voxels combined at once by fixed_effects
+CHUNK_SIZE = 20000
+
+# Bytes of float64 temporaries per scan and voxel in fit_ar1
+_BYTES_PER_SAMPLE = 8 * 4
+
+# Regression results of the voxels sharing an AR coefficient, with the
+# attributes of nistats RegressionResults used by compute_contrasts
+RegressionResult = namedtuple('RegressionResult',
+                              ['theta', 'cov', 'dispersion', 'df_resid'])
+
+
+def t_to_z(t_stat, dof):
+    """Convert t statistics to z-scores, through one-sided p-values."""
+    p_value = t_dist.sf(t_stat, np.minimum(dof, DOFMAX))
+    return norm.isf(np.clip(p_value, 1e-300, 1. - 1e-16))
+
+
+def compute_contrasts(labels, results, contrast_matrix):
+    """Effects, variances and z-scores of several t contrasts at once.
+
+    All contrasts are projected in a single matrix product per group of
+    voxels sharing the same regression results, instead of one traversal of
+    the results per contrast and output type.
+
+    Parameters
+    ----------
+    labels: array of shape (n_voxels,)
+        Voxel labels of a nistats GLM fit, e.g. FirstLevelModel.labels_[0].
+
+    results: dict
+        Regression results of each label, e.g. FirstLevelModel.results_[0].
+        They must provide theta, cov, dispersion and df_resid.
+
+    contrast_matrix: array of shape (n_contrasts, n_regressors)
+
+    Returns
+    -------
+    effect, variance, z_score: arrays of shape (n_contrasts, n_voxels)
+    """
+    contrast_matrix = np.atleast_2d(contrast_matrix)
+    n_contrasts = contrast_matrix.shape[0]
+    labels = np.asarray(labels)
+    effect = np.empty((n_contrasts, labels.size))
+    variance = np.empty_like(effect)
+    dof = np.empty(labels.size)
+    for label, result in results.items():
+        voxels = labels == label
+        effect[:, voxels] = contrast_matrix.dot(result.theta)
+        # diagonal of C cov C^T, for all contrasts at once
+        contrast_cov = np.einsum('ij,jk,ik->i', contrast_matrix, result.cov,
+                                 contrast_matrix)
+        variance[:, voxels] = (contrast_cov[:, np.newaxis]
+                               * result.dispersion)
+        dof[voxels] = result.df_resid
+    t_stat = effect / np.sqrt(np.maximum(variance, TINY))
+    z_score = t_to_z(t_stat, dof)
+    return effect, variance, z_score
+
+
+def residual_dof(labels, results):
+    """Residual degrees of freedom of each voxel, of shape (n_voxels,)."""
+    labels = np.asarray(labels)
+    dof = np.empty(labels.size)
+    for label, result in results.items():
+        dof[labels == label] = result.df_resid
+    return dof
+
+
+def fixed_effects(effects, variances, dofs, chunk_size=None):
+    """Inverse-variance weighted fixed effects of several runs.
+
+    Runs are combined over chunks of voxels, so that the temporaries of the
+    combination stay small whatever the number of voxels, and inputs may be
+    memory-mapped. The three outputs are allocated at full size.
+
+    Parameters
+    ----------
+    effects, variances: lists of arrays of shape (n_contrasts, n_voxels)
+        Effects and variances of the contrasts in each run.
+
+    dofs: list of arrays of shape (n_voxels,) or floats
+        Residual degrees of freedom of each run.
+
+    chunk_size: int or None,
+        Number of voxels processed at once. Defaults to CHUNK_SIZE.
+
+    Returns
+    -------
+    effect, variance, z_score: arrays of shape (n_contrasts, n_voxels)
+    """
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    n_contrasts, n_voxels = effects[0].shape
+    effect = np.empty((n_contrasts, n_voxels))
+    variance = np.empty_like(effect)
+    z_score = np.empty_like(effect)
+    dof = np.zeros(n_voxels)
+    for this_dof in dofs:
+        dof += this_dof
+    for start in range(0, n_voxels, chunk_size):
+        chunk = slice(start, min(start + chunk_size, n_voxels))
+        weight_sum = np.zeros((n_contrasts, chunk.stop - start))
+        weighted_effect = np.zeros_like(weight_sum)
+        for this_effect, this_variance in zip(effects, variances):
+            weight = 1. / np.maximum(this_variance[:, chunk], TINY)
+            weight_sum += weight
+            weighted_effect += weight * this_effect[:, chunk]
+        variance[:, chunk] = 1. / weight_sum
+        effect[:, chunk] = weighted_effect * variance[:, chunk]
+        z_score[:, chunk] = t_to_z(effect[:, chunk]
+                                   / np.sqrt(variance[:, chunk]), dof[chunk])
+    return effect, variance, z_score
+
+
+def chunk_size_from_budget(n_scans, memory_budget):
+    """Number of voxels that fit_ar1 can process at once within
+    memory_budget bytes."""
+    return max(1, int(memory_budget // (n_scans * _BYTES_PER_SAMPLE)))
+
+
+def _whiten_ar1(X, rho):
+    """AR(1) whitening of the rows of X, as nistats ARModel.whiten."""
+    whitened = X.copy()
+    whitened[1:] -= rho * X[:-1]
+    return whitened
+
+
+def _column_block(Ys, offsets, start, stop):
+    """Columns start:stop of the horizontal concatenation of Ys."""
+    blocks = []
+    for Y, offset in zip(Ys, offsets):
+        this_start = max(start - offset, 0)
+        this_stop = min(stop - offset, Y.shape[1])
+        if this_start < this_stop:
+            blocks.append(Y[:, this_start:this_stop])
+    if len(blocks) == 1:
+        return np.array(blocks[0], dtype=np.float64)
+    return np.hstack(blocks).astype(np.float64)
+
+
+def fit_ar1(Y, design, bins=100, standardize=False, chunk_size=None):
+    """Voxel-wise AR(1) GLM, fitted over chunks of voxels.
+
+    Same model as nistats run_glm(noise_model='ar1'): the AR(1) coefficient
+    of the OLS residuals of each voxel is quantized in bins, and the voxels
+    of each bin are refitted after whitening. Pseudo-inverses of the
+    whitened design are shared by all the chunks.
+
+    Parameters
+    ----------
+    Y: array of shape (n_scans, n_voxels), or list of such arrays
+        Data, possibly memory-mapped. Only chunk_size columns are loaded in
+        memory at once. A list of arrays, e.g. runs of several subjects
+        sharing the design, is fitted as their horizontal concatenation,
+        without copying them: labels and results then cover the voxels of
+        all the arrays, in order.
+
+    design: array of shape (n_scans, n_regressors)
+
+    bins: int,
+        Number of bins quantizing the AR(1) coefficients.
+
+    standardize: bool,
+        Center each voxel time series and scale it to unit energy, as nilearn
+        maskers with standardize=True.
+
+    chunk_size: int or None,
+        Number of voxels processed at once, see `chunk_size_from_budget`.
+        Defaults to CHUNK_SIZE.
+
+    Returns
+    -------
+    labels: array of shape (n_voxels,)
+        Quantized AR(1) coefficient of each voxel.
+
+    results: dict of RegressionResult, keyed on labels
+    """
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    Ys = Y if isinstance(Y, (list, tuple)) else [Y]
+    n_scans = Ys[0].shape[0]
+    n_voxels = sum(this_Y.shape[1] for this_Y in Ys)
+    offsets = np.cumsum([0] + [this_Y.shape[1] for this_Y in Ys[:-1]])
+    design = np.asarray(design, dtype=np.float64)
+    n_regressors = design.shape[1]
+    ols_pinv = np.linalg.pinv(design)
+    models = {}
+    labels = np.empty(n_voxels)
+    theta = np.empty((n_regressors, n_voxels))
+    dispersion = np.empty(n_voxels)
+    for start in range(0, n_voxels, chunk_size):
+        stop = min(start + chunk_size, n_voxels)
+        y = _column_block(Ys, offsets, start, stop)
+        if standardize:
+            y -= y.mean(axis=0)
+            energy = np.sqrt(np.sum(y ** 2, axis=0))
+            energy[energy < np.finfo(np.float64).eps] = 1.
+            y /= energy
+        resid = y - design.dot(ols_pinv.dot(y))
+        resid_energy = np.sum(resid ** 2, axis=0)
+        ar1 = np.sum(resid[1:] * resid[:-1], axis=0)
+        ar1 = np.divide(ar1, resid_energy, out=np.zeros_like(ar1),
+                        where=resid_energy > 0)
+        del resid
+        ar1 = (ar1 * bins).astype(np.int64) * 1. / bins
+        labels[start:stop] = ar1
+        for rho in np.unique(ar1):
+            if rho not in models:
+                whitened_design = _whiten_ar1(design, rho)
+                pinv = np.linalg.pinv(whitened_design)
+                models[rho] = (whitened_design, pinv,
+                               n_scans - np.linalg.matrix_rank(
+                                   whitened_design))
+            whitened_design, pinv, df_resid = models[rho]
+            voxels = np.flatnonzero(ar1 == rho)
+            wy = _whiten_ar1(y[:, voxels], rho)
+            beta = pinv.dot(wy)
+            wresid = wy - whitened_design.dot(beta)
+            theta[:, start + voxels] = beta
+            dispersion[start + voxels] = np.sum(wresid ** 2,
+                                                axis=0) / df_resid
+    results = {}
+    for rho, (_, pinv, df_resid) in models.items():
+        voxels = labels == rho
+        results[rho] = RegressionResult(theta=theta[:, voxels],
+                                        cov=pinv.dot(pinv.T),
+                                        dispersion=dispersion[voxels],
+                                        df_resid=df_resid)
+    return labels, results
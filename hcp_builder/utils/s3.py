@@ -0,0 +1,557 @@
+"""
+Concurrent transfer engine for the HCP S3 bucket.
+"""
+import gzip
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from http.client import HTTPException
+
+import boto
+
+CHUNK_SIZE = 1024 * 1024
+# Keys larger than this are fetched as parallel byte ranges
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+RANGE_SIZE = 32 * 1024 * 1024
+# Part sizes of common S3 upload clients, tried in order to reproduce
+# multipart ETags
+PART_SIZES = [mb * 1024 * 1024 for mb in (8, 16, 5, 15, 32, 64, 100,
+                                         128, 256, 512)]
+# Default process-wide number of simultaneously open S3 streams
+MAX_CONCURRENCY = 16
+
+_local = threading.local()
+
+
+def get_bucket(aws_key, aws_secret, bucket_name, host='s3.amazonaws.com'):
+    """Return the bucket handle of the calling thread.
+
+    boto connections are not thread-safe: every thread of the current process
+    lazily opens its own connection, which is then reused for all the
+    transfers it performs. Transfers run on the long-lived threads of
+    `_get_pool`, so that connections outlive the calls that opened them.
+    Connections are discarded in forked children.
+    """
+    pid = os.getpid()
+    if getattr(_local, 'pid', None) != pid:
+        _local.pid = pid
+        _local.buckets = {}
+    token = (aws_key, bucket_name, host)
+    if token not in _local.buckets:
+        con = boto.connect_s3(aws_key, aws_secret, host=host)
+        _local.buckets[token] = con.get_bucket(bucket_name, validate=False)
+    return _local.buckets[token]
+
+
+class TransferLimiter(object):
+    """Process-wide bound on concurrent S3 streams and bandwidth.
+
+    Parameters
+    ----------
+    max_concurrency: int or None,
+        Maximum number of simultaneously open S3 streams.
+
+    max_bandwidth: float or None,
+        Maximum aggregated download rate, in bytes per second.
+    """
+    def __init__(self, max_concurrency=None, max_bandwidth=None):
+        self.max_concurrency = max_concurrency
+        self.max_bandwidth = max_bandwidth
+        if max_concurrency is not None:
+            self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        else:
+            self._semaphore = None
+        self._lock = threading.Lock()
+        self._allowance = 0.
+        self._last = time.time()
+
+    def __enter__(self):
+        if self._semaphore is not None:
+            self._semaphore.acquire()
+        return self
+
+    def __exit__(self, *args):
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    def throttle(self, n_bytes):
+        """Account for n_bytes received, sleeping if above the budget."""
+        if self.max_bandwidth is None:
+            return
+        with self._lock:
+            now = time.time()
+            self._allowance = min(self.max_bandwidth,
+                                  self._allowance
+                                  + (now - self._last) * self.max_bandwidth)
+            self._last = now
+            self._allowance -= n_bytes
+            wait = - self._allowance / self.max_bandwidth
+        if wait > 0:
+            time.sleep(wait)
+
+
+_limiter = TransferLimiter(max_concurrency=MAX_CONCURRENCY)
+
+
+def set_transfer_limits(max_concurrency=MAX_CONCURRENCY, max_bandwidth=None):
+    """Set the process-wide concurrency and bandwidth limits of S3 transfers.
+
+    None removes a limit.
+    """
+    global _limiter
+    _limiter = TransferLimiter(max_concurrency=max_concurrency,
+                               max_bandwidth=max_bandwidth)
+    return _limiter
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(name, n_jobs):
+    """Module-level thread pool of n_jobs workers, created once per process
+    and reused by all the transfers. Keys and ranges have pools of their
+    own, as key downloads wait for their ranges."""
+    with _pools_lock:
+        pid = os.getpid()
+        if _pools.get('pid') != pid:
+            _pools.clear()
+            _pools['pid'] = pid
+        if (name, n_jobs) not in _pools:
+            _pools[name, n_jobs] = ThreadPoolExecutor(max_workers=n_jobs)
+        return _pools[name, n_jobs]
+
+
+class S3Manifest(object):
+    """Local index of the keys of a bucket, stored in a SQLite database.
+
+    Listing a prefix once records the size, ETag and last modification date
+    of every key below it. Existence and size checks are then answered
+    locally, without any HEAD request.
+
+    Parameters
+    ----------
+    filename: str,
+        Path of the SQLite database. It is created if needed, and can be
+        shared between processes.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(filename, timeout=60,
+                                    check_same_thread=False)
+        with self._lock, self._con:
+            self._con.execute('CREATE TABLE IF NOT EXISTS keys '
+                              '(key TEXT PRIMARY KEY, size INTEGER, '
+                              'etag TEXT, last_modified TEXT)')
+            self._con.execute('CREATE TABLE IF NOT EXISTS prefixes '
+                              '(prefix TEXT PRIMARY KEY, listed REAL)')
+
+    @staticmethod
+    def _normalize(key):
+        return key.lstrip('/')
+
+    def has_prefix(self, prefix):
+        with self._lock:
+            row = self._con.execute('SELECT 1 FROM prefixes WHERE prefix=?',
+                                    (self._normalize(prefix),)).fetchone()
+        return row is not None
+
+    def update(self, bucket, prefix, overwrite=False):
+        """List every key below prefix with a single paginated LIST."""
+        prefix = self._normalize(prefix)
+        if not overwrite and self.has_prefix(prefix):
+            return
+        rows = [(key.name, key.size, key.etag, key.last_modified)
+                for key in bucket.list(prefix=prefix)]
+        with self._lock, self._con:
+            self._con.execute("DELETE FROM keys WHERE key >= ? AND key < ?",
+                              (prefix, prefix + '\uffff'))
+            self._con.executemany('INSERT OR REPLACE INTO keys '
+                                  'VALUES (?, ?, ?, ?)', rows)
+            self._con.execute('INSERT OR REPLACE INTO prefixes '
+                              'VALUES (?, ?)', (prefix, time.time()))
+
+    def get(self, key):
+        """Return the (size, etag, last_modified) of key, or None."""
+        with self._lock:
+            return self._con.execute('SELECT size, etag, last_modified '
+                                     'FROM keys WHERE key=?',
+                                     (self._normalize(key),)).fetchone()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def close(self):
+        self._con.close()
+
+
+def stream_key(key, fileobj, headers=None, chunk_size=CHUNK_SIZE,
+               digest=None):
+    """Copy the content of an S3 key into an open file object.
+
+    If provided, the hashlib object digest is updated with the received
+    bytes. Network failures are reported as ConnectionError.
+    """
+    limiter = _limiter
+    with limiter:
+        try:
+            key.open_read(headers=headers)
+            while True:
+                chunk = key.read(chunk_size)
+                if not chunk:
+                    break
+                limiter.throttle(len(chunk))
+                if digest is not None:
+                    digest.update(chunk)
+                fileobj.write(chunk)
+        except (HTTPException, socket.error) as e:
+            raise ConnectionError('Interrupted download of %s: %s'
+                                  % (key.name, e)) from e
+        finally:
+            key.close()
+
+
+def _parse_etag(etag):
+    """Return (md5, n_parts) from an ETag. n_parts is None for keys
+    uploaded in one piece, whose ETag is the MD5 of the content."""
+    if etag is None:
+        return None, None
+    etag = etag.strip('"')
+    if '-' in etag:
+        md5, n_parts = etag.split('-')
+        return md5, int(n_parts)
+    return etag, None
+
+
+def _multipart_part_sizes(size, n_parts):
+    """Part sizes that may have been used to upload a multipart key, most
+    likely first."""
+    candidates = PART_SIZES + [- (- size // n_parts)]
+    part_sizes = []
+    for part_size in candidates:
+        if (- (- size // part_size) == n_parts and
+                part_size not in part_sizes):
+            part_sizes.append(part_size)
+    return part_sizes
+
+
+def _multipart_md5(filename, part_size, chunk_size=CHUNK_SIZE):
+    """MD5 of the concatenated part digests of a file, as in the ETag of a
+    key uploaded in parts of part_size."""
+    digests = []
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        for start in range(0, size, part_size):
+            digest = hashlib.md5()
+            remaining = min(part_size, size - start)
+            while remaining:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                remaining -= len(chunk)
+            digests.append(digest.digest())
+    return hashlib.md5(b''.join(digests)).hexdigest()
+
+
+class _RangeWriter(object):
+    """File-like object writing sequentially from an offset of a file
+    descriptor shared by several threads."""
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        while data:
+            written = os.pwrite(self.fd, data, self.offset)
+            self.offset += written
+            data = data[written:]
+
+
+def _load_range_state(sidecar, size, etag, range_size):
+    try:
+        with open(sidecar, 'r') as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if (state.get('size') != size or state.get('etag') != etag
+            or state.get('range_size') != range_size):
+        return None
+    return {(start, stop): digest for start, stop, digest in state['done']}
+
+
+def _dump_range_state(sidecar, size, etag, range_size, done):
+    tmp = sidecar + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'size': size, 'etag': etag, 'range_size': range_size,
+                   'done': [[start, stop, digest] for (start, stop), digest
+                            in sorted(done.items())]}, f)
+    os.replace(tmp, sidecar)
+
+
+def download_ranges(bucket_factory, key, target, size, etag=None,
+                    range_size=None, n_jobs=4, allow_unverified=False,
+                    verbose=0):
+    """Download a large key as byte ranges fetched in parallel.
+
+    Ranges are written in place into a preallocated `target + '.part'` file,
+    while the sidecar `target + '.part.json'` records the completed ones.
+    An interrupted download is resumed by fetching only the missing ranges.
+    The part file is renamed to target once every range is in.
+
+    For keys uploaded in several parts, ranges are aligned on the most
+    likely part size: the MD5 of each range is computed while it is written,
+    and the multipart ETag is checked without reading the file again. On a
+    mismatch, the other part sizes that fit are tried by reading the file
+    back. A plain MD5 ETag is checked by reading the file back.
+
+    If the part size cannot be found, or the key has no ETag, the gzip
+    stream of .gz files is decompressed instead. Other files cannot be
+    verified: ConnectionError is raised and the part file is kept, unless
+    allow_unverified is True. A corrupted download is removed and raises
+    ConnectionError.
+    """
+    md5, n_parts = _parse_etag(etag)
+    part_sizes = []
+    if n_parts is not None:
+        part_sizes = _multipart_part_sizes(size, n_parts)
+    if range_size is None:
+        range_size = part_sizes[0] if part_sizes else RANGE_SIZE
+
+    part = target + '.part'
+    sidecar = part + '.json'
+    ranges = [(start, min(start + range_size, size) - 1)
+              for start in range(0, size, range_size)]
+    done = None
+    if os.path.exists(part):
+        done = _load_range_state(sidecar, size, etag, range_size)
+    if done is None:
+        with open(part, 'wb') as f:
+            f.truncate(size)
+        done = {}
+        _dump_range_state(sidecar, size, etag, range_size, done)
+    missing = [r for r in ranges if r not in done]
+    if verbose:
+        print('Downloading %s from %s: %i / %i ranges to fetch'
+              % (target, key, len(missing), len(ranges)))
+    lock = threading.Lock()
+
+    def _fetch(this_range):
+        start, stop = this_range
+        s3fid = bucket_factory().new_key(key)
+        writer = _RangeWriter(fd, start)
+        digest = hashlib.md5()
+        stream_key(s3fid, writer,
+                   headers={'Range': 'bytes=%i-%i' % (start, stop)},
+                   digest=digest)
+        if writer.offset != stop + 1:
+            raise ConnectionError('Incomplete range %i-%i of %s'
+                                  % (start, stop, key))
+        with lock:
+            done[this_range] = digest.hexdigest()
+            _dump_range_state(sidecar, size, etag, range_size, done)
+
+    fd = os.open(part, os.O_WRONLY)
+    try:
+        executor = _get_pool('ranges', n_jobs)
+        futures = [executor.submit(_fetch, r) for r in missing]
+        wait(futures)
+        errors = [future.exception() for future in futures
+                  if future.exception() is not None]
+        if errors:
+            raise errors[0]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    verified = _check_ranges_etag(part, ranges, done, range_size, md5,
+                                  part_sizes)
+    if verified is None and target.endswith('.gz'):
+        if verbose:
+            print('Could not check the ETag of %s, checking its content'
+                  % key)
+        try:
+            check_gzip(part)
+            verified = True
+        except ConnectionError:
+            verified = False
+    if verified is False:
+        os.unlink(part)
+        os.unlink(sidecar)
+        raise ConnectionError('Corrupted download of %s' % key)
+    if verified is None:
+        if not allow_unverified:
+            raise ConnectionError('Could not verify the download of %s, '
+                                  'kept in %s' % (key, part))
+        if verbose:
+            print('Keeping the unverified download of %s' % key)
+    os.replace(part, target)
+    os.unlink(sidecar)
+
+
+def _check_ranges_etag(part, ranges, done, range_size, md5, part_sizes):
+    """Check the ETag of a ranged download, trying each candidate part size
+    of a multipart ETag.
+
+    Returns True if the ETag matches, False if the file does not match a
+    plain MD5 ETag, and None if the ETag could not be verified.
+    """
+    if md5 is None:
+        return None
+    if not part_sizes:
+        # Plain MD5: the digest of a single part spanning the whole file
+        this_md5 = _multipart_md5(part, max(os.path.getsize(part), 1))
+        return this_md5 == hashlib.md5(bytes.fromhex(md5)).hexdigest()
+    for part_size in part_sizes:
+        if part_size == range_size:
+            digests = b''.join(bytes.fromhex(done[r]) for r in ranges)
+            this_md5 = hashlib.md5(digests).hexdigest()
+        else:
+            this_md5 = _multipart_md5(part, part_size)
+        if this_md5 == md5:
+            return True
+    return None
+
+
+def check_gzip(filename, chunk_size=CHUNK_SIZE):
+    """Decompress a gzip file entirely, checking its CRC and length.
+
+    Raises ConnectionError if the stream is corrupted.
+    """
+    try:
+        with gzip.open(filename, 'rb') as f:
+            while f.read(chunk_size):
+                pass
+    except (OSError, EOFError, ValueError) as e:
+        raise ConnectionError('Corrupted gzip stream %s: %s'
+                              % (filename, e)) from e
+
+
+_checker = None
+
+
+def deep_check(filename):
+    """Schedule `check_gzip` on a background thread, away from the download
+    threads. Returns a concurrent.futures.Future."""
+    global _checker
+    if _checker is None:
+        _checker = ThreadPoolExecutor(max_workers=1)
+    return _checker.submit(check_gzip, filename)
+
+
+def download_key(bucket, key, target, overwrite=False,
+                 bucket_factory=None, n_range_jobs=4, manifest=None,
+                 allow_unverified=False, verbose=0):
+    """Download a single key of the bucket into target.
+
+    Keys larger than MULTIPART_THRESHOLD are fetched as resumable parallel
+    byte ranges, see `download_ranges`. Smaller keys are streamed while their
+    MD5 is computed, and checked against the ETag. If a S3Manifest is
+    provided, the key metadata are read from it instead of being requested
+    to S3. Raises FileNotFoundError if the key does not exist and
+    ConnectionError if the transfer fails, if the downloaded file does not
+    match the size or ETag of the key, or if it cannot be verified and
+    allow_unverified is False.
+    """
+    if manifest is not None:
+        entry = manifest.get(key)
+        if entry is None:
+            raise FileNotFoundError('File does not exist on S3')
+        s3fid = bucket.new_key(key)
+        s3fid.size, s3fid.etag, s3fid.last_modified = entry
+    else:
+        s3fid = bucket.get_key(key)
+        if s3fid is None:
+            raise FileNotFoundError('File does not exist on S3')
+    if os.path.exists(target) and not overwrite:
+        if verbose:
+            print('Skipping %s as it already exists' % target)
+        return
+    if s3fid.size is not None and s3fid.size > MULTIPART_THRESHOLD:
+        if bucket_factory is None:
+            def bucket_factory():
+                return bucket
+        download_ranges(bucket_factory, key, target, s3fid.size,
+                        etag=s3fid.etag, n_jobs=n_range_jobs,
+                        allow_unverified=allow_unverified, verbose=verbose)
+    else:
+        if verbose:
+            print('Downloading %s from %s' % (target, key))
+        part = target + '.part'
+        digest = hashlib.md5()
+        with open(part, 'wb') as f:
+            stream_key(s3fid, f, digest=digest)
+            length = f.tell()
+        md5, n_parts = _parse_etag(s3fid.etag)
+        if ((s3fid.size is not None and length != s3fid.size)
+                or (md5 is not None and n_parts is None
+                    and digest.hexdigest() != md5)):
+            os.unlink(part)
+            raise ConnectionError('Corrupted download of %s' % key)
+        os.replace(part, target)
+
+
+def download_keys(bucket_factory, keys, targets, n_jobs=4,
+                  overwrite=False, manifest=None, deep=False,
+                  allow_unverified=False, verbose=0):
+    """Download several keys at once with a bounded thread pool.
+
+    The download threads, and their S3 connections, are kept for the next
+    calls. The number of open streams is bounded process-wide, see
+    `set_transfer_limits`.
+
+    Parameters
+    ----------
+    bucket_factory: callable,
+        Returns the bucket handle to use in the calling thread, typically
+        a partial of `get_bucket`.
+
+    keys: list of str,
+        S3 keys to fetch.
+
+    targets: list of str,
+        Local filenames, one per key. Parent directories are created.
+
+    n_jobs: int,
+        Number of download threads.
+
+    manifest: S3Manifest or None,
+        Index answering existence and size checks without HEAD requests.
+
+    deep: bool,
+        Also check the gzip CRC of downloaded .gz files, on a background
+        thread.
+
+    allow_unverified: bool,
+        Keep the large files whose ETag cannot be checked, instead of
+        reporting them as failures.
+
+    Returns
+    -------
+    failures: list of (key, target, exception)
+        Transfers that raised, in the order of keys.
+    """
+    def _download(key, target):
+        dirname = os.path.dirname(target)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        try:
+            download_key(bucket_factory(), key, target, overwrite=overwrite,
+                         bucket_factory=bucket_factory,
+                         manifest=manifest,
+                         allow_unverified=allow_unverified, verbose=verbose)
+        except (FileNotFoundError, ConnectionError) as e:
+            return e
+        if deep and target.endswith('.gz'):
+            return deep_check(target)
+
+    errors = list(_get_pool('keys', n_jobs).map(_download, keys, targets))
+    errors = [error.exception() if isinstance(error, Future) else error
+              for error in errors]
+    return [(key, target, error) for key, target, error
+            in zip(keys, targets, errors) if error is not None]
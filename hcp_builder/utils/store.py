@@ -0,0 +1,138 @@
+"""
+Masked maps of a cohort stored as one uncompressed, memory-mappable array.
+"""
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
+
+import nibabel
+import numpy as np
+import pandas as pd
+
+from .packed import PackedMap
+
+MAPS_FILE = 'maps.npy'
+INDEX_FILE = 'index.pkl'
+MASK_FILE = 'mask.nii.gz'
+
+
+def _masked_map(source, mask):
+    """Masked data of a Nifti path or a PackedMap."""
+    if isinstance(source, PackedMap):
+        img = source.to_img()
+    else:
+        img = nibabel.load(source)
+    if img.shape[:3] != mask.shape:
+        raise ValueError('Map %s has shape %s, while the mask has shape %s'
+                         % (source, img.shape, mask.shape))
+    return np.asanyarray(img.dataobj)[mask]
+
+
+def write_store(store_dir, sources, index, mask_img, batch_size=256,
+                n_jobs=1, verbose=0):
+    """Write masked maps in a single float32 array of shape
+    (n_maps, n_voxels).
+
+    Parameters
+    ----------
+    store_dir: str,
+        Output directory. It is replaced once the store is complete.
+
+    sources: sequence of str or PackedMap,
+        Maps to store, in row order.
+
+    index: pandas.Index,
+        Row labels, e.g. the (subject, task, contrast, direction) index of
+        `fetch_hcp_contrasts`.
+
+    mask_img: str or Nifti image,
+        Mask applied to every map. A copy is stored along with the maps.
+
+    batch_size: int,
+        Number of maps loaded in memory at once.
+
+    n_jobs: int,
+        Number of threads decompressing the maps.
+    """
+    if len(sources) != len(index):
+        raise ValueError('Got %i maps for an index of length %i'
+                         % (len(sources), len(index)))
+    if isinstance(mask_img, str):
+        mask_img = nibabel.load(mask_img)
+    mask = np.asanyarray(mask_img.dataobj) != 0
+    tmp_dir = store_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    nibabel.save(nibabel.Nifti1Image(mask.astype(np.int8), mask_img.affine),
+                 join(tmp_dir, MASK_FILE))
+    maps = np.lib.format.open_memmap(join(tmp_dir, MAPS_FILE), mode='w+',
+                                     dtype=np.float32,
+                                     shape=(len(sources), int(mask.sum())))
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for start in range(0, len(sources), batch_size):
+            batch = sources[start:start + batch_size]
+            for i, data in enumerate(executor.map(
+                    lambda source: _masked_map(source, mask), batch)):
+                maps[start + i] = data
+            if verbose > 0:
+                print('Stored %i/%i maps' % (start + len(batch),
+                                             len(sources)))
+    maps.flush()
+    del maps
+    pd.to_pickle(pd.Series(np.arange(len(index)), index=index),
+                 join(tmp_dir, INDEX_FILE))
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.replace(tmp_dir, store_dir)
+
+
+def _as_slice(positions):
+    """Slice equivalent to an array of positions, or None if they are not
+    evenly spaced."""
+    if len(positions) == 0:
+        return slice(0, 0)
+    if len(positions) == 1:
+        return slice(positions[0], positions[0] + 1)
+    steps = np.diff(positions)
+    step = steps[0]
+    if step <= 0 or np.any(steps != step):
+        return None
+    return slice(positions[0], positions[-1] + 1, step)
+
+
+def read_index(store_dir):
+    """Row positions of a store, as a Series indexed by the row labels."""
+    return pd.read_pickle(join(store_dir, INDEX_FILE))
+
+
+def read_store(store_dir, rows=None):
+    """Return the maps of a store and their row labels.
+
+    Parameters
+    ----------
+    store_dir: str,
+        Directory written by `write_store`.
+
+    rows: Series or None,
+        Subset of the `read_index` Series, in store order. All rows are
+        returned if None.
+
+    Returns
+    -------
+    maps: array of shape (n_rows, n_voxels)
+        A zero-copy np.memmap view when the selected rows are evenly spaced
+        in the store (e.g. all the contrasts of a range of subjects), an
+        in-memory copy otherwise.
+
+    index: pandas.Index of the selected rows
+    """
+    maps = np.load(join(store_dir, MAPS_FILE), mmap_mode='r')
+    if rows is None:
+        rows = read_index(store_dir)
+    positions = rows.values
+    selection = _as_slice(positions)
+    if selection is None:
+        return np.asarray(maps[positions]), rows.index
+    return maps[selection], rows.index
@@ -0,0 +1,143 @@
+"""
+Masked fMRI runs cached as uncompressed (n_scans, n_voxels) arrays.
+"""
+import gzip
+import hashlib
+import json
+import os
+
+import nibabel
+import numpy as np
+from scipy import ndimage
+
+
+def mask_key(mask_img):
+    """Short hash identifying a mask, used to name the cached runs."""
+    mask = np.asanyarray(mask_img.dataobj) != 0
+    md5 = hashlib.md5()
+    md5.update(str(mask.shape).encode())
+    md5.update(np.asarray(mask_img.affine, dtype=np.float64).tobytes())
+    md5.update(np.packbits(mask).tobytes())
+    return md5.hexdigest()[:12]
+
+
+def cache_filename(filename, key):
+    """Cache path of a run, next to it: <run>_masked_<key>.npy"""
+    if filename.endswith('.nii.gz'):
+        filename = filename[:-len('.nii.gz')]
+    elif filename.endswith('.nii'):
+        filename = filename[:-len('.nii')]
+    return '%s_masked_%s.npy' % (filename, key)
+
+
+def smooth_volume(volume, affine, fwhm):
+    """Gaussian smoothing of a 3D volume in place, as nilearn maskers do
+    with smoothing_fwhm."""
+    volume[~np.isfinite(volume)] = 0
+    voxel_size = np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
+    sigmas = fwhm / (np.sqrt(8 * np.log(2)) * voxel_size)
+    for axis, sigma in enumerate(sigmas):
+        ndimage.gaussian_filter1d(volume, sigma, output=volume, axis=axis)
+    return volume
+
+
+def iter_volumes(filename, mask=None, smoothing_fwhm=None):
+    """Stream the volumes of a 4D Nifti file, decompressing one at a time.
+
+    Parameters
+    ----------
+    filename: str,
+        .nii or .nii.gz file.
+
+    mask: boolean array or None,
+        If provided, yield the masked volumes, in the order of mask[mask]
+        (the order of nilearn maskers).
+
+    smoothing_fwhm: float or None,
+        If provided, volumes are smoothed before masking.
+
+    Yields
+    ------
+    volume: float32 array, of the 3D shape of the image or of shape
+        (n_voxels,)
+    """
+    # Offset and scaling of the data, as read from the header by nibabel
+    img = nibabel.load(filename)
+    proxy = img.dataobj
+    shape = proxy.shape
+    if len(shape) != 4:
+        raise ValueError('Expected a 4D image, got shape %s' % (shape,))
+    dtype = proxy.dtype
+    slope, inter = proxy.slope, proxy.inter
+    n_voxels = int(np.prod(shape[:3]))
+    if mask is not None:
+        if mask.shape != tuple(shape[:3]):
+            raise ValueError('Mask of shape %s does not match image of shape'
+                             ' %s' % (mask.shape, shape))
+        # Positions of the masked voxels in the Fortran-ordered volumes
+        indices = np.ravel_multi_index(np.nonzero(mask), shape[:3],
+                                       order='F')
+    smooth = smoothing_fwhm is not None and smoothing_fwhm > 0
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as f:
+        f.read(int(proxy.offset))
+        for _ in range(shape[3]):
+            data = f.read(n_voxels * dtype.itemsize)
+            if len(data) != n_voxels * dtype.itemsize:
+                raise ValueError('Truncated image %s' % filename)
+            volume = np.frombuffer(data, dtype=dtype)
+            if mask is not None and not smooth:
+                volume = volume[indices]
+            volume = volume.astype(np.float32)
+            if slope is not None and slope != 1:
+                volume *= slope
+            if inter is not None and inter != 0:
+                volume += inter
+            if mask is None or smooth:
+                volume = volume.reshape(shape[:3], order='F')
+            if smooth:
+                volume = smooth_volume(volume, img.affine, smoothing_fwhm)
+                if mask is not None:
+                    volume = volume[mask]
+            yield volume
+
+
+def _source_state(source):
+    stat = os.stat(source)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def is_cached(source, target):
+    """Whether target holds the masked data of the current source file."""
+    try:
+        with open(target + '.json', 'r') as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return False
+    return os.path.exists(target) and state == _source_state(source)
+
+
+def cache_timeseries(source, target, mask_img, overwrite=False):
+    """Write the masked data of a 4D run as a float32 array of shape
+    (n_scans, n_voxels).
+
+    The run is decompressed volume by volume, so that memory use does not
+    depend on its length. The size and modification time of the source are
+    recorded in a sidecar, target + '.json': the cache is rebuilt if the
+    source changes.
+    """
+    if not overwrite and is_cached(source, target):
+        return target
+    mask = np.asanyarray(mask_img.dataobj) != 0
+    n_scans = nibabel.load(source).shape[3]
+    tmp = target + '.tmp%i' % os.getpid()
+    data = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32,
+                                     shape=(n_scans, int(mask.sum())))
+    for i, volume in enumerate(iter_volumes(source, mask=mask)):
+        data[i] = volume
+    data.flush()
+    del data
+    os.replace(tmp, target)
+    with open(target + '.json', 'w') as f:
+        json.dump(_source_state(source), f)
+    return target
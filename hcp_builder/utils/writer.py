@@ -0,0 +1,101 @@
+"""
+Background saving of Nifti images.
+"""
+import gzip
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel
+
+
+def save_img(img, filename, compresslevel=None):
+    """Save a Nifti image atomically.
+
+    .nii.gz files are compressed with the given zlib level; 0 stores the
+    data uncompressed within a valid gzip stream, so that file names do not
+    change. None uses the nibabel default.
+    """
+    directory, name = os.path.split(filename)
+    # Keep the extension, from which nibabel infers the file format
+    tmp = os.path.join(directory, '.tmp%i.%i.%s' % (os.getpid(),
+                                                    threading.get_ident(),
+                                                    name))
+    try:
+        if compresslevel is None or not filename.endswith('.gz'):
+            nibabel.save(img, tmp)
+        else:
+            with gzip.open(tmp, 'wb', compresslevel=compresslevel) as f:
+                img.to_file_map({'image': nibabel.FileHolder(fileobj=f)})
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+class ImageWriter(object):
+    """Pool of threads saving images in the background.
+
+    zlib releases the GIL, so that compression runs concurrently with the
+    computations of the caller. save() blocks when max_pending images are
+    waiting, which bounds the memory held by the queue. Pending images are
+    flushed when leaving the context, and write errors are raised there.
+
+    Parameters
+    ----------
+    n_jobs: int,
+        Number of writer threads. 0 saves images synchronously.
+
+    max_pending: int or None,
+        Maximum number of images queued or being written. Defaults to
+        2 * n_jobs.
+
+    compresslevel: int or None,
+        zlib level of .nii.gz files, see `save_img`.
+    """
+    def __init__(self, n_jobs=2, max_pending=None, compresslevel=None):
+        self.n_jobs = n_jobs
+        self.compresslevel = compresslevel
+        if max_pending is None:
+            max_pending = 2 * max(n_jobs, 1)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = (ThreadPoolExecutor(max_workers=n_jobs)
+                          if n_jobs > 0 else None)
+        self._futures = []
+
+    def _save(self, img, filename):
+        try:
+            save_img(img, filename, compresslevel=self.compresslevel)
+        finally:
+            self._slots.release()
+
+    def save(self, img, filename):
+        """Queue img to be saved to filename."""
+        self._slots.acquire()
+        if self._executor is None:
+            self._save(img, filename)
+            return
+        self._futures.append(self._executor.submit(self._save, img,
+                                                   filename))
+
+    def flush(self):
+        """Wait for the queued images, raising the first write error."""
+        futures, self._futures = self._futures, []
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()